@@ -0,0 +1,255 @@
+import atexit
+import collections
+import gzip
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+
+from instrumentation import increment, timed
+from utils import get_abs_path, get_config
+
+
+# Samples recorded since the last push, as (site, metric, record).
+# Only filled once start_agent() has found an AGGREGATOR_URL.
+_buffer = collections.deque()
+_buffer_lock = threading.Lock()
+
+_agent = {
+    "thread": None,
+    "wake": threading.Event(),
+    "session": None,
+    # Consecutive failed pushes, the next attempt backs off exponentially
+    "failures": 0,
+    "retry_at": 0,
+}
+# Pushes and spool writes of a batch never run concurrently
+_push_lock = threading.Lock()
+
+
+def enqueue(site_name, metric, records):
+    '''
+    Buffer samples for the aggregator. Does nothing
+    unless the agent is running.
+    '''
+    if _agent["thread"] is None or not records:
+        return
+
+    config = get_config()
+    with _buffer_lock:
+        for record in records:
+            _buffer.append((site_name, metric, record))
+        overflow = len(_buffer) - config.get('AGENT_BUFFER_SIZE', 50000)
+        for _ in range(max(overflow, 0)):
+            _buffer.popleft()
+        pending = len(_buffer)
+
+    if overflow > 0:
+        increment('agent.records.dropped', overflow)
+    if pending >= config.get('AGENT_BATCH_SIZE', 500):
+        _agent["wake"].set()
+
+
+def get_host_name(config):
+    return config.get('AGENT_HOST_NAME') or socket.gethostname()
+
+
+def get_spool_folder(config):
+    return get_abs_path(config.get('AGENT_SPOOL_DIR', 'spool'))
+
+
+def take_batches(batch_size):
+    with _buffer_lock:
+        items = list(_buffer)
+        _buffer.clear()
+    return [items[index:index + batch_size] for index in range(0, len(items), batch_size)]
+
+
+def encode_batch(host_name, items):
+    '''
+    Gzipped JSON of a batch, records grouped by site and metric.
+    The batch_id lets the aggregator drop a batch sent twice.
+    '''
+    samples = {}
+    for site_name, metric, record in items:
+        samples.setdefault(site_name, {}).setdefault(metric, []).append(record)
+
+    batch = {
+        "host": host_name,
+        "batch_id": uuid.uuid4().hex,
+        "sent_at": time.time(),
+        "samples": samples,
+    }
+    return gzip.compress(json.dumps(batch, separators=(',', ':')).encode(), compresslevel=6)
+
+
+def get_session():
+    if _agent["session"] is None:
+        import requests
+
+        _agent["session"] = requests.Session()
+    return _agent["session"]
+
+
+def send_batch(payload, config):
+    '''
+    POST a batch to the aggregator, retrying AGENT_MAX_RETRIES times.
+    Returns False if it should be spooled and tried again later.
+    '''
+    import requests
+
+    url = config['AGGREGATOR_URL'].rstrip('/') + '/ingest'
+    headers = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+    if config.get('AGGREGATOR_TOKEN'):
+        headers["Authorization"] = f"Bearer {config['AGGREGATOR_TOKEN']}"
+
+    max_retries = config.get('AGENT_MAX_RETRIES', 2)
+    for attempt in range(max_retries + 1):
+        try:
+            with timed('agent.push'):
+                response = get_session().post(url, data=payload, headers=headers, timeout=config.get('AGENT_TIMEOUT', 10))
+            if response.status_code == 200:
+                return True
+            # A batch the aggregator refuses won't be accepted later either
+            if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+                logging.error(f"Aggregator rejected a batch with {response.status_code}: {response.text[:200]}")
+                increment('agent.batches.rejected')
+                return True
+            logging.warning(f"Aggregator answered {response.status_code}, attempt {attempt + 1} of {max_retries + 1}")
+        except requests.RequestException as e:
+            logging.warning(f"Push to {url} failed, attempt {attempt + 1} of {max_retries + 1}: {e}")
+
+        if attempt < max_retries:
+            time.sleep(min(2 ** attempt, 30) * random.uniform(0.5, 1.5))
+
+    return False
+
+
+def spool_batch(payload, config):
+    '''
+    Keep a batch on disk until the aggregator is back. The oldest
+    batches are dropped once the spool exceeds AGENT_SPOOL_MAX_MB.
+    '''
+    folder = get_spool_folder(config)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    path = os.path.join(folder, f'{time.time_ns()}_{uuid.uuid4().hex[:8]}.json.gz')
+    with open(path + '.tmp', 'wb') as file:
+        file.write(payload)
+    os.replace(path + '.tmp', path)
+    increment('agent.batches.spooled')
+
+    max_bytes = config.get('AGENT_SPOOL_MAX_MB', 100) * 1024 * 1024
+    spooled = get_spooled_files(folder)
+    total = sum(size for _, size in spooled)
+    for old_path, size in spooled:
+        if total <= max_bytes:
+            break
+        os.remove(old_path)
+        total -= size
+        increment('agent.batches.dropped')
+        logging.warning(f"Agent spool is over {max_bytes} bytes, dropped {old_path}")
+
+
+def get_spooled_files(folder):
+    '''
+    Spooled batches oldest first, as (path, size)
+    '''
+    if not os.path.exists(folder):
+        return []
+    entries = [entry for entry in os.scandir(folder) if entry.name.endswith('.json.gz')]
+    entries.sort(key=lambda entry: entry.name)
+    return [(entry.path, entry.stat().st_size) for entry in entries]
+
+
+def drain_spool(config):
+    '''
+    Send spooled batches oldest first. Returns False as
+    soon as one fails, leaving it and the rest in place.
+    '''
+    for path, _ in get_spooled_files(get_spool_folder(config)):
+        with open(path, 'rb') as file:
+            payload = file.read()
+        if not send_batch(payload, config):
+            return False
+        os.remove(path)
+        increment('agent.batches.sent')
+    return True
+
+
+def push_pending():
+    '''
+    Push the spool, then the buffer. While the aggregator is down new
+    batches go straight to the spool and pushes back off exponentially.
+    '''
+    config = get_config()
+    if not config.get('AGGREGATOR_URL'):
+        return
+
+    with _push_lock:
+        host_name = get_host_name(config)
+        payloads = [encode_batch(host_name, items) for items in take_batches(config.get('AGENT_BATCH_SIZE', 500))]
+
+        delivered = False
+        if time.time() >= _agent["retry_at"]:
+            delivered = drain_spool(config)
+            while delivered and payloads:
+                delivered = send_batch(payloads[0], config)
+                if delivered:
+                    payloads.pop(0)
+                    increment('agent.batches.sent')
+
+        for payload in payloads:
+            spool_batch(payload, config)
+
+        if delivered:
+            if _agent["failures"]:
+                logging.info(f"Aggregator reachable again after {_agent['failures']} failed pushes")
+            _agent["failures"] = 0
+            _agent["retry_at"] = 0
+        elif time.time() >= _agent["retry_at"]:
+            _agent["failures"] += 1
+            backoff = min(config.get('AGENT_PUSH_INTERVAL', 10) * 2 ** _agent["failures"], config.get('AGENT_MAX_BACKOFF', 300))
+            _agent["retry_at"] = time.time() + backoff
+            logging.warning(f"Aggregator unreachable, spooling batches and retrying in {backoff}s")
+
+
+def _push_forever():
+    while True:
+        _agent["wake"].wait(get_config().get('AGENT_PUSH_INTERVAL', 10))
+        _agent["wake"].clear()
+        try:
+            push_pending()
+        except Exception as e:
+            logging.exception(f"Agent push failed: {e}")
+
+
+def spool_buffer():
+    # Samples still in memory at exit are pushed on the next start
+    config = get_config()
+    if not config.get('AGGREGATOR_URL'):
+        return
+    with _push_lock:
+        for items in take_batches(config.get('AGENT_BATCH_SIZE', 500)):
+            spool_batch(encode_batch(get_host_name(config), items), config)
+
+
+def start_agent():
+    '''
+    Push recorded samples to AGGREGATOR_URL every AGENT_PUSH_INTERVAL
+    seconds from a daemon thread. Does nothing unless AGGREGATOR_URL
+    is set. Safe to call more than once.
+    '''
+    config = get_config()
+    if not config.get('AGGREGATOR_URL') or _agent["thread"] is not None:
+        return
+
+    _agent["thread"] = threading.Thread(target=_push_forever, name='agent-push', daemon=True)
+    _agent["thread"].start()
+    atexit.register(spool_buffer)
+    logging.info(f"Pushing samples as {get_host_name(config)} to {config['AGGREGATOR_URL']}")
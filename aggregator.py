@@ -0,0 +1,271 @@
+import argparse
+import collections
+import datetime
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+
+from log_pipeline import setup_logging
+from utils import get_abs_path, get_config
+
+
+setup_logging('logs/aggregator.log')
+
+METRICS = ['hardware', 'ping', 'nginx']
+
+# Host and site names become folder names in the store
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]{0,127}$')
+
+# Batch ids recently stored per shard, so that a batch pushed again
+# after a lost response isn't stored twice
+RECENT_BATCHES_PER_SHARD = 4096
+
+# One lock per shard: agents on different shards are written in
+# parallel, those on the same shard one batch at a time
+_shards = {}
+_shards_lock = threading.Lock()
+
+_stats = {
+    "started_at": time.time(),
+    "batches": 0,
+    "duplicates": 0,
+    "rejected": 0,
+    "records": 0,
+    "hosts": {},
+}
+_stats_lock = threading.Lock()
+
+
+def get_shard_count(config):
+    return config.get('AGGREGATOR_SHARDS', 16)
+
+
+def get_shard_index(host_name, shard_count):
+    # crc32 rather than hash(), which changes between runs
+    return zlib.crc32(host_name.encode()) % shard_count
+
+
+def get_shard(index):
+    with _shards_lock:
+        shard = _shards.get(index)
+        if shard is None:
+            shard = _shards[index] = {"lock": threading.Lock(), "recent": collections.OrderedDict()}
+        return shard
+
+
+def get_store_folder(config):
+    return get_abs_path(config.get('AGGREGATOR_STORE', 'aggregated'))
+
+
+def get_host_file(store_folder, shard_index, host_name, site_name, metric, date_string):
+    '''
+    Records a host pushed for one site, metric and day, one JSON
+    object per line: <store>/shard_<n>/<host>/<site>/<metric>_metrics_<date>.jsonl
+    '''
+    return os.path.join(store_folder, f'shard_{shard_index:02d}', host_name, site_name, f'{metric}_metrics_{date_string}.jsonl')
+
+
+def decode_batch(body, content_encoding, max_bytes):
+    '''
+    Parse and validate a pushed batch.
+    Raises ValueError with a message for the agent.
+    '''
+    if content_encoding == 'gzip':
+        decompressor = zlib.decompressobj(wbits=31)
+        try:
+            body = decompressor.decompress(body, max_bytes + 1)
+        except zlib.error as e:
+            raise ValueError(f"Body is not valid gzip: {e}")
+        if len(body) > max_bytes or decompressor.unconsumed_tail:
+            raise ValueError(f"Batch is larger than {max_bytes} bytes")
+    elif content_encoding not in (None, '', 'identity'):
+        raise ValueError(f"Unsupported Content-Encoding: {content_encoding}")
+
+    try:
+        batch = json.loads(body)
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        raise ValueError(f"Body is not valid JSON: {e}")
+
+    if not isinstance(batch, dict) or not isinstance(batch.get('samples'), dict):
+        raise ValueError("Batch must be an object with samples")
+    if not NAME_PATTERN.match(str(batch.get('host', ''))):
+        raise ValueError(f"Invalid host: {batch.get('host')}")
+
+    for site_name, metrics in batch['samples'].items():
+        if not NAME_PATTERN.match(site_name) or not isinstance(metrics, dict):
+            raise ValueError(f"Invalid site: {site_name}")
+        for metric, records in metrics.items():
+            if metric not in METRICS:
+                raise ValueError(f"Unknown metric: {metric}, expected one of {', '.join(METRICS)}")
+            if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+                raise ValueError(f"Records of {site_name} {metric} must be a list of objects")
+
+    return batch
+
+
+def store_batch(batch, config):
+    '''
+    Append a batch's records to its host's shard. Returns the
+    number of records stored, 0 for a batch already stored.
+    '''
+    host_name = batch['host']
+    shard_index = get_shard_index(host_name, get_shard_count(config))
+    shard = get_shard(shard_index)
+    store_folder = get_store_folder(config)
+    received_at = time.time()
+
+    # Group by day first so each file is opened once per batch
+    lines = {}
+    for site_name, metrics in batch['samples'].items():
+        for metric, records in metrics.items():
+            for record in records:
+                timestamp = record.get('timestamp') or received_at
+                date_string = datetime.date.fromtimestamp(timestamp).strftime("%Y_%m_%d")
+                path = get_host_file(store_folder, shard_index, host_name, site_name, metric, date_string)
+                lines.setdefault(path, []).append(json.dumps(record) + '\n')
+
+    batch_id = batch.get('batch_id')
+    with shard["lock"]:
+        if batch_id and batch_id in shard["recent"]:
+            return 0
+
+        for path, path_lines in lines.items():
+            folder = os.path.dirname(path)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            with open(path, 'a') as file:
+                file.writelines(path_lines)
+
+        if batch_id:
+            shard["recent"][batch_id] = received_at
+            while len(shard["recent"]) > RECENT_BATCHES_PER_SHARD:
+                shard["recent"].popitem(last=False)
+
+    return sum(len(path_lines) for path_lines in lines.values())
+
+
+def ingest(body, headers, config):
+    '''
+    Returns (status, response) of POST /ingest
+    '''
+    token = config.get('AGGREGATOR_TOKEN')
+    if token and headers.get('Authorization') != f'Bearer {token}':
+        return 401, {"error": "Invalid token"}
+
+    try:
+        batch = decode_batch(body, headers.get('Content-Encoding'), config.get('AGGREGATOR_MAX_BATCH_MB', 16) * 1024 * 1024)
+    except ValueError as e:
+        with _stats_lock:
+            _stats["rejected"] += 1
+        logging.warning(f"Rejected batch: {e}")
+        return 400, {"error": str(e)}
+
+    stored = store_batch(batch, config)
+    with _stats_lock:
+        _stats["hosts"][batch['host']] = time.time()
+        if stored:
+            _stats["batches"] += 1
+            _stats["records"] += stored
+        else:
+            _stats["duplicates"] += 1
+
+    return 200, {"stored": stored}
+
+
+def get_status():
+    with _stats_lock:
+        stats = {**_stats, "hosts": dict(_stats["hosts"])}
+    now = time.time()
+    stats["host_count"] = len(stats["hosts"])
+    stats["hosts"] = {host_name: round(now - last_seen, 1) for host_name, last_seen in sorted(stats["hosts"].items())}
+    return stats
+
+
+def read_host_records(host_name, site_name, metric, date_string, config=None):
+    '''
+    Records the aggregator holds for one host, site, metric and day
+    '''
+    config = config or get_config()
+    shard_index = get_shard_index(host_name, get_shard_count(config))
+    path = get_host_file(get_store_folder(config), shard_index, host_name, site_name, metric, date_string)
+    if not os.path.exists(path):
+        return []
+
+    records = []
+    with open(path) as file:
+        for line in file:
+            # A line cut short by a crash mid-append is skipped
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                logging.warning(f"Skipping a malformed line in {path}")
+    return records
+
+
+def make_server(host, port):
+    import http.server
+
+    class IngestHandler(http.server.BaseHTTPRequestHandler):
+        def send(self, status, response):
+            body = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path != '/ingest':
+                self.send(404, {"error": "Not found"})
+                return
+
+            config = get_config()
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > config.get('AGGREGATOR_MAX_BATCH_MB', 16) * 1024 * 1024:
+                self.send(413, {"error": "Batch too large"})
+                return
+
+            try:
+                self.send(*ingest(self.rfile.read(length), self.headers, config))
+            except Exception as e:
+                logging.exception(f"Ingest failed: {e}")
+                self.send(500, {"error": "Internal error"})
+
+        def do_GET(self):
+            if self.path == '/status':
+                self.send(200, get_status())
+            else:
+                self.send(404, {"error": "Not found"})
+
+        def log_message(self, format, *args):
+            pass
+
+    class AggregatorServer(http.server.ThreadingHTTPServer):
+        daemon_threads = True
+        # Hundreds of agents may connect at the same moment
+        request_queue_size = 1024
+
+    return AggregatorServer((host, port), IngestHandler)
+
+
+def serve(host=None, port=None):
+    config = get_config()
+    host = host or config.get('AGGREGATOR_HOST', '127.0.0.1')
+    port = port or config.get('AGGREGATOR_PORT', 8060)
+
+    server = make_server(host, port)
+    logging.info(f"Aggregating into {get_store_folder(config)} on http://{host}:{port}/ingest")
+    print(f"Aggregator on http://{host}:{port}/ingest")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Receive samples pushed by agents into a sharded store")
+    parser.add_argument('--host', default=None)
+    parser.add_argument('--port', type=int, default=None)
+    args = parser.parse_args()
+    serve(args.host, args.port)
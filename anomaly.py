@@ -0,0 +1,266 @@
+import atexit
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+from instrumentation import increment
+from utils import get_base_dir, send_anomaly_email
+
+
+# Series watched per check, with the smallest deviation a detector
+# assumes, so a flat series doesn't turn every wobble into an anomaly
+ANOMALY_METRICS = {
+    'hardware': {'cpu_usage': 2.0, 'ram_usage': 1.0, 'load_avg_last_10_mins': 2.0},
+    'ping': {'response_time_ms': 20.0},
+}
+
+DETECTORS = ['ewma', 'seasonal', 'robust']
+
+# Hour of week baselines, Monday 00:00 is bucket 0
+SEASONAL_BUCKETS = 7 * 24
+
+# Mean absolute deviation to standard deviation of a normal distribution
+MAD_TO_STD = 1.2533
+
+# Detector state per site, {site: {kind: {metric: series state}}}, loaded
+# from and saved to results/<site>/anomaly_state.json
+_anomaly = {"sites": {}, "saved_at": {}, "registered": False}
+_anomaly_lock = threading.Lock()
+
+
+def get_state_file(site_name):
+    return os.path.join(get_base_dir(), 'results', site_name, 'anomaly_state.json')
+
+
+def new_series_state():
+    '''
+    Constant size state of one series: [mean, variance, count] of the
+    EWMA and of each hour of week, [median, mean absolute deviation, count]
+    of the robust detector, and whether the series is in an anomaly
+    '''
+    return {
+        "ewma": [0.0, 0.0, 0],
+        "seasonal": [[0.0, 0.0, 0] for _ in range(SEASONAL_BUCKETS)],
+        "robust": [0.0, 0.0, 0],
+        "anomalous": False,
+        "started_at": None,
+    }
+
+
+def load_site_state(site_name):
+    path = get_state_file(site_name)
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as file:
+        try:
+            return json.load(file)
+        except json.JSONDecodeError:
+            logging.warning(f"Anomaly state could not be parsed, starting afresh: {path}")
+            return {}
+
+
+def save_site_state(site_name):
+    path = get_state_file(site_name)
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(_anomaly["sites"][site_name], file)
+    os.replace(tmp_path, path)
+    _anomaly["saved_at"][site_name] = time.time()
+
+
+def save_all_state():
+    with _anomaly_lock:
+        for site_name in list(_anomaly["sites"]):
+            try:
+                save_site_state(site_name)
+            except OSError as e:
+                logging.error(f"Anomaly state of {site_name} could not be saved: {e}")
+
+
+def get_series_state(site_name, kind, metric):
+    site = _anomaly["sites"].get(site_name)
+    if site is None:
+        site = _anomaly["sites"][site_name] = load_site_state(site_name)
+        if not _anomaly["registered"]:
+            # Learned baselines survive a restart
+            atexit.register(save_all_state)
+            _anomaly["registered"] = True
+    series = site.setdefault(kind, {}).get(metric)
+    if series is None:
+        series = site[kind][metric] = new_series_state()
+    return series
+
+
+def get_hour_of_week(timestamp):
+    moment = datetime.datetime.fromtimestamp(timestamp)
+    return moment.weekday() * 24 + moment.hour
+
+
+def ewma_update(state, value, alpha, clip=None):
+    '''
+    Exponentially weighted mean and variance. Early values are averaged
+    evenly until there are 1 / alpha of them.
+    '''
+    mean, variance, count = state
+    if not count:
+        state[:] = [value, 0.0, 1]
+        return
+
+    if clip is not None:
+        value = min(max(value, mean - clip), mean + clip)
+    alpha = max(alpha, 1 / (count + 1))
+    difference = value - mean
+    step = alpha * difference
+    state[:] = [mean + step, (1 - alpha) * (variance + difference * step), count + 1]
+
+
+def robust_update(state, value, alpha):
+    '''
+    Streaming median, moved a step towards every value in proportion
+    to the spread, and mean absolute deviation from it with outliers clipped
+    '''
+    median, deviation, count = state
+    if not count:
+        state[:] = [value, 0.0, 1]
+        return
+
+    spread = deviation or abs(value - median)
+    if value > median:
+        median = min(median + alpha * spread, value)
+    elif value < median:
+        median = max(median - alpha * spread, value)
+
+    distance = abs(value - median)
+    if deviation:
+        distance = min(distance, 5 * deviation)
+    deviation += max(alpha, 1 / (count + 1)) * (distance - deviation)
+    state[:] = [median, deviation, count + 1]
+
+
+def score_series(series, value, timestamp, min_deviation, min_samples):
+    '''
+    z-score of value against each detector with enough samples,
+    as {detector: (score, baseline)}
+    '''
+    scores = {}
+
+    mean, variance, count = series["ewma"]
+    if count >= min_samples:
+        scores['ewma'] = ((value - mean) / max(variance ** 0.5, min_deviation), mean)
+
+    mean, variance, count = series["seasonal"][get_hour_of_week(timestamp)]
+    if count >= min_samples:
+        scores['seasonal'] = ((value - mean) / max(variance ** 0.5, min_deviation), mean)
+
+    median, deviation, count = series["robust"]
+    if count >= min_samples:
+        scores['robust'] = ((value - median) / max(deviation * MAD_TO_STD, min_deviation), median)
+
+    return scores
+
+
+def update_series(series, value, timestamp, min_deviation, config):
+    threshold = config.get('ANOMALY_Z_THRESHOLD', 4)
+
+    # Values past the threshold move the means by at most that much,
+    # so an anomaly isn't learned as the new normal within a few samples
+    _, variance, count = series["ewma"]
+    ewma_update(series["ewma"], value, config.get('ANOMALY_EWMA_ALPHA', 0.05), threshold * max(variance ** 0.5, min_deviation) if count > 1 else None)
+
+    bucket = series["seasonal"][get_hour_of_week(timestamp)]
+    _, variance, count = bucket
+    ewma_update(bucket, value, config.get('ANOMALY_SEASONAL_ALPHA', 0.02), threshold * max(variance ** 0.5, min_deviation) if count > 1 else None)
+
+    robust_update(series["robust"], value, config.get('ANOMALY_ROBUST_ALPHA', 0.05))
+
+
+def detect_anomalies(site_config, kind, values, timestamp):
+    '''
+    Score a check's values against the site's learned baselines, then
+    learn from them. Only values above their baselines are anomalies, once
+    at least ANOMALY_MIN_DETECTORS of the detectors with ANOMALY_MIN_SAMPLES
+    samples (all of them, if fewer) score past ANOMALY_Z_THRESHOLD.
+    Returns one result per value, "started" on the first anomalous check.
+    '''
+    if not site_config.get('ANOMALY_DETECTION', False):
+        return []
+
+    site_name = site_config.get('SITE_NAME', '')
+    threshold = site_config.get('ANOMALY_Z_THRESHOLD', 4)
+    min_samples = site_config.get('ANOMALY_MIN_SAMPLES', 30)
+    enabled = site_config.get('ANOMALY_DETECTORS', DETECTORS)
+    results = []
+
+    with _anomaly_lock:
+        for metric, min_deviation in ANOMALY_METRICS[kind].items():
+            value = values.get(metric)
+            if value is None:
+                continue
+
+            series = get_series_state(site_name, kind, metric)
+            scores = {
+                detector: score
+                for detector, score in score_series(series, value, timestamp, min_deviation, min_samples).items()
+                if detector in enabled
+            }
+            flagged = [detector for detector, (score, _) in scores.items() if score > threshold]
+            anomalous = bool(scores) and len(flagged) >= min(site_config.get('ANOMALY_MIN_DETECTORS', 2), len(scores))
+
+            started = anomalous and not series["anomalous"]
+            if started:
+                series["started_at"] = timestamp
+            series["anomalous"] = anomalous
+            update_series(series, value, timestamp, min_deviation, site_config)
+
+            results.append({
+                "metric": metric,
+                "timestamp": timestamp,
+                "value": value,
+                "anomalous": anomalous,
+                "started": started,
+                "detectors": flagged,
+                "scores": {detector: round(score, 2) for detector, (score, _) in scores.items()},
+                "baselines": {detector: round(baseline, 3) for detector, (_, baseline) in scores.items()},
+            })
+
+        # Without a value (a failed ping) the site's state may not even be loaded
+        if results and time.time() - _anomaly["saved_at"].get(site_name, 0) >= site_config.get('ANOMALY_PERSIST_INTERVAL', 300):
+            save_site_state(site_name)
+
+    return results
+
+
+def get_anomaly_alerts(results):
+    # As the {metric: state} alerts of metrics_server.publish
+    return {f'{result["metric"]}_anomaly': result["anomalous"] for result in results}
+
+
+def notify_anomalies(site_config, kind, results, source_file, notify=None):
+    '''
+    Email the anomalies that started on this check, as the threshold alarms do
+    '''
+    notify = notify or send_anomaly_email
+    for result in results:
+        if not result["started"]:
+            continue
+        logging.info(f"{kind} anomaly started for {result['metric']} of {site_config.get('SITE_NAME')}: {result['value']} scored {result['scores']}")
+        increment(f'{kind}.anomalies')
+        notify(
+            site_name=site_config.get('SITE_NAME', ''),
+            cc=site_config.get('MAILING_LIST', []),
+            kind=kind,
+            metric=result["metric"],
+            metric_measure=result["value"],
+            baselines=result["baselines"],
+            scores=result["scores"],
+            source_file=source_file,
+            scoped_time_stamp=result["timestamp"],
+        )
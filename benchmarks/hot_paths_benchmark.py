@@ -0,0 +1,278 @@
+'''
+Benchmarks of the storage, query, render and parse hot paths.
+
+Everything runs on synthetic data in a temporary folder, without
+network access:
+
+    export      export_to_json_file appending one sample to a day file
+                of 1k/10k/100k samples
+    scope       get_data_scoped_by_time_stamp over 1k/10k/100k samples
+    report      generate_graphs_for_daily_report at 1k/10k/100k samples
+    prune       prune_graphs over exports/images holding 10k/50k files,
+                with and without a fresh retention ledger
+    nginx       parse_nginx_log lines per second
+    collectors  get_extended_metrics of this host, one tick after the first
+
+Run from the project root (config/config.json and logs/ must exist):
+
+    python benchmarks/hot_paths_benchmark.py [--runs 3] [--output hot_paths.json] [--compare previous.json] [export scope ...]
+
+Results are written as JSON with the interpreter and git commit, and
+--compare prints the change of every median against an earlier run.
+'''
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+import graph_generator  # noqa: E402
+import hardware_metrics  # noqa: E402
+import nginx  # noqa: E402
+import retention  # noqa: E402
+import utils  # noqa: E402
+from nginx_parse_benchmark import generate_log  # noqa: E402
+
+
+SIZES = [1000, 10000, 100000]
+PRUNE_SIZES = [10000, 50000]
+SITE_NAME = 'benchmark'
+
+
+def generate_hardware_records(count, seed=1, interval=60):
+    '''
+    Samples shaped like sample_hardware_metrics(), one per
+    interval seconds, ending now
+    '''
+    rng = random.Random(seed)
+    start = time.time() - count * interval
+    records = []
+    for index in range(count):
+        used = 200 + rng.random() * 50
+        records.append({
+            "timestamp": start + index * interval,
+            "cpu_usage": round(rng.random() * 100, 1),
+            "ram_usage_free": 8 - rng.random() * 4,
+            "ram_usage_used": 4 + rng.random() * 4,
+            "ram_usage_percentage": round(40 + rng.random() * 50, 1),
+            "load_avg_last_5_mins": rng.random() * 4,
+            "load_avg_last_10_mins": rng.random() * 4,
+            "load_avg_last_15_mins": rng.random() * 4,
+            "disk_usage_free": 500 - used,
+            "disk_usage_used": used,
+        })
+    return records
+
+
+def generate_ping_records(count, seed=1, interval=60, failure_ratio=0.02):
+    rng = random.Random(seed)
+    start = time.time() - count * interval
+    records = []
+    for index in range(count):
+        if rng.random() < failure_ratio:
+            records.append({"timestamp": start + index * interval, "status": "failure", "status_code": 503})
+        else:
+            records.append({"timestamp": start + index * interval, "status": "success"})
+    return records
+
+
+def write_json(path, data):
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=4)
+
+
+def time_runs(func, runs, setup=None):
+    timings = []
+    for _ in range(runs):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return {'min': min(timings), 'median': statistics.median(timings), 'max': max(timings)}
+
+
+def report(name, seconds, **extra):
+    rate = ''.join(f"  {value:12,.0f} {key.replace('_per_second', '')}/s" for key, value in extra.items() if key.endswith('_per_second'))
+    print(f"{name:<36} {seconds['median'] * 1000:10.2f} ms{rate}")
+    return {'seconds': seconds, **extra}
+
+
+def bench_export(tmp_dir, runs):
+    results = {}
+    for size in SIZES:
+        source = os.path.join(tmp_dir, f'export_{size}.json')
+        target = os.path.join(tmp_dir, f'export_{size}_target.json')
+        write_json(source, generate_hardware_records(size))
+        sample = generate_hardware_records(1, seed=2)
+
+        seconds = time_runs(
+            lambda: utils.export_to_json_file(sample, target),
+            runs,
+            setup=lambda: shutil.copyfile(source, target),
+        )
+        results[str(size)] = report(f'export_to_json_file {size:>7,} existing', seconds, file_bytes=os.path.getsize(source))
+    return results
+
+
+def bench_scope(tmp_dir, runs):
+    results = {}
+    for size in SIZES:
+        records = generate_hardware_records(size)
+        random.Random(3).shuffle(records)
+        timestamp = records[len(records) // 2]['timestamp']
+
+        seconds = time_runs(lambda: utils.get_data_scoped_by_time_stamp(timestamp, records), runs)
+        results[str(size)] = report(f'get_data_scoped_by_time_stamp {size:>7,}', seconds, records_per_second=size / seconds['median'])
+    return results
+
+
+def bench_report(tmp_dir, runs):
+    results = {}
+    for size in SIZES:
+        hardware_file = os.path.join(tmp_dir, f'hardware_{size}.json')
+        ping_file = os.path.join(tmp_dir, f'ping_{size}.json')
+        write_json(hardware_file, generate_hardware_records(size))
+        write_json(ping_file, generate_ping_records(size))
+
+        seconds = time_runs(
+            lambda: graph_generator.generate_graphs_for_daily_report(SITE_NAME, hardware_source_file=hardware_file, ping_source_file=ping_file),
+            runs,
+        )
+        results[str(size)] = report(f'generate_graphs_for_daily_report {size:>7,}', seconds, samples_per_second=size / seconds['median'])
+    return results
+
+
+def fill_exports(count, files_per_folder=1000):
+    shutil.rmtree(retention.EXPORTS_ROOT, ignore_errors=True)
+    payload = b'\x89PNG' + b'\0' * 2044
+    now = time.time()
+    for index in range(count):
+        folder = os.path.join(retention.EXPORTS_ROOT, SITE_NAME, 'hardware_metrics', f'folder_{index // files_per_folder}')
+        if index % files_per_folder == 0:
+            os.makedirs(folder)
+        path = os.path.join(folder, f'{index}_metrics.png')
+        with open(path, 'wb') as file:
+            file.write(payload)
+        os.utime(path, (now - count + index, now - count + index))
+
+
+def bench_prune(tmp_dir, runs):
+    results = {}
+    for count in PRUNE_SIZES:
+        fill_exports(count)
+
+        def forget_ledger():
+            retention._ledger["scanned_at"] = None
+
+        # Within budget, so nothing is deleted and every run sees the same tree
+        seconds = time_runs(lambda: utils.prune_graphs(SITE_NAME), runs, setup=forget_ledger)
+        results[f'{count}_scan'] = report(f'prune_graphs {count:>7,} files, scan', seconds, files_per_second=count / seconds['median'])
+
+        seconds = time_runs(lambda: utils.prune_graphs(SITE_NAME), runs)
+        results[f'{count}_ledger'] = report(f'prune_graphs {count:>7,} files, ledger', seconds)
+
+    shutil.rmtree(retention.EXPORTS_ROOT, ignore_errors=True)
+    return results
+
+
+def bench_nginx(tmp_dir, runs, lines=200000):
+    log_file = os.path.join(tmp_dir, 'access.log')
+    generate_log(log_file, lines)
+
+    seconds = time_runs(lambda: nginx.parse_nginx_log(log_file), runs)
+    return {str(lines): report(f'parse_nginx_log {lines:>7,} lines', seconds, lines_per_second=lines / seconds['median'])}
+
+
+def bench_collectors(tmp_dir, runs):
+    # The first call only primes the counters
+    hardware_metrics.get_extended_metrics()
+    seconds = time_runs(hardware_metrics.get_extended_metrics, max(runs, 10))
+    _, detail = hardware_metrics.get_extended_metrics()
+    return {'extended': report('get_extended_metrics', seconds, mounts=len(detail["mounts"]), disks=len(detail["disks"]), nics=len(detail["nics"]))}
+
+
+BENCHMARKS = {
+    'export': bench_export,
+    'scope': bench_scope,
+    'report': bench_report,
+    'prune': bench_prune,
+    'nginx': bench_nginx,
+    'collectors': bench_collectors,
+}
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline_file):
+    with open(baseline_file) as file:
+        baseline = json.load(file)["results"]
+
+    print(f"\nChange against {baseline_file} (median, negative is faster)")
+    for benchmark, cases in results.items():
+        for case, result in cases.items():
+            previous = baseline.get(benchmark, {}).get(case)
+            if previous:
+                change = (result['seconds']['median'] / previous['seconds']['median'] - 1) * 100
+                print(f"  {benchmark} {case:<14} {change:+8.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--compare', help='Results JSON of an earlier run to compare against')
+    parser.add_argument('benchmarks', nargs='*', default=list(BENCHMARKS), help=f"Any of {', '.join(BENCHMARKS)}")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"Unknown benchmarks: {', '.join(unknown)}")
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    results = {}
+
+    # Graphs and exports are written relative to the working directory
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            for name in args.benchmarks:
+                results[name] = BENCHMARKS[name](tmp_dir, args.runs)
+        finally:
+            os.chdir(PROJECT_ROOT)
+
+    if baseline:
+        compare(results, baseline)
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump({
+                'timestamp': datetime.datetime.now().isoformat(),
+                'commit': get_commit(),
+                'python': sys.version,
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'runs': args.runs,
+                'results': results,
+            }, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
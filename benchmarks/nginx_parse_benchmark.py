@@ -0,0 +1,156 @@
+'''
+Parser benchmark for nginx access logs.
+
+Synthetic combined and common format logs are generated (with a small
+share of malformed lines) and parsed by the previous regex implementation
+of parse_nginx_log and by the current bytes fast path. Counts must agree,
+lines per second are reported, along with those of parse_line which
+tailing and --bulk use on the combined log.
+
+Run from the project root (logs/ must exist):
+
+    python benchmarks/nginx_parse_benchmark.py [--lines 2000000] [--runs 3] [--output nginx_parse.json]
+'''
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+import nginx  # noqa: E402
+
+
+# parse_nginx_log before the fast path, kept as the baseline
+baseline_log_pattern = re.compile(r'(\S+) - - \[(.*?)\] "\S+ \S+ \S+" (\d{3}) \S+')
+
+
+def baseline_parse_nginx_log(log_file):
+    total_requests = 0
+    failed_requests = 0
+
+    with open(log_file, 'r') as file:
+        for line in file:
+            match = baseline_log_pattern.match(line)
+            if match:
+                total_requests += 1
+                status_code = int(match.group(3))
+                if status_code >= 400:
+                    failed_requests += 1
+
+    failure_rate = (failed_requests / total_requests) * 100 if total_requests > 0 else 0
+    return total_requests, failed_requests, failure_rate
+
+
+def count_parsed_lines(log_file, log_format):
+    parsed = 0
+    with open(log_file, 'rb') as file:
+        for line in file:
+            if nginx.parse_line(line, log_format) is not None:
+                parsed += 1
+    return parsed
+
+
+METHODS = ['GET', 'GET', 'GET', 'POST', 'PUT', 'DELETE']
+STATUSES = [200] * 90 + [301, 304, 404, 404, 429, 500, 502, 503, 504, 400]
+AGENTS = [
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36',
+    'curl/8.5.0',
+    'python-requests/2.31.0',
+]
+
+
+def generate_log(path, lines, malformed_ratio=0.001, seed=1, log_format='combined'):
+    '''
+    Write a deterministic combined format log with request and
+    upstream times appended, or a common format log
+    '''
+    rng = random.Random(seed)
+    start = 1700000000
+    block = []
+
+    with open(path, 'w') as file:
+        for index in range(lines):
+            if rng.random() < malformed_ratio:
+                block.append('garbage line without the expected fields\n')
+            else:
+                time_local = time.strftime('%d/%b/%Y:%H:%M:%S +0000', time.gmtime(start + index // 500))
+                line = (
+                    f'10.0.{rng.randint(0, 255)}.{rng.randint(0, 255)} - - [{time_local}] '
+                    f'"{rng.choice(METHODS)} /api/v1/items/{rng.randint(0, 5000)}?page={rng.randint(1, 9)} HTTP/1.1" '
+                    f'{rng.choice(STATUSES)} {rng.randint(0, 50000)}'
+                )
+                if log_format == 'combined':
+                    line += f' "-" "{rng.choice(AGENTS)}" {rng.random() / 2:.3f} {rng.random() / 2:.3f}'
+                block.append(line + '\n')
+            if len(block) >= 10000:
+                file.writelines(block)
+                block = []
+        file.writelines(block)
+
+
+def time_runs(func, runs):
+    timings = []
+    result = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+    return result, timings
+
+
+def report(name, lines, timings):
+    median = statistics.median(timings)
+    result = {
+        'seconds': {'min': min(timings), 'median': median, 'max': max(timings)},
+        'lines_per_second': lines / median,
+    }
+    print(f"{name:<40} {median:8.2f} s  {result['lines_per_second']:12,.0f} lines/s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lines', type=int, default=2000000)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    args = parser.parse_args()
+
+    log_format = nginx.DEFAULT_LOG_FORMAT + ' $request_time $upstream_response_time'
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in ['combined', 'common']:
+            log_file = os.path.join(tmp_dir, f'access_{name}.log')
+            print(f"Generating {args.lines:,} {name} format lines")
+            generate_log(log_file, args.lines, log_format=name)
+
+            baseline, timings = time_runs(lambda: baseline_parse_nginx_log(log_file), args.runs)
+            results[f'parse_nginx_log_regex_{name}'] = report(f'parse_nginx_log (regex, {name})', args.lines, timings)
+            current, timings = time_runs(lambda: nginx.parse_nginx_log(log_file), args.runs)
+            results[f'parse_nginx_log_fast_path_{name}'] = report(f'parse_nginx_log (fast path, {name})', args.lines, timings)
+            if baseline != current:
+                sys.exit(f"parse_nginx_log results differ on the {name} log: {baseline} != {current}")
+
+            if name == 'combined':
+                _, timings = time_runs(lambda: count_parsed_lines(log_file, log_format), args.runs)
+                results['parse_line'] = report('parse_line', args.lines, timings)
+
+    for name in ['combined', 'common']:
+        speedup = results[f'parse_nginx_log_fast_path_{name}']['lines_per_second'] / results[f'parse_nginx_log_regex_{name}']['lines_per_second']
+        print(f"parse_nginx_log fast path, {name}: {speedup:.2f}x")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'python': sys.version, 'lines': args.lines, 'runs': args.runs, 'results': results}, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
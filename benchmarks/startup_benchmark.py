@@ -0,0 +1,154 @@
+'''
+Startup benchmark for the monitor entry points.
+
+Each entry point is started in a fresh interpreter and timed until its
+first sample has been written. Peak RSS and whether the rendering/mail
+stacks were pulled in are reported alongside.
+
+Run from the project root (config/config.json and logs/ must exist):
+
+    python benchmarks/startup_benchmark.py [--runs 5] [--output startup.json]
+'''
+import argparse
+import http.server
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['plotly', 'kaleido', 'graph_generator', 'mailer', 'smtplib']
+
+CHILD_PRELUDE = '''
+import json, sys, time
+t0 = time.perf_counter()
+'''
+
+CHILD_EPILOGUE = '''
+t_first = time.perf_counter()
+try:
+    import resource
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+except ImportError:
+    import psutil
+    rss_kb = psutil.Process().memory_info().rss // 1024
+print(json.dumps({
+    "import_s": t_import - t0,
+    "first_sample_s": t_first - t0,
+    "rss_kb": rss_kb,
+    "heavy_modules_loaded": [m for m in %r if m in sys.modules],
+}))
+''' % (HEAVY_MODULES,)
+
+ENTRY_POINTS = {
+    'ping_monitor': '''
+import ping_monitor
+t_import = time.perf_counter()
+ping_monitor.ping_url(sys.argv[1], sys.argv[2])
+''',
+    'hardware_monitor': '''
+import hardware_monitor
+t_import = time.perf_counter()
+hardware_monitor.record_hardware_metrics(sys.argv[2])
+''',
+    'report_generator': '''
+import report_generator
+t_import = time.perf_counter()
+''',
+}
+
+
+class _OkHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _OkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/'
+
+
+def run_entry_point(name, url, output_file):
+    code = CHILD_PRELUDE + ENTRY_POINTS[name] + CHILD_EPILOGUE
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-c', code, url, output_file],
+        cwd=PROJECT_ROOT,
+        capture_output=True,
+        text=True
+    )
+    wall_s = time.perf_counter() - started
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"{name} failed:\n{proc.stderr}")
+
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result['wall_s'] = wall_s
+    return result
+
+
+def summarize(samples):
+    summary = {}
+    for key in ['import_s', 'first_sample_s', 'wall_s', 'rss_kb']:
+        values = [sample[key] for sample in samples]
+        summary[key] = {
+            'min': min(values),
+            'median': statistics.median(values),
+            'max': max(values),
+        }
+    summary['heavy_modules_loaded'] = samples[-1]['heavy_modules_loaded']
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('entry_points', nargs='*', default=list(ENTRY_POINTS))
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(PROJECT_ROOT, 'config', 'config.json')):
+        sys.exit("config/config.json not found, see README for setting it up")
+
+    server, url = start_stub_server()
+    results = {}
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in args.entry_points:
+                samples = []
+                for run in range(args.runs):
+                    output_file = os.path.join(tmp_dir, f'{name}_{run}.json')
+                    samples.append(run_entry_point(name, url, output_file))
+                results[name] = summarize(samples)
+
+                print(
+                    f"{name:<18} "
+                    f"first sample {results[name]['first_sample_s']['median'] * 1000:8.1f} ms  "
+                    f"wall {results[name]['wall_s']['median'] * 1000:8.1f} ms  "
+                    f"rss {results[name]['rss_kb']['median'] / 1024:6.1f} MB  "
+                    f"heavy: {', '.join(results[name]['heavy_modules_loaded']) or '-'}"
+                )
+    finally:
+        server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'python': sys.version, 'runs': args.runs, 'results': results}, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+import datetime
+import json
+import logging
+import os
+import threading
+
+from utils import get_base_dir
+
+
+# Running aggregates kept per metric so reports don't have to
+# re-read the day's results. Values are averaged and peaked.
+SUMMARY_FIELDS = {
+    'hardware': ['cpu_usage', 'ram_usage_percentage', 'load_avg_last_10_mins', 'disk_usage'],
+    'ping': [],
+    'nginx': ['total_requests', 'failed_requests', 'failure_rate'],
+}
+
+# Per-record dicts of counts and fixed-size histograms that are summed
+# into the summary as they are, so daily percentiles stay available
+SUMMARY_COUNTERS = {
+    'nginx': ['status_classes'],
+}
+SUMMARY_HISTOGRAMS = {
+    'nginx': ['request_time_histogram', 'upstream_time_histogram'],
+}
+
+# Open summaries of the collector process, keyed by file path
+_summaries = {}
+_summaries_lock = threading.Lock()
+
+
+def get_summary_file(site_name, metric, date_string=None):
+    date_string = date_string or datetime.date.today().strftime("%Y_%m_%d")
+    return os.path.join(get_base_dir(), 'results', site_name, 'summaries', f'{metric}_summary_{date_string}.json')
+
+
+def new_summary(metric, date_string):
+    return {
+        "date": date_string,
+        "metric": metric,
+        "count": 0,
+        "success_count": 0,
+        # Sums weighted by the seconds each sample covered, so averages
+        # stay right when adaptive sampling changes the interval
+        "weight": 0,
+        "unweighted_count": 0,
+        "weighted_success": 0,
+        "weighted_sums": {field: 0.0 for field in SUMMARY_FIELDS[metric]},
+        "first_timestamp": None,
+        "last_timestamp": None,
+        "sums": {field: 0.0 for field in SUMMARY_FIELDS[metric]},
+        "peaks": {field: {"value": None, "timestamp": None} for field in SUMMARY_FIELDS[metric]},
+        "counters": {field: {} for field in SUMMARY_COUNTERS.get(metric, [])},
+        "histograms": {field: [] for field in SUMMARY_HISTOGRAMS.get(metric, [])},
+    }
+
+
+def load_summary(site_name, metric, date_string=None):
+    path = get_summary_file(site_name, metric, date_string)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as file:
+        try:
+            return json.load(file)
+        except json.JSONDecodeError:
+            logging.warning(f"Summary file could not be parsed: {path}")
+            return None
+
+
+def get_record_values(metric, record):
+    if metric == 'ping':
+        return {}
+
+    if metric == 'nginx':
+        return {field: record.get(field, 0) for field in SUMMARY_FIELDS[metric]}
+
+    values = {field: record.get(field) for field in SUMMARY_FIELDS[metric] if record.get(field) is not None}
+
+    if 'disk_usage' not in values and 'disk_usage_used' in record:
+        used = record.get('disk_usage_used', 0.0)
+        total = (used + record.get('disk_usage_free', 0.0)) or 1
+        values['disk_usage'] = (used / total) * 100
+
+    return values
+
+
+def update_summary(site_name, metric, record):
+    '''
+    Fold a single sample into today's summary and persist it.
+    Each site and metric has its own summary file.
+    '''
+    date_string = datetime.date.today().strftime("%Y_%m_%d")
+    path = get_summary_file(site_name, metric, date_string)
+
+    with _summaries_lock:
+        return _update_summary(site_name, metric, record, date_string, path)
+
+
+def _update_summary(site_name, metric, record, date_string, path):
+    summary = _summaries.get(path)
+    if summary is None:
+        # Drop previous days and pick up where a restarted collector left off
+        for stale_path in [key for key, value in _summaries.items() if value["date"] != date_string]:
+            del _summaries[stale_path]
+        summary = load_summary(site_name, metric, date_string) or new_summary(metric, date_string)
+        _summaries[path] = summary
+
+    fold_record(summary, metric, record)
+    write_summary(path, summary)
+    return summary
+
+
+def fold_record(summary, metric, record):
+    timestamp = record.get('timestamp')
+    interval = record.get('interval') or 0
+    # Summaries written before intervals were stored can't be weighted
+    summary.setdefault("unweighted_count", summary["count"])
+    summary["count"] += 1
+    summary["weight"] = summary.get("weight", 0) + interval
+    if not interval:
+        summary["unweighted_count"] += 1
+    if record.get('status') == 'success':
+        summary["success_count"] += 1
+        summary["weighted_success"] = summary.get("weighted_success", 0) + interval
+    if summary["first_timestamp"] is None:
+        summary["first_timestamp"] = timestamp
+    summary["last_timestamp"] = timestamp
+
+    for field, value in get_record_values(metric, record).items():
+        summary["sums"][field] += value
+        weighted_sums = summary.setdefault("weighted_sums", {})
+        weighted_sums[field] = weighted_sums.get(field, 0.0) + value * interval
+        peak = summary["peaks"][field]
+        # Aggregated high resolution samples also carry the max of their readings
+        peak_value = record.get(f'{field}_max', value)
+        if peak["value"] is None or peak_value > peak["value"]:
+            peak["value"] = peak_value
+            peak["timestamp"] = timestamp
+
+    for field in SUMMARY_COUNTERS.get(metric, []):
+        counter = summary.setdefault("counters", {}).setdefault(field, {})
+        for key, count in record.get(field, {}).items():
+            counter[key] = counter.get(key, 0) + count
+
+    for field in SUMMARY_HISTOGRAMS.get(metric, []):
+        histogram = summary.setdefault("histograms", {}).setdefault(field, [])
+        values = record.get(field, [])
+        if len(histogram) < len(values):
+            histogram.extend([0] * (len(values) - len(histogram)))
+        for index, count in enumerate(values):
+            histogram[index] += count
+
+
+def write_summary(path, summary):
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    # Write then rename so the report never reads a half written summary
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(summary, file, indent=4)
+    os.replace(tmp_path, path)
+
+
+def is_time_weighted(summary):
+    # Only when every sample carried the interval it covered
+    return bool(summary.get("weight")) and summary.get("unweighted_count", summary["count"]) == 0
+
+
+def get_average(summary, field):
+    if not summary or not summary["count"]:
+        return 0.0
+    if is_time_weighted(summary):
+        return summary["weighted_sums"].get(field, 0.0) / summary["weight"]
+    return summary["sums"].get(field, 0.0) / summary["count"]
+
+
+def get_hardware_breakdown(summary):
+    return {
+        'ram_usage_avg': round(get_average(summary, 'ram_usage_percentage'), 5),
+        'load_last_10_mins_avg': round(get_average(summary, 'load_avg_last_10_mins'), 2),
+        'cpu_usage_avg': round(get_average(summary, 'cpu_usage'), 2),
+        'disk_usage_avg': round(get_average(summary, 'disk_usage'), 2),
+        'peaks': summary.get("peaks", {}) if summary else {},
+    }
+
+
+def get_nginx_breakdown(summary):
+    from nginx import histogram_percentile
+
+    if not summary or not summary["count"]:
+        return {}
+
+    total_requests = summary["sums"].get('total_requests', 0)
+    failed_requests = summary["sums"].get('failed_requests', 0)
+    request_times = summary.get("histograms", {}).get('request_time_histogram', [])
+    upstream_times = summary.get("histograms", {}).get('upstream_time_histogram', [])
+
+    return {
+        'total_requests': int(total_requests),
+        'failed_requests': int(failed_requests),
+        'failure_rate': round((failed_requests / total_requests) * 100, 2) if total_requests else 0.0,
+        'status_classes': summary.get("counters", {}).get('status_classes', {}),
+        'request_time_p50': histogram_percentile(request_times, 0.5),
+        'request_time_p95': histogram_percentile(request_times, 0.95),
+        'request_time_p99': histogram_percentile(request_times, 0.99),
+        'upstream_time_p99': histogram_percentile(upstream_times, 0.99),
+        'peaks': summary.get("peaks", {}),
+    }
+
+
+def get_ping_breakdown(summary):
+    if not summary or not summary["count"]:
+        return {'status_avg_success': 0.0}
+    if is_time_weighted(summary):
+        return {'status_avg_success': round((summary["weighted_success"] / summary["weight"]), 3) * 100}
+    return {
+        'status_avg_success': round((summary["success_count"] / summary["count"]), 3) * 100
+    }
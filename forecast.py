@@ -0,0 +1,213 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+from instrumentation import increment
+from utils import get_base_dir, send_forecast_email
+
+
+# Percentage series projected to 100 %
+FORECAST_METRICS = {
+    'disk_usage': 'Disk Usage',
+    'ram_usage': 'RAM Usage',
+}
+
+# Running regression sums per site, {site: {metric: series state}}, loaded
+# from and saved to results/<site>/forecast_state.json
+_forecast = {"sites": {}, "saved_at": {}, "registered": False}
+_forecast_lock = threading.Lock()
+
+
+def get_state_file(site_name):
+    return os.path.join(get_base_dir(), 'results', site_name, 'forecast_state.json')
+
+
+def new_series_state(timestamp):
+    '''
+    Decayed sums of a weighted least squares fit of value against
+    days since origin, so memory stays constant however long it runs
+    '''
+    return {
+        "origin": timestamp,
+        "first_at": timestamp,
+        "updated_at": None,
+        "last_value": None,
+        "sums": {"w": 0.0, "x": 0.0, "y": 0.0, "xx": 0.0, "xy": 0.0},
+        "alerting": False,
+    }
+
+
+def load_site_state(site_name):
+    path = get_state_file(site_name)
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as file:
+        try:
+            return json.load(file)
+        except json.JSONDecodeError:
+            logging.warning(f"Forecast state could not be parsed, starting afresh: {path}")
+            return {}
+
+
+def save_site_state(site_name):
+    path = get_state_file(site_name)
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(_forecast["sites"][site_name], file)
+    os.replace(tmp_path, path)
+    _forecast["saved_at"][site_name] = time.time()
+
+
+def save_all_state():
+    with _forecast_lock:
+        for site_name in list(_forecast["sites"]):
+            try:
+                save_site_state(site_name)
+            except OSError as e:
+                logging.error(f"Forecast state of {site_name} could not be saved: {e}")
+
+
+def get_site_state(site_name):
+    site = _forecast["sites"].get(site_name)
+    if site is None:
+        site = _forecast["sites"][site_name] = load_site_state(site_name)
+        if not _forecast["registered"]:
+            atexit.register(save_all_state)
+            _forecast["registered"] = True
+    return site
+
+
+def update_series(series, value, timestamp, weight, half_life):
+    '''
+    Fold one sample into the sums. Older samples fade with a half life
+    of half_life seconds, so the trend follows recent growth.
+    '''
+    sums = series["sums"]
+    if series["updated_at"] is not None and timestamp > series["updated_at"]:
+        decay = 0.5 ** ((timestamp - series["updated_at"]) / half_life)
+        for key in sums:
+            sums[key] *= decay
+
+    x = (timestamp - series["origin"]) / 86400
+    sums["w"] += weight
+    sums["x"] += weight * x
+    sums["y"] += weight * value
+    sums["xx"] += weight * x * x
+    sums["xy"] += weight * x * value
+    series["updated_at"] = timestamp
+    series["last_value"] = value
+
+
+def get_slope(series):
+    # Growth per day of the fit, None while it is undetermined
+    sums = series["sums"]
+    denominator = sums["w"] * sums["xx"] - sums["x"] ** 2
+    if sums["w"] <= 0 or denominator <= 1e-12 * max(sums["w"] * sums["xx"], 1):
+        return None
+    return (sums["w"] * sums["xy"] - sums["x"] * sums["y"]) / denominator
+
+
+def project(series, min_hours):
+    '''
+    Growth per day and hours until the series reaches 100 % from its
+    last value, hours None when it isn't growing. None before min_hours
+    of samples.
+    '''
+    if series["updated_at"] is None or series["updated_at"] - series["first_at"] < min_hours * 3600:
+        return None
+
+    slope = get_slope(series)
+    if slope is None:
+        return None
+
+    hours_to_full = (100 - series["last_value"]) / slope * 24 if slope > 0 else None
+    return {
+        "value": round(series["last_value"], 2),
+        "growth_per_day": round(slope, 4),
+        "hours_to_full": round(max(hours_to_full, 0), 1) if hours_to_full is not None else None,
+        "updated_at": series["updated_at"],
+    }
+
+
+def update_forecasts(site_config, values, timestamp, weight=1):
+    '''
+    Fold a check's values into the site's trends and project each.
+    Returns one result per value, "started" when its time to full first
+    drops below FORECAST_HORIZON_HOURS.
+    '''
+    if not site_config.get('FORECASTING', False):
+        return []
+
+    site_name = site_config.get('SITE_NAME', '')
+    half_life = site_config.get('FORECAST_HALF_LIFE_HOURS', 72) * 3600
+    min_hours = site_config.get('FORECAST_MIN_HOURS', 24)
+    horizon = site_config.get('FORECAST_HORIZON_HOURS', 72)
+    results = []
+
+    with _forecast_lock:
+        site = get_site_state(site_name)
+        for metric in FORECAST_METRICS:
+            value = values.get(metric)
+            if value is None:
+                continue
+
+            series = site.get(metric)
+            if series is None:
+                series = site[metric] = new_series_state(timestamp)
+            update_series(series, value, timestamp, weight, half_life)
+
+            projection = project(series, min_hours)
+            hours_to_full = projection["hours_to_full"] if projection else None
+            # Cleared only well past the horizon, so noise around it doesn't alert again
+            limit = horizon * 1.25 if series["alerting"] else horizon
+            alerting = hours_to_full is not None and hours_to_full < limit
+            started = alerting and not series["alerting"]
+            series["alerting"] = alerting
+            results.append({"metric": metric, "projection": projection, "alerting": alerting, "started": started, "horizon_hours": horizon})
+
+        if time.time() - _forecast["saved_at"].get(site_name, 0) >= site_config.get('FORECAST_PERSIST_INTERVAL', 300):
+            save_site_state(site_name)
+
+    return results
+
+
+def get_forecast_alerts(results):
+    # As the {metric: state} alerts of metrics_server.publish
+    return {f'{result["metric"]}_full_forecast': result["alerting"] for result in results}
+
+
+def notify_forecasts(site_config, results, source_file, notify=None):
+    notify = notify or send_forecast_email
+    for result in results:
+        if not result["started"]:
+            continue
+        projection = result["projection"]
+        logging.info(f"{result['metric']} of {site_config.get('SITE_NAME')} projected full in {projection['hours_to_full']} hours")
+        increment('hardware.forecast_alerts')
+        notify(
+            site_name=site_config.get('SITE_NAME', ''),
+            cc=site_config.get('MAILING_LIST', []),
+            metric=result["metric"],
+            metric_measure=projection["value"],
+            growth_per_day=projection["growth_per_day"],
+            hours_to_full=projection["hours_to_full"],
+            horizon_hours=result["horizon_hours"],
+            source_file=source_file,
+        )
+
+
+def load_forecasts(site_name, min_hours=24):
+    '''
+    Projections from the site's saved trends, for reports
+    run outside the collector
+    '''
+    site = load_site_state(site_name)
+    return {metric: project(site[metric], min_hours) for metric in FORECAST_METRICS if metric in site}
@@ -1,11 +1,13 @@
 import os
 import json
+import logging
 import datetime
 import statistics
 
 import plotly.graph_objects as go
-import psutil
-import time
+
+from instrumentation import increment, timed
+from retention import record_export
 
 
 # Check if file exists
@@ -13,10 +15,33 @@ def check_file_exists(file_path):
     return os.path.exists(file_path)
 
 
+def save_figure(fig, path):
+    # Kaleido rendering, usually the slowest stage of an alert
+    with timed('graph.render'):
+        fig.write_image(path)
+    increment('graph.images')
+    record_export(path)
+    return path
+
+
+def warm_renderer():
+    '''
+    Start kaleido's renderer process up front so the first
+    report graph doesn't pay its startup cost
+    '''
+    try:
+        go.Figure().to_image(format='png', width=10, height=10)
+    except Exception as e:
+        # A failing pool initializer breaks the whole pool, the
+        # graphs start the renderer cold instead
+        logging.warning(f"Could not warm the graph renderer: {e}")
+
+
 def get_datetime_string_from_timestamp(timestamp):
     return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
 
 
+@timed('graph.hardware_graphic')
 def generate_hardware_graphic(metric, sitename, metric_value):
     exports_folder = get_export_folder(site_name=sitename, metric=metric)
     
@@ -44,14 +69,26 @@ def generate_hardware_graphic(metric, sitename, metric_value):
         width=900
     )
 
-    fig.write_image(file_loc)
+    save_figure(fig, file_loc)
     return file_loc
 
 
+def get_time_weighted_mean(data, values):
+    '''
+    Mean of values, each weighted by the interval its sample covered.
+    Samples stored without an interval count equally.
+    '''
+    weights = [entry.get('interval') for entry in data]
+    if not all(weights):
+        return statistics.mean(values)
+    return sum(value * weight for value, weight in zip(values, weights)) / sum(weights)
+
+
 def get_export_folder(site_name, metric):
     return os.path.join('exports', 'images', site_name, metric)
 
 
+@timed('graph.graphic')
 def generate_graphic(site_name, metric):
     datetime_str = datetime.date.today().strftime("%Y_%m_%d")
 
@@ -111,7 +148,7 @@ def generate_graphic(site_name, metric):
             showlegend=True
         )
 
-        fig.write_image(os.path.join(exports_folder, f'{file_prefix}_ping_metrics.png'))
+        save_figure(fig, os.path.join(exports_folder, f'{file_prefix}_ping_metrics.png'))
 
     elif metric == 'hardware':
         # # Current Metrics
@@ -195,16 +232,16 @@ def generate_graphic(site_name, metric):
                 os.makedirs(path)
 
         # Save the figures
-        fig_ram.write_image(os.path.join(exports_folder, 'ram_usage', f'{file_prefix}_ram_metrics.png'))
-        fig_disk.write_image(os.path.join(exports_folder, 'disk_usage', f'{file_prefix}_disk_metrics.png'))
-        fig_metrics.write_image(os.path.join(exports_folder, 'system_metrics', f'{file_prefix}_system_metrics.png'))
-        fig_cpu.write_image(os.path.join(exports_folder, 'cpu_usage', f'{file_prefix}_cpu_metrics.png'))
+        save_figure(fig_ram, os.path.join(exports_folder, 'ram_usage', f'{file_prefix}_ram_metrics.png'))
+        save_figure(fig_disk, os.path.join(exports_folder, 'disk_usage', f'{file_prefix}_disk_metrics.png'))
+        save_figure(fig_metrics, os.path.join(exports_folder, 'system_metrics', f'{file_prefix}_system_metrics.png'))
+        save_figure(fig_cpu, os.path.join(exports_folder, 'cpu_usage', f'{file_prefix}_cpu_metrics.png'))
 
     else:
         raise ValueError("Invalid metric specified")
 
 
-def generate_hardware_metrics_trends_graph(site, data, time_scoped_filtered=False, last_n_filtered=False, scope_by_metric=None):
+def generate_hardware_metrics_trends_graph(site, data, time_scoped_filtered=False, last_n_filtered=False, scope_by_metric=None, with_breakdown=True):
     if not data:
         return
 
@@ -234,16 +271,17 @@ def generate_hardware_metrics_trends_graph(site, data, time_scoped_filtered=Fals
         load_avg_last_10_mins = [item['load_avg_last_10_mins'] for item in data]
         cpu_usage = [item['cpu_usage'] for item in data]
 
-        # Averages
-        ram_usage_avg = statistics.mean([item['ram_usage_percentage'] for item in data])
-        load_last_10_mins_avg = statistics.mean([item['load_avg_last_10_mins'] for item in data])
-        cpu_usage_avg = statistics.mean([item['cpu_usage'] for item in data])
+        # Averages, unless the caller has them from the day's summary
+        if with_breakdown:
+            ram_usage_avg = get_time_weighted_mean(data, ram_usage_percentages)
+            load_last_10_mins_avg = get_time_weighted_mean(data, load_avg_last_10_mins)
+            cpu_usage_avg = get_time_weighted_mean(data, cpu_usage)
 
-        hardware_breakdown = {
-            'ram_usage_avg': round(ram_usage_avg, 5),
-            'load_last_10_mins_avg': round(load_last_10_mins_avg, 2),
-            'cpu_usage_avg': round(cpu_usage_avg, 2)
-        }
+            hardware_breakdown = {
+                'ram_usage_avg': round(ram_usage_avg, 5),
+                'load_last_10_mins_avg': round(load_last_10_mins_avg, 2),
+                'cpu_usage_avg': round(cpu_usage_avg, 2)
+            }
 
         ram_trace = go.Scatter(x=timestamps, y=ram_usage_percentages, mode='lines', name='RAM Usage Percentage', yaxis="y1")
         cpu_trace = go.Scatter(x=timestamps, y=cpu_usage, mode='lines', name='CPU Usage', yaxis="y1")
@@ -251,6 +289,9 @@ def generate_hardware_metrics_trends_graph(site, data, time_scoped_filtered=Fals
 
         trace_list = [cpu_trace, ram_trace, load_last_10_mins_trace]
     else:
+        if scope_by_metric == "cpu_usage":
+            metric_data = [item.get('cpu_usage', 0.0) for item in data]
+
         if scope_by_metric == "ram_usage":
             metric_data = [item.get('ram_usage_percentage', 0.0) for item in data]
         
@@ -306,11 +347,11 @@ def generate_hardware_metrics_trends_graph(site, data, time_scoped_filtered=Fals
         filter_string = ''
     
     export_path = os.path.join(exports_folder, f'{file_prefix}_{filter_string}_hardware_metrics_trends.png')
-    fig.write_image(export_path)
+    save_figure(fig, export_path)
     return export_path, hardware_breakdown
 
 
-def generate_ping_metrics_trends_graph(site, data):
+def generate_ping_metrics_trends_graph(site, data, with_breakdown=True):
     if not data:
         return
 
@@ -330,12 +371,12 @@ def generate_ping_metrics_trends_graph(site, data):
     
     
     statuses = [1 if entry['status'] == "success" else 0 for entry in data]
-    successful_pings = [item for item in statuses if item == 1] 
-    status_avg_success = round((len(successful_pings) / len(statuses)), 3) * 100
+    if with_breakdown:
+        status_avg_success = round(get_time_weighted_mean(data, statuses), 3) * 100
 
-    ping_breakdown = {
-        'status_avg_success': status_avg_success
-    }
+        ping_breakdown = {
+            'status_avg_success': status_avg_success
+        }
 
     fig = go.Figure()
     fig.add_trace(go.Scatter(x=timestamps, y=statuses, mode='lines+markers', name='Ping Status'))
@@ -349,44 +390,232 @@ def generate_ping_metrics_trends_graph(site, data):
     )
 
     file_prefix = str(datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S"))
-    fig.write_image(os.path.join(exports_folder, f'{file_prefix}_ping_metrics_trends.png'))
+    save_figure(fig, os.path.join(exports_folder, f'{file_prefix}_ping_metrics_trends.png'))
     return os.path.join(exports_folder, f'{file_prefix}_ping_metrics_trends.png'), ping_breakdown
 
 
+def fold_nginx_buckets(data):
+    '''
+    Late lines can add a second record for a bucket, fold
+    them together: counts are summed, percentiles take the max
+    '''
+    buckets = {}
+    for entry in data:
+        bucket = buckets.setdefault(entry['timestamp'], {
+            'total_requests': 0,
+            'failed_requests': 0,
+            'status_classes': {},
+            'request_time_p95': None,
+            'request_time_p99': None
+        })
+        bucket['total_requests'] += entry.get('total_requests', 0)
+        bucket['failed_requests'] += entry.get('failed_requests', 0)
+        for status_class, count in entry.get('status_classes', {}).items():
+            bucket['status_classes'][status_class] = bucket['status_classes'].get(status_class, 0) + count
+        for percentile in ['request_time_p95', 'request_time_p99']:
+            if entry.get(percentile) is not None:
+                bucket[percentile] = max(bucket[percentile] or 0, entry[percentile])
+    return buckets
+
+
+def generate_nginx_metrics_trends_graph(site, data):
+    if not data:
+        return
+
+    sub_folder = 'nginx_metrics'
+    exports_folder = os.path.join('exports', 'images', 'reports', site, sub_folder)
+
+    if not os.path.exists(exports_folder):
+        os.makedirs(exports_folder)
+
+    buckets = fold_nginx_buckets(data)
+
+    bucket_timestamps = sorted(buckets)
+    timestamps = [get_datetime_string_from_timestamp(timestamp) for timestamp in bucket_timestamps]
+    status_classes = sorted({status_class for bucket in buckets.values() for status_class in bucket['status_classes']})
+
+    fig = go.Figure()
+    for status_class in status_classes:
+        fig.add_trace(go.Bar(
+            x=timestamps,
+            y=[buckets[timestamp]['status_classes'].get(status_class, 0) for timestamp in bucket_timestamps],
+            name=f'{status_class} Requests',
+            yaxis="y1"
+        ))
+
+    for percentile, label in [('request_time_p95', 'Request Time p95'), ('request_time_p99', 'Request Time p99')]:
+        fig.add_trace(go.Scatter(
+            x=timestamps,
+            y=[buckets[timestamp][percentile] for timestamp in bucket_timestamps],
+            mode='lines',
+            name=label,
+            yaxis="y2"
+        ))
+
+    fig.update_layout(
+        title='nginx Requests Over Time',
+        xaxis_title='Timestamp',
+        barmode='stack',
+        yaxis=dict(title="Requests"),
+        yaxis2=dict(
+            title="Latency (ms)",
+            overlaying='y',
+            side='right'
+        ),
+        width=1000
+    )
+
+    file_prefix = str(datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S"))
+    export_path = os.path.join(exports_folder, f'{file_prefix}_nginx_metrics_trends.png')
+    save_figure(fig, export_path)
+    return export_path
+
+
+def generate_nginx_routes_graph(site, top_routes):
+    if not top_routes:
+        return
+
+    sub_folder = 'nginx_metrics'
+    exports_folder = os.path.join('exports', 'images', 'reports', site, sub_folder)
+
+    if not os.path.exists(exports_folder):
+        os.makedirs(exports_folder)
+
+    # Largest at the top of a horizontal bar chart
+    top_routes = list(reversed(top_routes))
+    fig = go.Figure(go.Bar(
+        x=[route['count'] for route in top_routes],
+        y=[route['route'] for route in top_routes],
+        orientation='h',
+        name='Requests'
+    ))
+
+    fig.update_layout(
+        title='Top nginx Routes',
+        xaxis_title='Requests',
+        width=1000
+    )
+
+    file_prefix = str(datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S"))
+    export_path = os.path.join(exports_folder, f'{file_prefix}_nginx_routes.png')
+    save_figure(fig, export_path)
+    return export_path
+
+
+def generate_nginx_error_trends_graph(site, data, thresholds=None, sub_folder='nginx_metrics'):
+    '''
+    Failure rate and p99 request time per bucket, with
+    the alert thresholds drawn as dashed lines
+    '''
+    if not data:
+        return
+
+    thresholds = thresholds or {}
+    exports_folder = os.path.join('exports', 'images', 'reports', site, sub_folder)
+
+    if not os.path.exists(exports_folder):
+        os.makedirs(exports_folder)
+
+    buckets = fold_nginx_buckets(data)
+
+    bucket_timestamps = sorted(buckets)
+    timestamps = [get_datetime_string_from_timestamp(timestamp) for timestamp in bucket_timestamps]
+    failure_rates = [
+        round(buckets[timestamp]['failed_requests'] / buckets[timestamp]['total_requests'] * 100, 2) if buckets[timestamp]['total_requests'] else 0.0
+        for timestamp in bucket_timestamps
+    ]
+
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=timestamps, y=failure_rates, mode='lines', name='Failure Rate (%)', yaxis="y1"))
+    fig.add_trace(go.Scatter(
+        x=timestamps,
+        y=[buckets[timestamp]['request_time_p99'] for timestamp in bucket_timestamps],
+        mode='lines',
+        name='Request Time p99 (ms)',
+        yaxis="y2"
+    ))
+
+    if thresholds.get('failure_rate') is not None:
+        fig.add_hline(y=thresholds['failure_rate'], line_dash='dash', line_color='red', annotation_text='Failure Rate Threshold')
+    if thresholds.get('request_time_p99') is not None:
+        fig.add_hline(y=thresholds['request_time_p99'], line_dash='dash', line_color='orange', annotation_text='p99 Threshold', yref='y2')
+
+    fig.update_layout(
+        title='nginx Failure Rate and p99 Latency Over Time',
+        xaxis_title='Timestamp',
+        yaxis=dict(title="Failure Rate (%)"),
+        yaxis2=dict(
+            title="Request Time p99 (ms)",
+            overlaying='y',
+            side='right'
+        ),
+        legend=dict(x=1.1),
+        width=1000
+    )
+
+    file_prefix = str(datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S"))
+    export_path = os.path.join(exports_folder, f'{file_prefix}_nginx_error_trends.png')
+    save_figure(fig, export_path)
+    return export_path
+
+
+@timed('graph.nginx_graphs_for_daily_report')
+def generate_nginx_graphs_for_daily_report(site_name, nginx_source_file, top_routes=None, last_n_items=None, thresholds=None):
+    with open(nginx_source_file) as nginx_file:
+        nginx_data = json.load(nginx_file)
+        if last_n_items:
+            nginx_data = nginx_data[-last_n_items:]
+
+    trends_graph_file = generate_nginx_metrics_trends_graph(site_name, nginx_data)
+    error_trends_graph_file = generate_nginx_error_trends_graph(site_name, nginx_data, thresholds)
+    routes_graph_file = generate_nginx_routes_graph(site_name, top_routes)
+    return [graph_file for graph_file in [trends_graph_file, error_trends_graph_file, routes_graph_file] if graph_file]
+
+
+@timed('graph.graphs_for_daily_report')
 def generate_graphs_for_daily_report(site_name,
                                      hardware_source_file=None,
                                      ping_source_file=None,
                                      last_n_items=None,
                                      scoped_time_stamp=None,
-                                     scope_by_metric=None
+                                     scope_by_metric=None,
+                                     since_timestamp=None,
+                                     scoped_items=10,
+                                     with_breakdown=True
                                      ):
     from utils import get_data_scoped_by_time_stamp
 
     # hardware_data
     # last n items fetches the latest n items from data list
     # as a reflection of time the total period covered will be last_n_items x ping/hardware_check_interval
+    # since timestamp keeps the items from then on, whatever the interval
+    # with_breakdown=False skips the averages, for callers that read them from the summaries
     hardware_graph_file = None
     ping_graph_file = None
     breakdown = {}
 
     if hardware_source_file:
-        last_n_filtered = last_n_items is not None
+        last_n_filtered = last_n_items is not None or since_timestamp is not None
         time_scoped_filtered = scoped_time_stamp is not None
         with open(hardware_source_file) as hardware_file:
             hardware_data = json.load(hardware_file)
             # get last n items if set
             if last_n_items:
                 hardware_data = hardware_data[-last_n_items:]
+            if since_timestamp:
+                hardware_data = [item for item in hardware_data if item['timestamp'] and item['timestamp'] >= since_timestamp]
             if scoped_time_stamp:
                 hardware_data = get_data_scoped_by_time_stamp(
                     timestamp=scoped_time_stamp,
-                    data=hardware_data
+                    data=hardware_data,
+                    n=scoped_items
                 )
         hardware_graph_file, breakdown["hardware"] = generate_hardware_metrics_trends_graph(site_name, 
                                                                                             hardware_data,
                                                                                             last_n_filtered=last_n_filtered,
                                                                                             time_scoped_filtered=time_scoped_filtered,
-                                                                                            scope_by_metric=scope_by_metric
+                                                                                            scope_by_metric=scope_by_metric,
+                                                                                            with_breakdown=with_breakdown
                                                                                             )
 
     # ping data
@@ -395,6 +624,8 @@ def generate_graphs_for_daily_report(site_name,
             ping_data = json.load(ping_file)
             if last_n_items:
                 ping_data = ping_data[-last_n_items:]
-        ping_graph_file, breakdown["ping"] = generate_ping_metrics_trends_graph(site_name, ping_data)
+            if since_timestamp:
+                ping_data = [item for item in ping_data if item['timestamp'] and item['timestamp'] >= since_timestamp]
+        ping_graph_file, breakdown["ping"] = generate_ping_metrics_trends_graph(site_name, ping_data, with_breakdown=with_breakdown)
 
     return hardware_graph_file, ping_graph_file, breakdown
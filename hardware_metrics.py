@@ -1,25 +1,233 @@
+import contextlib
 import os
+import time
+
 import psutil
 
 
+# Pseudo and read-only image filesystems that are never full in a useful sense
+IGNORED_FSTYPES = {'squashfs', 'tmpfs', 'devtmpfs', 'iso9660', 'proc', 'sysfs', 'cgroup', 'cgroup2', 'nsfs', 'autofs'}
+IGNORED_DISK_PREFIXES = ('loop', 'ram', 'zram')
+IGNORED_NICS = {'lo'}
+
+# Mounts and block devices change rarely, so they are listed every
+# DEVICE_REFRESH_SECONDS rather than on every tick
+DEVICE_REFRESH_SECONDS = 300
+
+# Counters of the previous extended reading, deltas are taken against them
+_devices = {"mounts": [], "whole_disks": None, "listed_at": None}
+_previous = {"timestamp": None, "disk_io": None, "net_io": None}
+# Per device readings since the last rollup, see add_device_reading
+_device_rollup = {"started_at": None, "readings": 0, "mounts": {}, "cpu_per_core": [], "disks": {}, "nics": {}}
+# Counters that are summed over a rollup rather than averaged
+DEVICE_TOTAL_FIELDS = {'errors', 'drops'}
+# Filesystem usage read within a oneshot() block, by mount
+_oneshot = {"active": False, "disk_usage": {}}
+
+
+@contextlib.contextmanager
+def oneshot():
+    '''
+    Like psutil.Process.oneshot(): within the block each mount
+    is only statted once, whichever collector asks for it
+    '''
+    _oneshot["active"] = True
+    try:
+        yield
+    finally:
+        _oneshot["active"] = False
+        _oneshot["disk_usage"].clear()
+
+
+def read_disk_usage(mount):
+    if not _oneshot["active"]:
+        return psutil.disk_usage(mount)
+    if mount not in _oneshot["disk_usage"]:
+        _oneshot["disk_usage"][mount] = psutil.disk_usage(mount)
+    return _oneshot["disk_usage"][mount]
+
+
 def get_ram_usage():
     return psutil.virtual_memory()
 
 
-def get_cpu_usage():
+def get_cpu_usage(interval=1):
+    # interval=None doesn't block, it returns the usage since the previous call
     return {
-        "cpu_usage": psutil.cpu_percent(interval=1)
+        "cpu_usage": psutil.cpu_percent(interval=interval)
     }
 
 
 def get_disk_usage():
-    hdd = psutil.disk_usage('/')
+    hdd = read_disk_usage('/')
     return {
         "used": round(hdd.used / (2**30), 2),
         "free": round(hdd.free / (2**30), 2)
     }
 
 
+def list_devices():
+    now = time.monotonic()
+    if _devices["listed_at"] is not None and now - _devices["listed_at"] < DEVICE_REFRESH_SECONDS:
+        return _devices
+
+    _devices["mounts"] = sorted({
+        partition.mountpoint for partition in psutil.disk_partitions(all=False)
+        if partition.fstype not in IGNORED_FSTYPES
+    })
+    # On Linux, partitions are counted in their disk as well, only whole disks add up
+    _devices["whole_disks"] = set(os.listdir('/sys/block')) if os.path.isdir('/sys/block') else None
+    _devices["listed_at"] = now
+    return _devices
+
+
+def get_mount_usage(mounts):
+    usage = {}
+    for mount in mounts:
+        try:
+            hdd = read_disk_usage(mount)
+        except OSError:
+            # Unmounted or unreadable since it was listed
+            continue
+        usage[mount] = {
+            "used": round(hdd.used / (2**30), 2),
+            "free": round(hdd.free / (2**30), 2),
+            "percent": hdd.percent,
+        }
+    return usage
+
+
+def get_rates(current, previous, fields, elapsed):
+    # A counter that went back was reset, e.g. by a driver reload
+    return {field: round(max(getattr(current, field) - getattr(previous, field), 0) / elapsed, 1) for field in fields}
+
+
+def get_extended_metrics():
+    '''
+    Every mount's usage, disk and network throughput per device, and
+    per core CPU, read in one pass. Rates are deltas of the counters since
+    the previous call, so the first call has none.
+    Returns the host wide totals and the per device detail apart.
+    '''
+    devices = list_devices()
+    timestamp = time.monotonic()
+    disk_io = psutil.disk_io_counters(perdisk=True) or {}
+    net_io = psutil.net_io_counters(pernic=True) or {}
+    # Since the previous call, without blocking
+    per_core = psutil.cpu_percent(percpu=True, interval=None)
+
+    detail = {
+        "mounts": get_mount_usage(devices["mounts"]),
+        "cpu_per_core": per_core,
+        "disks": {},
+        "nics": {},
+    }
+
+    elapsed = timestamp - _previous["timestamp"] if _previous["timestamp"] is not None else 0
+    if elapsed > 0:
+        for name, counters in disk_io.items():
+            previous = _previous["disk_io"].get(name)
+            if previous is None or name.startswith(IGNORED_DISK_PREFIXES):
+                continue
+            rates = get_rates(counters, previous, ['read_bytes', 'write_bytes', 'read_count', 'write_count'], elapsed)
+            detail["disks"][name] = {
+                "read_bytes_per_s": rates['read_bytes'],
+                "write_bytes_per_s": rates['write_bytes'],
+                "read_iops": rates['read_count'],
+                "write_iops": rates['write_count'],
+            }
+
+        for name, counters in net_io.items():
+            previous = _previous["net_io"].get(name)
+            if previous is None or name in IGNORED_NICS:
+                continue
+            rates = get_rates(counters, previous, ['bytes_recv', 'bytes_sent'], elapsed)
+            detail["nics"][name] = {
+                "recv_bytes_per_s": rates['bytes_recv'],
+                "sent_bytes_per_s": rates['bytes_sent'],
+                "errors": max(counters.errin - previous.errin, 0) + max(counters.errout - previous.errout, 0),
+                "drops": max(counters.dropin - previous.dropin, 0) + max(counters.dropout - previous.dropout, 0),
+            }
+
+    _previous.update({"timestamp": timestamp, "disk_io": disk_io, "net_io": net_io})
+
+    metrics = {}
+    whole_disks = devices["whole_disks"]
+    counted = [disk for name, disk in detail["disks"].items() if whole_disks is None or name in whole_disks]
+    metrics["disk_read_bytes_per_s"] = round(sum(disk["read_bytes_per_s"] for disk in counted), 1)
+    metrics["disk_write_bytes_per_s"] = round(sum(disk["write_bytes_per_s"] for disk in counted), 1)
+    metrics["disk_iops"] = round(sum(disk["read_iops"] + disk["write_iops"] for disk in counted), 1)
+    metrics["net_recv_bytes_per_s"] = round(sum(nic["recv_bytes_per_s"] for nic in detail["nics"].values()), 1)
+    metrics["net_sent_bytes_per_s"] = round(sum(nic["sent_bytes_per_s"] for nic in detail["nics"].values()), 1)
+    metrics["net_errors"] = sum(nic["errors"] for nic in detail["nics"].values())
+    metrics["net_drops"] = sum(nic["drops"] for nic in detail["nics"].values())
+    return metrics, detail
+
+
+def add_device_reading(detail):
+    '''
+    Fold one get_extended_metrics detail into the running rollup:
+    mean and max of every rate, totals of errors and drops, and the
+    latest usage of each mount, which moves too slowly to average
+    '''
+    rollup = _device_rollup
+    if rollup["started_at"] is None:
+        rollup["started_at"] = time.time()
+    rollup["readings"] += 1
+    rollup["mounts"] = detail["mounts"]
+
+    for index, usage in enumerate(detail["cpu_per_core"]):
+        if index == len(rollup["cpu_per_core"]):
+            rollup["cpu_per_core"].append({"sum": 0.0, "max": usage, "count": 0})
+        add_to_stats(rollup["cpu_per_core"][index], usage)
+
+    for group in ['disks', 'nics']:
+        for name, fields in detail[group].items():
+            device = rollup[group].setdefault(name, {})
+            for field, value in fields.items():
+                add_to_stats(device.setdefault(field, {"sum": 0.0, "max": value, "count": 0}), value)
+
+
+def add_to_stats(stats, value):
+    stats["sum"] += value
+    stats["max"] = max(stats["max"], value)
+    stats["count"] += 1
+
+
+def finish_stats(field, stats):
+    if field in DEVICE_TOTAL_FIELDS:
+        return {"total": stats["sum"]}
+    return {"mean": round(stats["sum"] / stats["count"], 1), "max": stats["max"]}
+
+
+def flush_device_rollup(interval):
+    '''
+    The rollup of the per device readings once `interval` seconds
+    have passed since its first one, None before that. Starts a new one.
+    '''
+    rollup = _device_rollup
+    now = time.time()
+    if rollup["started_at"] is None or now - rollup["started_at"] < interval:
+        return None
+
+    record = {
+        "timestamp": now,
+        "started_at": rollup["started_at"],
+        "readings": rollup["readings"],
+        "mounts": rollup["mounts"],
+        "cpu_per_core": [finish_stats('cpu', stats) for stats in rollup["cpu_per_core"]],
+        **{
+            group: {
+                name: {field: finish_stats(field, stats) for field, stats in device.items()}
+                for name, device in rollup[group].items()
+            }
+            for group in ['disks', 'nics']
+        },
+    }
+    rollup.update({"started_at": None, "readings": 0, "mounts": {}, "cpu_per_core": [], "disks": {}, "nics": {}})
+    return record
+
+
 def get_load_average():
     '''Represents the processes which are in a runnable state,
         either using the CPU or waiting to use the CPU'''
@@ -33,3 +241,9 @@ def get_load_average():
 
 if __name__ == "__main__":
     print(get_load_average())
+    get_extended_metrics()
+    time.sleep(1)
+    totals, detail = get_extended_metrics()
+    print(totals)
+    add_device_reading(detail)
+    print(flush_device_rollup(0))
@@ -2,60 +2,313 @@ import json
 import logging
 import os
 import time
+import threading
 import datetime
 
-from hardware_metrics import get_cpu_usage, get_disk_usage, get_load_average, get_ram_usage
-from utils import check_load_if_avg_exceeded, current_time_within_business_hours, export_to_json_file, get_config, send_warning_email_for_metric, update_alert_file
+from agent import enqueue, start_agent
+from anomaly import detect_anomalies, get_anomaly_alerts, notify_anomalies
+from daily_summary import update_summary
+from forecast import get_forecast_alerts, notify_forecasts, update_forecasts
+from hardware_metrics import add_device_reading, flush_device_rollup, get_cpu_usage, get_disk_usage, get_extended_metrics, get_load_average, get_ram_usage, oneshot
+from instrumentation import increment, start_stats_writer, timed
+from log_pipeline import setup_logging
+from metrics_server import publish
+from processes import get_periodic_snapshot, get_snapshot
+from ring_buffer import new_ring, ring_aggregate, ring_append, ring_window
+from sampling import adapt_interval
+from utils import check_load_if_avg_exceeded, current_time_within_business_hours, ensure_alert_file, export_to_json_file, get_config, get_site_config, get_site_configs, install_config_reload_signal, on_config_reload, send_warning_email_for_metric, update_alert_file
+
+
+def apply_config(config):
+    global RAM_USAGE_MAX_THRESH_HOLD, CPU_USAGE_MAX_THRESH_HOLD, HDD_USAGE_MAX_THRESH_HOLD
+    global HARDWARE_CHECK_INTERVAL, SITE_NAME, MAILING_LIST
+
+    # Get max thresholds for hardware
+    RAM_USAGE_MAX_THRESH_HOLD = config.get('RAM_USAGE_MAX_THRESH_HOLD', 80)
+    CPU_USAGE_MAX_THRESH_HOLD = config.get('CPU_USAGE_MAX_THRESH_HOLD', 80)
+    HDD_USAGE_MAX_THRESH_HOLD = config.get('HDD_USAGE_MAX_THRESH_HOLD', 80)
+
+    # Get hardware check interval in seconds
+    HARDWARE_CHECK_INTERVAL = config.get('HARDWARE_CHECK_INTERVAL', 60)
+
+    # Site name
+    SITE_NAME = config.get('SITE_NAME', '')
+
+    # MAILING_LIST
+    MAILING_LIST = config.get('MAILING_LIST', [])
+
+
+apply_config(get_config())
+# Thresholds and interval follow config.json edits without a restart
+on_config_reload(apply_config)
+
+
+HARDWARE_TRIGGER_DEFAULTS = {
+    "load_avg_last_10_mins": 0.0,
+    "load_avg_last_10_mins_exceeded": False,
+    "load_avg_last_10_mins_trigger_count": 0,
+    "load_avg_last_10_mins_last_trigger_time": 0,
+    "ram_usage": 0.0,
+    "ram_usage_trigger_count": 0,
+    "ram_usage_exceeded": False,
+    "ram_usage_last_trigger_time": None,
+    "disk_usage": 0.0,
+    "disk_usage_exceeded": False,
+    "disk_usage_trigger_count": 0,
+    "disk_usage_last_trigger_time": None,
+}
+
+
+# Host wide totals of EXTENDED_HARDWARE_METRICS, published with the sample
+EXTENDED_TOTALS = ['disk_read_bytes_per_s', 'disk_write_bytes_per_s', 'disk_iops', 'net_recv_bytes_per_s', 'net_sent_bytes_per_s', 'net_errors', 'net_drops']
+
+# Readings taken every HIGH_RES_INTERVAL seconds with HIGH_RES_SAMPLING,
+# kept in memory and flushed to storage as aggregates once per check
+HIGH_RES_FIELDS = [
+    'timestamp', 'cpu_usage', 'ram_usage_percentage', 'ram_usage_used', 'ram_usage_free',
+    'load_avg_last_5_mins', 'load_avg_last_10_mins', 'load_avg_last_15_mins',
+]
+# Stored with their min, max and last besides the mean
+HIGH_RES_DETAILED_FIELDS = ['cpu_usage', 'ram_usage_percentage', 'load_avg_last_10_mins']
+# Alerts that keep the raw readings leading up to them, disk isn't read every second
+HIGH_RES_ALERT_METRICS = ['ram_usage', 'load_avg_last_10_mins']
+
+# flushed_at is per site, each site's aggregates cover its own interval
+_high_res = {"thread": None, "ring": None, "started_at": None, "flushed_at": {}}
+
+# Alerts that keep a snapshot of the top processes, load stands in for CPU
+PROCESS_ALERT_METRICS = ['ram_usage', 'load_avg_last_10_mins']
+# Only a breach seen this recently is attributed to the processes running now
+PROCESS_BREACH_MAX_AGE = 60
+
+
+def get_site_hardware_files(site_name, date_string):
+    hardware_metrics_folder = os.path.join('results', site_name, 'hardware_metrics')
+    site_alert_folder = os.path.join('alert_status', site_name, "hardware_alert_status")
 
+    if not os.path.exists(hardware_metrics_folder):
+        os.makedirs(hardware_metrics_folder)
 
-logging.basicConfig(filename='logs/ping.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    output_file = os.path.join(hardware_metrics_folder, f'hardware_metrics_{date_string}.json')
+    alert_file = os.path.join(site_alert_folder, f'alert_status_{date_string}.json')
+    ensure_alert_file(alert_file, HARDWARE_TRIGGER_DEFAULTS)
 
-config = get_config()
+    return output_file, alert_file
 
 
-# Get max thresholds for hardware
-RAM_USAGE_MAX_THRESH_HOLD = config.get('RAM_USAGE_MAX_THRESH_HOLD', 80)
-CPU_USAGE_MAX_THRESH_HOLD = config.get('CPU_USAGE_MAX_THRESH_HOLD', 80)
-HDD_USAGE_MAX_THRESH_HOLD = config.get('HDD_USAGE_MAX_THRESH_HOLD', 80)
+def read_high_res():
+    gb_size = (1024 * 1024 * 1024)
+    cpu_usage = get_cpu_usage(interval=None)
+    ram_usage = get_ram_usage()
+    load_avg = get_load_average()
 
-# Get hardware check interval in seconds
-HARDWARE_CHECK_INTERVAL = config.get('HARDWARE_CHECK_INTERVAL', 60)
+    return {
+        "timestamp": time.time(),
+        "cpu_usage": cpu_usage.get('cpu_usage', 0.0),
+        "ram_usage_percentage": ram_usage.percent,
+        "ram_usage_used": ram_usage.used / gb_size,
+        "ram_usage_free": ram_usage.free / gb_size,
+        "load_avg_last_5_mins": load_avg.get("Last 5 Mins", 0.0),
+        "load_avg_last_10_mins": load_avg.get("Last 10 Mins", 0.0),
+        "load_avg_last_15_mins": load_avg.get("Last 15 Mins", 0.0),
+    }
 
-# Site name
-SITE_NAME = config.get('SITE_NAME', '')
 
-# MAILING_LIST
-MAILING_LIST = config.get('MAILING_LIST', [])
+def _sample_high_res_forever(ring, interval):
+    next_reading = time.time()
+    while True:
+        try:
+            with timed('hardware.high_res.read'):
+                ring_append(ring, read_high_res())
+        except Exception as e:
+            logging.exception(f"High resolution reading failed: {e}")
+        next_reading += interval
+        time.sleep(max(0, next_reading - time.time()))
+
+
+def start_high_res_sampler():
+    '''
+    Read CPU, RAM and load every HIGH_RES_INTERVAL seconds into a ring
+    buffer holding HIGH_RES_BUFFER_SECONDS of readings, if HIGH_RES_SAMPLING is on
+    '''
+    config = get_config()
+    if not config.get('HIGH_RES_SAMPLING', False):
+        return
+    if _high_res["thread"] is not None and _high_res["thread"].is_alive():
+        return
+
+    interval = config.get('HIGH_RES_INTERVAL', 1)
+    capacity = max(int(config.get('HIGH_RES_BUFFER_SECONDS', 3600) / interval), 1)
+    _high_res["ring"] = new_ring(HIGH_RES_FIELDS, capacity)
+    _high_res["started_at"] = time.time()
+    _high_res["flushed_at"] = {}
+    # Primes cpu_percent, whose first non-blocking call has nothing to compare against
+    get_cpu_usage(interval=None)
+
+    _high_res["thread"] = threading.Thread(target=_sample_high_res_forever, args=(_high_res["ring"], interval), name='hardware-high-res', daemon=True)
+    _high_res["thread"].start()
+    logging.info(f"High resolution sampling every {interval}s into a buffer of {capacity} readings")
+
+
+def flush_high_res(site_name, timestamp):
+    '''
+    Aggregates of the readings since the site's previous flush,
+    None without the sampler or readings
+    '''
+    ring = _high_res["ring"]
+    if ring is None:
+        return None
+    aggregates = ring_aggregate(ring, _high_res["flushed_at"].get(site_name, _high_res["started_at"]), timestamp)
+    _high_res["flushed_at"][site_name] = timestamp
+    return aggregates
+
+
+def keep_high_res_window(site_name, metric, timestamp):
+    '''
+    Write the raw readings of the HIGH_RES_ALERT_WINDOW seconds up to an
+    alert to results/<site>/hardware_metrics/high_res/. Returns the file,
+    None when there are no readings.
+    '''
+    ring = _high_res["ring"]
+    if ring is None or timestamp is None:
+        return None
+
+    window_seconds = get_site_config(site_name).get('HIGH_RES_ALERT_WINDOW', 300)
+    readings = ring_window(ring, timestamp - window_seconds, timestamp)
+    if not readings:
+        return None
+
+    folder = os.path.join('results', site_name, 'hardware_metrics', 'high_res')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    path = os.path.join(folder, f'{metric}_{int(timestamp)}.json')
+    with open(path, 'w') as file:
+        json.dump(readings, file)
+    logging.info(f"Kept {len(readings)} high resolution readings before the {metric} alert of {site_name} in {path}")
+    return path
+
+
+def get_process_folder(site_name):
+    folder = os.path.join('results', site_name, 'hardware_metrics', 'processes')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    return folder
+
+
+def keep_process_snapshot(site_config, metric, timestamp):
+    '''
+    Write the top processes at an alert to results/<site>/hardware_metrics/processes/.
+    Returns the file, None when PROCESS_SNAPSHOTS is off or the breach isn't current.
+    '''
+    if not site_config.get('PROCESS_SNAPSHOTS', False) or timestamp is None or time.time() - timestamp > PROCESS_BREACH_MAX_AGE:
+        return None
+
+    site_name = site_config.get('SITE_NAME', '')
+    with timed('hardware.processes'):
+        snapshot = get_snapshot(site_config.get('PROCESS_TOP_N', 10), site_config.get('PROCESS_SAMPLE_SECONDS', 1))
+    # Apart from the high resolution readings attached to the same email
+    path = os.path.join(get_process_folder(site_name), f'top_processes_{metric}_{int(timestamp)}.json')
+    with open(path, 'w') as file:
+        json.dump(snapshot, file)
+    logging.info(f"Kept the top processes of {snapshot['process_count']} at the {metric} alert of {site_name} in {path}")
+    return path
+
+
+def sample_processes():
+    '''
+    Snapshot of the top processes every PROCESS_SNAPSHOT_INTERVAL
+    seconds with PROCESS_SNAPSHOTS, None in between
+    '''
+    config = get_config()
+    if not config.get('PROCESS_SNAPSHOTS', False):
+        return None
+    with timed('hardware.processes'):
+        return get_periodic_snapshot(config.get('PROCESS_SNAPSHOT_INTERVAL', 300), config.get('PROCESS_TOP_N', 10))
+
+
+def store_process_snapshot(site_config, snapshot, date_string):
+    if not site_config.get('PROCESS_SNAPSHOTS', False):
+        return
+    site_name = site_config.get('SITE_NAME', '')
+    export_to_json_file([snapshot], os.path.join(get_process_folder(site_name), f'processes_{date_string}.json'))
+
+
+def get_device_folder(site_name):
+    folder = os.path.join('results', site_name, 'hardware_metrics', 'devices')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    return folder
+
+
+def sample_devices():
+    '''
+    Rollup of the per device readings every DEVICE_ROLLUP_INTERVAL
+    seconds with EXTENDED_HARDWARE_METRICS, None in between
+    '''
+    config = get_config()
+    if not config.get('EXTENDED_HARDWARE_METRICS', False):
+        return None
+    return flush_device_rollup(config.get('DEVICE_ROLLUP_INTERVAL', 900))
+
+
+def store_device_rollup(site_config, rollup, date_string):
+    site_name = site_config.get('SITE_NAME', '')
+    export_to_json_file([rollup], os.path.join(get_device_folder(site_name), f'devices_{date_string}.json'))
+
+
+def sample_hardware_metrics(site_names=('',)):
+    '''
+    Take one reading of the host, shared by the sites the collector
+    records it for. With HIGH_RES_SAMPLING each site gets the readings
+    since its own previous sample aggregated instead.
+    Returns {site_name: sample}.
+    '''
+    flushed_at = time.time()
+    windows = {site_name: flush_high_res(site_name, flushed_at) for site_name in site_names}
+    # The root filesystem is statted once for the samples and the mounts
+    with oneshot():
+        if all(windows.values()):
+            reading = None
+            with timed('hardware.psutil.disk'):
+                disk_usage = get_disk_usage()
+            increment('hardware.samples')
+        else:
+            reading = read_hardware_sample()
+            disk_usage = {'free': reading['disk_usage_free'], 'used': reading['disk_usage_used']}
 
+        totals = {}
+        if get_config().get('EXTENDED_HARDWARE_METRICS', False):
+            with timed('hardware.psutil.extended'):
+                totals, detail = get_extended_metrics()
+            # Only the totals go in the sample, the detail is rolled up apart
+            add_device_reading(detail)
+
+    samples = {}
+    for site_name, aggregates in windows.items():
+        sample = build_high_res_sample(flushed_at, aggregates, disk_usage) if aggregates else dict(reading)
+        sample.update(totals)
+        samples[site_name] = sample
+    return samples
 
-def record_hardware_metrics(output_file):
-    results = []
-    metric_map = {
-        "timestamp": None,
-        "load_avg_last_10_mins ": 0.0,
-        "load_avg_last_10_mins_exceeded": False,
-        "load_avg_last_10_mins_trigger_count": 0,
-        "ram_usage": 0.0,
-        "ram_usage_exceeded": False,
-        "ram_usage_last_trigger_time": None,
-        "ram_usage_trigger_count": 0,
-        "disk_usage": 0.0,
-        "disk_usage_exceeded": False,
-        "disk_usage_trigger_count": 0,
-        "disk_usage_last_trigger_time": None,
-    }
 
+def read_hardware_sample():
     gb_size = (1024 * 1024 * 1024)
+
     # Get Metrics
-    cpu_usage = get_cpu_usage()
-    ram_usage = get_ram_usage()
+    with timed('hardware.psutil.cpu'):
+        cpu_usage = get_cpu_usage()
+    with timed('hardware.psutil.ram'):
+        ram_usage = get_ram_usage()
 
     # load avgs
-    load_avg = get_load_average()
-    disk_usage = get_disk_usage()
+    with timed('hardware.psutil.load'):
+        load_avg = get_load_average()
+    with timed('hardware.psutil.disk'):
+        disk_usage = get_disk_usage()
     timestamp = time.time()
+    increment('hardware.samples')
 
-    results.append({
+    return {
         "timestamp": timestamp,
         "cpu_usage": cpu_usage.get('cpu_usage', 0.0),
         "ram_usage_free": ram_usage.free / gb_size,
@@ -66,35 +319,67 @@ def record_hardware_metrics(output_file):
         "load_avg_last_15_mins": load_avg.get("Last 15 Mins", 0.0),
         "disk_usage_free": disk_usage.get('free', 0.0),
         "disk_usage_used": disk_usage.get('used', 0.0)
-    })
+    }
+
+
+def build_high_res_sample(timestamp, aggregates, disk_usage):
+    # Means under the usual names, so graphs, summaries and alerts read it as any sample
+    sample = {"timestamp": timestamp}
+    for field in HIGH_RES_FIELDS[1:]:
+        sample[field] = round(aggregates[field]["mean"], 3)
+    for field in HIGH_RES_DETAILED_FIELDS:
+        sample[f'{field}_min'] = aggregates[field]["min"]
+        sample[f'{field}_max'] = aggregates[field]["max"]
+        sample[f'{field}_last'] = aggregates[field]["last"]
+    sample["high_res_readings"] = aggregates["count"]
+    sample["disk_usage_free"] = disk_usage.get('free', 0.0)
+    sample["disk_usage_used"] = disk_usage.get('used', 0.0)
+    return sample
 
-    logging.info(f'Logging to {output_file}')
-    export_to_json_file(results, output_file)
+
+def evaluate_hardware_sample(sample, site_config):
+    metric_map = {
+        "timestamp": None,
+        "load_avg_last_10_mins ": 0.0,
+        "load_avg_last_10_mins_exceeded": False,
+        "load_avg_last_10_mins_trigger_count": 0,
+        "ram_usage": 0.0,
+        "ram_usage_exceeded": False,
+        "ram_usage_last_trigger_time": None,
+        "ram_usage_trigger_count": 0,
+        "disk_usage": 0.0,
+        "disk_usage_exceeded": False,
+        "disk_usage_trigger_count": 0,
+        "disk_usage_last_trigger_time": None,
+    }
 
     # Recording time stamp
+    timestamp = sample["timestamp"]
     logging.info(f"Recording Hardware record timestamp: {timestamp}")
     metric_map['timestamp'] = timestamp
 
     # load Average
-    load_avg_exceeded , number_of_cores = check_load_if_avg_exceeded(load_avg.get("Last 10 Mins", 0.0))
-    metric_map['load_avg_last_10_mins'] = round(load_avg.get("Last 10 Mins", 0.0) / number_of_cores * 100, 2)
+    load_avg_last_10_mins = sample.get("load_avg_last_10_mins", 0.0)
+    load_avg_exceeded , number_of_cores = check_load_if_avg_exceeded(load_avg_last_10_mins)
+    metric_map['load_avg_last_10_mins'] = round(load_avg_last_10_mins / number_of_cores * 100, 2)
     metric_map['load_avg_last_10_mins_exceeded'] = load_avg_exceeded
-    logging.info(f'Load usage exceeded threshold: {load_avg_exceeded} at {load_avg.get("Last 10 Mins", 0.0)} .')
+    logging.info(f'Load usage exceeded threshold: {load_avg_exceeded} at {load_avg_last_10_mins} .')
 
     # Ram Usage
-    ram_usage_exceeded = ram_usage.percent > RAM_USAGE_MAX_THRESH_HOLD
-    metric_map['ram_usage'] = ram_usage.percent
+    ram_usage_percentage = sample.get("ram_usage_percentage", 0.0)
+    ram_usage_exceeded = ram_usage_percentage > site_config.get('RAM_USAGE_MAX_THRESH_HOLD', 80)
+    metric_map['ram_usage'] = ram_usage_percentage
     metric_map['ram_usage_exceeded'] = ram_usage_exceeded
-    logging.info(f'RAM usage exceeded threshold: {ram_usage_exceeded} at {ram_usage.percent} %.')
+    logging.info(f'RAM usage exceeded threshold: {ram_usage_exceeded} at {ram_usage_percentage} %.')
 
     # Disk Usage
-    used = disk_usage.get('used', 0.0)
-    free = disk_usage.get('free', 0.0)
+    used = sample.get('disk_usage_used', 0.0)
+    free = sample.get('disk_usage_free', 0.0)
     total = used + free
     total = total or 1
     used_percentage = (used / total) * 100
 
-    disk_usage_exceeded = used_percentage > HDD_USAGE_MAX_THRESH_HOLD
+    disk_usage_exceeded = used_percentage > site_config.get('HDD_USAGE_MAX_THRESH_HOLD', 80)
     metric_map['disk_usage'] = round(used_percentage, 3)
     metric_map['disk_usage_exceeded'] = disk_usage_exceeded
     logging.info(f'Disk usage exceeded threshold: {disk_usage_exceeded} at {used_percentage} %.')
@@ -102,26 +387,54 @@ def record_hardware_metrics(output_file):
     return metric_map
 
 
-def evaulate_metric(previous_state, current_state, metric, output_file):
+def store_hardware_sample(site_name, sample, output_file):
+    logging.info(f'Logging to {output_file}')
+    with timed('hardware.export'):
+        export_to_json_file([sample], output_file)
+    with timed('hardware.summary'):
+        update_summary(site_name, 'hardware', sample)
+    enqueue(site_name, 'hardware', [sample])
+
+
+def record_hardware_metrics(output_file, site_config=None):
+    site_config = site_config or get_site_config(SITE_NAME)
+    site_name = site_config.get('SITE_NAME', '')
+    sample = sample_hardware_metrics([site_name])[site_name]
+    store_hardware_sample(site_name, sample, output_file)
+    return evaluate_hardware_sample(sample, site_config)
+
+
+def evaulate_metric(previous_state, current_state, metric, output_file, site_config=None, notify=None):
+    site_config = site_config or get_site_config(SITE_NAME)
+    notify = notify or send_warning_email_for_metric
     logging.info(f'Now Assessing: {metric}')
-    
+
     previous_state_exceeded = previous_state.get(f'{metric}_exceeded', False)
     # previous_state_metric = previous_state.get(metric, 0.0)
     current_state_exceeded = current_state.get(f'{metric}_exceeded', False)
     # current_state_metric = current_state.get(metric, 0.0)
-    
+
     logging.info(f'Previous state: {previous_state_exceeded} Current state: {current_state_exceeded}')
-    
+
     if not previous_state_exceeded and current_state_exceeded:
         logging.info(f'Hardware alarm triggered for {metric}')
-        send_warning_email_for_metric(
-            site_name=SITE_NAME,
-            cc=MAILING_LIST,
+        increment('hardware.alerts')
+        raw_source_file = None
+        if metric in HIGH_RES_ALERT_METRICS:
+            raw_source_file = keep_high_res_window(site_config.get('SITE_NAME', ''), metric, current_state.get("timestamp"))
+        process_source_file = None
+        if metric in PROCESS_ALERT_METRICS:
+            process_source_file = keep_process_snapshot(site_config, metric, current_state.get("timestamp"))
+        notify(
+            site_name=site_config.get('SITE_NAME', ''),
+            cc=site_config.get('MAILING_LIST', []),
             metric=metric,
             metric_measure=current_state.get(metric, 0.0),
             previous_alert_data=previous_state,
             source_file=output_file,
-            scoped_time_stamp=current_state.get("timestamp")
+            scoped_time_stamp=current_state.get("timestamp"),
+            raw_source_file=raw_source_file,
+            process_source_file=process_source_file
         )
     elif previous_state_exceeded and not current_state_exceeded:
         logging.info(f'Hardware alarm no longer triggered for {metric}')
@@ -132,81 +445,130 @@ def evaulate_metric(previous_state, current_state, metric, output_file):
             logging.info(f'No hardware issues detected for {metric}')
 
 
-def evaluate_hardware_metrics(metric_map, previous_alert_state, output_file):
+def evaluate_hardware_metrics(metric_map, previous_alert_state, output_file, site_config=None):
     for metric in ["ram_usage", "disk_usage", "load_avg_last_10_mins"]:
-        evaulate_metric(previous_alert_state, metric_map, metric, output_file)
-
-
-def process_metrics(interval, hardware_metrics_folder, alert_status_folder):    
-    curr_time = time.strftime("%H:%M")
-    curr_date = datetime.datetime.now().date().strftime("%a")
-
-    while True:
-        if current_time_within_business_hours():
-            logging.info(f'Current TIME:{curr_time} DAY:{curr_date} is within business hours. Checking hardware metrics.')
-            
-            date_string = datetime.date.today().strftime("%Y_%m_%d")
-            output_file = os.path.join(hardware_metrics_folder,
-                                f'hardware_metrics_{date_string}.json')
-            monitored_metrics = record_hardware_metrics(output_file)
-
-            alert_file = os.path.join(alert_status_folder, f'alert_status_{date_string}.json')
-
-            with open(alert_file, 'r') as file:
-                previous_alert_data = json.load(file)
-
-            evaluate_hardware_metrics(monitored_metrics, previous_alert_data, output_file)
-            logging.info('Hardware evaluation completed.')
-            logging.info('Now Updating alert file')
-            update_alert_file(alertFile=alert_file, hardware_metrics=monitored_metrics)
-            logging.info('Alert file updated')
-            logging.info('Hardware check complete.')            
-        else:
-            logging.info(f'Current TIME:{curr_time} DAY:{curr_date} is outside business hours. Skipping hardware monitoring.')
-
-        time.sleep(interval)
+        with timed('hardware.evaluate'):
+            evaulate_metric(previous_alert_state, metric_map, metric, output_file, site_config)
 
 
-if __name__ == "__main__":
-    hardware_check_interval = HARDWARE_CHECK_INTERVAL
-    site_alert_folder = os.path.join('alert_status', SITE_NAME, "hardware_alert_status")
-    hardware_metrics_folder = os.path.join('results', SITE_NAME, 'hardware_metrics')
-    date_string = datetime.date.today().strftime("%Y_%m_%d")
-
-    if not os.path.exists(hardware_metrics_folder):
-        os.makedirs(hardware_metrics_folder)
-        # Create file
-        path = os.path.join(hardware_metrics_folder, f'hardware_metrics_{date_string}.json')
-        with open(path, 'w') as file:
-            json.dump([], file)
-
-    trigger_defaults = {
-        "load_avg_last_10_mins": 0.0,
-        "load_avg_last_10_mins_exceeded": False,
-        "load_avg_last_10_mins_trigger_count": 0,
-        "load_avg_last_10_mins_last_trigger_time": 0,
-        "ram_usage": 0.0,
-        "ram_usage_trigger_count": 0,
-        "ram_usage_exceeded": False,
-        "ram_usage_last_trigger_time": None,
-        "disk_usage": 0.0,
-        "disk_usage_exceeded": False,
-        "disk_usage_trigger_count": 0,
-        "disk_usage_last_trigger_time": None,
+def get_hardware_thresholds(site_config):
+    return {
+        "ram_usage": site_config.get('RAM_USAGE_MAX_THRESH_HOLD', 80),
+        "disk_usage": site_config.get('HDD_USAGE_MAX_THRESH_HOLD', 80),
+        # load_avg_last_10_mins is a % of the cores, over half of them alerts
+        "load_avg_last_10_mins": 50,
     }
 
-    if not os.path.exists(site_alert_folder):
-        os.makedirs(site_alert_folder)
-        # Create file
 
-    alert_file = os.path.join(site_alert_folder, f'alert_status_{date_string}.json')
-    logging.info(f'Alert File: {alert_file}')
+def process_site_sample(site_config, sample, date_string):
+    '''
+    Store, evaluate and alert on a sample for one site.
+    Returns the seconds until the site's next check.
+    '''
+    site_name = site_config.get('SITE_NAME', '')
+    output_file, alert_file = get_site_hardware_files(site_name, date_string)
+    monitored_metrics = evaluate_hardware_sample(sample, site_config)
+
+    metrics = ["ram_usage", "disk_usage", "load_avg_last_10_mins"]
+    interval = adapt_interval(site_config, 'hardware', {metric: monitored_metrics[metric] for metric in metrics}, get_hardware_thresholds(site_config))
+    # The seconds this sample stands for, so averages can be weighted by time
+    sample = {**sample, "interval": interval}
+    store_hardware_sample(site_name, sample, output_file)
+
+    with timed('hardware.alert_file.read'):
+        with open(alert_file, 'r') as file:
+            previous_alert_data = json.load(file)
+
+    evaluate_hardware_metrics(monitored_metrics, previous_alert_data, output_file, site_config)
+    logging.info(f'Hardware evaluation completed for {site_name}.')
+    logging.info('Now Updating alert file')
+    with timed('hardware.alert_file.write'):
+        update_alert_file(alertFile=alert_file, hardware_metrics=monitored_metrics)
+    logging.info('Alert file updated')
+
+    with timed('hardware.anomaly'):
+        anomalies = detect_anomalies(site_config, 'hardware', {
+            "cpu_usage": sample.get("cpu_usage"),
+            "ram_usage": monitored_metrics["ram_usage"],
+            "load_avg_last_10_mins": monitored_metrics["load_avg_last_10_mins"],
+        }, sample["timestamp"])
+    notify_anomalies(site_config, 'hardware', anomalies, output_file)
+
+    with timed('hardware.forecast'):
+        forecasts = update_forecasts(site_config, {
+            "disk_usage": monitored_metrics["disk_usage"],
+            "ram_usage": monitored_metrics["ram_usage"],
+        }, sample["timestamp"], interval)
+    notify_forecasts(site_config, forecasts, output_file)
+
+    publish(site_name, 'hardware', {
+        "cpu_usage": sample.get("cpu_usage"),
+        "ram_usage": monitored_metrics["ram_usage"],
+        "load_avg_last_10_mins": monitored_metrics["load_avg_last_10_mins"],
+        "disk_usage": monitored_metrics["disk_usage"],
+        **{metric: sample.get(metric) for metric in EXTENDED_TOTALS},
+        "timestamp": sample["timestamp"],
+    }, alerts={**{metric: monitored_metrics[f'{metric}_exceeded'] for metric in metrics}, **get_anomaly_alerts(anomalies), **get_forecast_alerts(forecasts)})
+
+    return interval
+
+
+def process_metrics():
+    '''
+    Serve every configured site from one loop. The host is sampled
+    once per tick and the sample recorded for each site that is due,
+    using that site's thresholds, mailing list and business hours.
+    '''
+    next_due = {}
 
-    if not os.path.exists(alert_file):
-        logging.info('Alert file not found. Creating...')
-        with open(alert_file, 'w') as file:
-            json.dump(trigger_defaults, file, indent=4)
+    while True:
+        now = time.time()
+        curr_time = time.strftime("%H:%M")
+        curr_date = datetime.datetime.now().date().strftime("%a")
+        date_string = datetime.date.today().strftime("%Y_%m_%d")
+
+        site_configs = [site_config for site_config in get_site_configs() if site_config.get('MONITOR_HARDWARE', True)]
+        due_sites = []
+
+        for site_config in site_configs:
+            site_name = site_config.get('SITE_NAME', '')
+            if next_due.get(site_name, 0) > now:
+                continue
+            next_due[site_name] = now + site_config.get('HARDWARE_CHECK_INTERVAL', 60)
+
+            if current_time_within_business_hours(site_name=site_name):
+                logging.info(f'Current TIME:{curr_time} DAY:{curr_date} is within business hours for {site_name}. Checking hardware metrics.')
+                due_sites.append(site_config)
+            else:
+                logging.info(f'Current TIME:{curr_time} DAY:{curr_date} is outside business hours for {site_name}. Skipping hardware monitoring.')
+
+        if due_sites:
+            samples = sample_hardware_metrics([site_config.get('SITE_NAME', '') for site_config in due_sites])
+            process_snapshot = sample_processes()
+            device_rollup = sample_devices()
+            for site_config in due_sites:
+                try:
+                    with timed('hardware.site'):
+                        interval = process_site_sample(site_config, samples[site_config.get('SITE_NAME', '')], date_string)
+                    next_due[site_config.get('SITE_NAME', '')] = now + interval
+                    if process_snapshot:
+                        store_process_snapshot(site_config, process_snapshot, date_string)
+                    if device_rollup:
+                        store_device_rollup(site_config, device_rollup, date_string)
+                except Exception as e:
+                    logging.exception(f"Hardware check failed for {site_config.get('SITE_NAME')}: {e}")
+            logging.info('Hardware check complete.')
+
+        site_names = {site_config.get('SITE_NAME', '') for site_config in site_configs}
+        next_tick = min((due for site_name, due in next_due.items() if site_name in site_names), default=now + HARDWARE_CHECK_INTERVAL)
+        time.sleep(max(0, next_tick - time.time()))
 
 
+if __name__ == "__main__":
+    setup_logging('logs/ping.log')
     logging.info('Starting Up Hardware Monitoring.')
-    process_metrics(hardware_check_interval, hardware_metrics_folder, site_alert_folder)
+    install_config_reload_signal()
+    start_stats_writer()
+    start_agent()
+    start_high_res_sampler()
+    process_metrics()
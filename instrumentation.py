@@ -0,0 +1,245 @@
+import bisect
+import contextlib
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+from utils import get_config, on_config_reload
+
+
+# Upper bounds in ms of the stage timing histograms, plus one overflow bucket
+TIMER_BOUNDS_MS = [0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000]
+
+PROFILE_MODES = ['cprofile', 'tracemalloc']
+
+# Timings and counters of the collector's own stages, kept in memory
+# and written out every INSTRUMENTATION_INTERVAL seconds
+_timers = {}
+_counters = {}
+_stats_lock = threading.Lock()
+_started_at = time.time()
+
+_profiling = {
+    "mode": None,
+    # One cProfile.Profile per thread that ran a timed stage, started
+    # afresh each time cprofile mode is switched on
+    "profiles": [],
+    "generation": 0,
+}
+_thread_state = threading.local()
+_writer = {"thread": None}
+
+
+def new_timer():
+    return {
+        "count": 0,
+        "total_ms": 0.0,
+        "max_ms": 0.0,
+        "histogram": [0] * (len(TIMER_BOUNDS_MS) + 1),
+    }
+
+
+def record_timing(name, elapsed_ms):
+    with _stats_lock:
+        timer = _timers.get(name)
+        if timer is None:
+            timer = _timers[name] = new_timer()
+        timer["count"] += 1
+        timer["total_ms"] += elapsed_ms
+        if elapsed_ms > timer["max_ms"]:
+            timer["max_ms"] = elapsed_ms
+        timer["histogram"][bisect.bisect_left(TIMER_BOUNDS_MS, elapsed_ms)] += 1
+
+
+def increment(name, count=1):
+    with _stats_lock:
+        _counters[name] = _counters.get(name, 0) + count
+
+
+@contextlib.contextmanager
+def timed(name):
+    '''
+    Time a stage of the collector, e.g. with timed('hardware.export').
+    Also usable as a decorator. Stages run under the profiler while
+    PROFILE_MODE is cprofile.
+    '''
+    profile = _enter_profile() if _profiling["mode"] == 'cprofile' else None
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(name, (time.perf_counter() - started) * 1000)
+        if profile is not None:
+            _exit_profile(profile)
+
+
+def _enter_profile():
+    # Profiles are per thread; nested stages share the outermost one
+    depth = getattr(_thread_state, "depth", 0)
+    _thread_state.depth = depth + 1
+    if depth:
+        return _thread_state.profile
+
+    profile = getattr(_thread_state, "profile", None)
+    if profile is None or _thread_state.generation != _profiling["generation"]:
+        profile = _thread_state.profile = cProfile.Profile()
+        _thread_state.generation = _profiling["generation"]
+        with _stats_lock:
+            _profiling["profiles"].append(profile)
+    try:
+        profile.enable()
+    except ValueError:
+        # Python 3.12+ allows one active profiler at a time, skip this stage
+        _thread_state.depth -= 1
+        return None
+    return profile
+
+
+def _exit_profile(profile):
+    _thread_state.depth -= 1
+    if not _thread_state.depth:
+        profile.disable()
+
+
+def timer_percentile(timer, quantile):
+    total = sum(timer["histogram"])
+    if not total:
+        return None
+
+    rank = quantile * total
+    cumulative = 0
+    for index, count in enumerate(timer["histogram"]):
+        cumulative += count
+        if cumulative >= rank:
+            return TIMER_BOUNDS_MS[min(index, len(TIMER_BOUNDS_MS) - 1)]
+    return TIMER_BOUNDS_MS[-1]
+
+
+def get_stats_snapshot():
+    '''
+    Copy of the current timers and counters with
+    mean and percentiles worked out per stage
+    '''
+    with _stats_lock:
+        timers = {name: {**timer, "histogram": list(timer["histogram"])} for name, timer in _timers.items()}
+        counters = dict(_counters)
+
+    for timer in timers.values():
+        timer["mean_ms"] = timer["total_ms"] / timer["count"] if timer["count"] else 0.0
+        timer["p50_ms"] = timer_percentile(timer, 0.5)
+        timer["p95_ms"] = timer_percentile(timer, 0.95)
+        timer["p99_ms"] = timer_percentile(timer, 0.99)
+
+    return {
+        "timestamp": time.time(),
+        "started_at": _started_at,
+        "pid": os.getpid(),
+        "profile_mode": _profiling["mode"],
+        "timer_bounds_ms": TIMER_BOUNDS_MS,
+        "timers": timers,
+        "counters": counters,
+    }
+
+
+def write_atomic(path, text):
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_stats_file(path=None):
+    config = get_config()
+    path = path or config.get('INSTRUMENTATION_STATS_FILE', os.path.join('logs', 'collector_stats.json'))
+    write_atomic(path, json.dumps(get_stats_snapshot(), indent=4))
+    write_profile_file(config)
+
+
+def write_profile_file(config):
+    mode = _profiling["mode"]
+    if mode is None:
+        return
+
+    path = config.get('PROFILE_OUTPUT_FILE', os.path.join('logs', f'collector_{mode}.txt'))
+    output = io.StringIO()
+
+    if mode == 'cprofile':
+        with _stats_lock:
+            profiles = list(_profiling["profiles"])
+        if not profiles:
+            return
+        stats = pstats.Stats(profiles[0], stream=output)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.sort_stats('cumulative').print_stats(50)
+    else:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        output.write(f"Traced memory: current {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB\n\n")
+        for stat in snapshot.statistics('lineno')[:50]:
+            output.write(f"{stat}\n")
+
+    write_atomic(path, output.getvalue())
+
+
+def apply_profile_mode(config):
+    '''
+    Start or stop the PROFILE_MODE capture. As it follows config
+    reloads, profiling can be switched on and off at runtime.
+    '''
+    mode = config.get('PROFILE_MODE') or None
+    if mode not in PROFILE_MODES and mode is not None:
+        logging.error(f"Unknown PROFILE_MODE {mode}, expected one of {', '.join(PROFILE_MODES)}")
+        mode = None
+
+    if mode == _profiling["mode"]:
+        return
+
+    # Write out what was captured before switching away from it
+    if _profiling["mode"] is not None:
+        write_profile_file(config)
+
+    if _profiling["mode"] == 'tracemalloc':
+        tracemalloc.stop()
+    if mode == 'tracemalloc':
+        tracemalloc.start(config.get('TRACEMALLOC_FRAMES', 1))
+    if mode == 'cprofile':
+        with _stats_lock:
+            _profiling["profiles"] = []
+            _profiling["generation"] += 1
+
+    logging.info(f"Profile mode changed from {_profiling['mode']} to {mode}")
+    _profiling["mode"] = mode
+
+
+def _write_stats_forever():
+    while True:
+        time.sleep(get_config().get('INSTRUMENTATION_INTERVAL', 60))
+        try:
+            write_stats_file()
+        except Exception as e:
+            logging.exception(f"Writing collector stats failed: {e}")
+
+
+def start_stats_writer():
+    '''
+    Write the stats file every INSTRUMENTATION_INTERVAL seconds
+    from a daemon thread. Safe to call more than once.
+    '''
+    if _writer["thread"] is not None:
+        return
+
+    apply_profile_mode(get_config())
+    on_config_reload(apply_profile_mode)
+    _writer["thread"] = threading.Thread(target=_write_stats_forever, name='stats-writer', daemon=True)
+    _writer["thread"].start()
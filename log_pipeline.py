@@ -0,0 +1,229 @@
+import atexit
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Records are queued by the caller and written by a listener thread, so
+# a slow disk or a rotation never holds up a check
+_logging = {"filename": None, "listener": None, "handlers": [], "queue_handler": None, "dropped": 0, "registered": False, "hooks_installed": False}
+_settings = {"level": logging.INFO, "levels": {}, "rate_limit": 100, "rate_window": 60}
+
+# Loggers written to a file of their own, next to the entry point's
+DEDICATED_LOGGERS = {'mailer': 'email.log'}
+
+# (file, line) -> [window start, messages let through, messages suppressed]
+_rates = {}
+_rates_lock = threading.Lock()
+# Guards _logging["dropped"], counted by every thread that logs
+_dropped_lock = threading.Lock()
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # A full queue drops the record rather than block or raise on the caller
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with _dropped_lock:
+                _logging["dropped"] += 1
+            return
+
+        # Read unlocked first, so records logged with nothing dropped don't take the lock
+        if not _logging["dropped"]:
+            return
+        with _dropped_lock:
+            dropped, _logging["dropped"] = _logging["dropped"], 0
+        if not dropped:
+            return
+        try:
+            self.queue.put_nowait(logging.makeLogRecord({
+                "msg": f"{dropped} log messages were dropped while the log queue was full",
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+            }))
+        except queue.Full:
+            with _dropped_lock:
+                _logging["dropped"] += dropped
+
+
+def get_level(value, default=logging.INFO):
+    if isinstance(value, int):
+        return value
+    level = logging.getLevelName(str(value).upper())
+    return level if isinstance(level, int) else default
+
+
+def filter_record(record):
+    '''
+    Level of the record's module from LOG_LEVELS, then at most
+    LOG_RATE_LIMIT records per LOG_RATE_WINDOW seconds from one line.
+    The first record of a window says how many were suppressed before it.
+    '''
+    if record.levelno < _settings["levels"].get(record.module, _settings["level"]):
+        return False
+
+    limit = _settings["rate_limit"]
+    if not limit:
+        return True
+
+    key = (record.pathname, record.lineno)
+    with _rates_lock:
+        window = _rates.get(key)
+        if window is None or record.created - window[0] >= _settings["rate_window"]:
+            suppressed = window[2] if window else 0
+            _rates[key] = [record.created, 1, 0]
+        elif window[1] < limit:
+            window[1] += 1
+            suppressed = 0
+        else:
+            window[2] += 1
+            return False
+
+    if suppressed:
+        record.msg = f"{record.getMessage()} ({suppressed} more from this line were suppressed)"
+        record.args = None
+    return True
+
+
+def apply_log_config(config):
+    # Levels and rate limits follow config reloads, rotation is set at start
+    _settings["level"] = get_level(config.get('LOG_LEVEL', 'INFO'))
+    _settings["levels"] = {module: get_level(level) for module, level in config.get('LOG_LEVELS', {}).items()}
+    _settings["rate_limit"] = config.get('LOG_RATE_LIMIT', 100)
+    _settings["rate_window"] = config.get('LOG_RATE_WINDOW', 60)
+    # The root logger lets through anything a module may want
+    logging.getLogger().setLevel(min([_settings["level"], *_settings["levels"].values()]))
+
+
+def load_log_config():
+    from utils import get_config, on_config_reload
+
+    if not _logging["registered"]:
+        on_config_reload(apply_log_config)
+        _logging["registered"] = True
+    try:
+        return get_config()
+    except FileNotFoundError:
+        return {}
+
+
+def compress_rotated(source, dest):
+    with open(source, 'rb') as file, gzip.open(dest, 'wb') as compressed:
+        shutil.copyfileobj(file, compressed)
+    os.remove(source)
+
+
+def name_rotated(name):
+    return name + '.gz'
+
+
+def get_file_handler(filename, config):
+    '''
+    Rotated by size, or by time with LOG_ROTATE_WHEN ("midnight", "h", ...),
+    keeping LOG_BACKUP_COUNT gzipped files
+    '''
+    backup_count = config.get('LOG_BACKUP_COUNT', 5)
+    when = config.get('LOG_ROTATE_WHEN')
+    if when:
+        handler = logging.handlers.TimedRotatingFileHandler(filename, when=when, backupCount=backup_count, delay=True)
+    else:
+        handler = logging.handlers.RotatingFileHandler(filename, maxBytes=config.get('LOG_MAX_BYTES', 10 * 2**20), backupCount=backup_count, delay=True)
+
+    if config.get('LOG_COMPRESS', True):
+        handler.namer = name_rotated
+        handler.rotator = compress_rotated
+    handler.setFormatter(logging.Formatter(FORMAT))
+    return handler
+
+
+def get_log_files(filename):
+    '''
+    The entry point's file for everything but DEDICATED_LOGGERS,
+    each of which gets its own file in the same folder
+    '''
+    folder = os.path.dirname(filename)
+    log_files = [(filename, lambda record: record.name not in DEDICATED_LOGGERS)]
+    for name, log_file in DEDICATED_LOGGERS.items():
+        log_files.append((os.path.join(folder, log_file), lambda record, name=name: record.name == name))
+    return log_files
+
+
+def stop_logging():
+    # Writes out whatever is still queued
+    root = logging.getLogger()
+    if _logging["queue_handler"] is not None:
+        root.removeHandler(_logging["queue_handler"])
+    if _logging["listener"] is not None:
+        _logging["listener"].stop()
+    for handler in _logging["handlers"]:
+        root.removeHandler(handler)
+        handler.close()
+    _logging.update({"filename": None, "listener": None, "handlers": [], "queue_handler": None})
+
+
+def write_directly_in_child():
+    '''
+    A forked worker has no listener thread, so it writes to the
+    file itself and leaves rotation to the parent
+    '''
+    global _rates_lock, _dropped_lock
+    _rates_lock = threading.Lock()
+    _dropped_lock = threading.Lock()
+    filename = _logging["filename"]
+    if filename is None:
+        return
+
+    root = logging.getLogger()
+    root.removeHandler(_logging["queue_handler"])
+    handlers = []
+    for path, accepts in get_log_files(filename):
+        handler = logging.FileHandler(path, delay=True)
+        handler.setFormatter(logging.Formatter(FORMAT))
+        handler.addFilter(filter_record)
+        handler.addFilter(accepts)
+        root.addHandler(handler)
+        handlers.append(handler)
+    _logging.update({"listener": None, "handlers": handlers, "queue_handler": None})
+
+
+def setup_logging(filename):
+    '''
+    Log the root logger to filename through a queue. Called again with
+    another file, logging moves there, so only entry points call it,
+    never a module that others import.
+    '''
+    # Set up again once the config can be read
+    if _logging["filename"] == filename and _logging["registered"]:
+        return
+
+    config = load_log_config()
+    stop_logging()
+
+    handlers = []
+    for path, accepts in get_log_files(filename):
+        handler = get_file_handler(path, config)
+        handler.addFilter(accepts)
+        handlers.append(handler)
+    log_queue = queue.Queue(config.get('LOG_QUEUE_SIZE', 10000))
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(filter_record)
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+
+    logging.getLogger().addHandler(queue_handler)
+    listener.start()
+    _logging.update({"filename": filename, "listener": listener, "handlers": handlers, "queue_handler": queue_handler})
+    apply_log_config(config)
+
+    if not _logging["hooks_installed"]:
+        atexit.register(stop_logging)
+        # Unix only, Windows has no fork
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=write_directly_in_child)
+        _logging["hooks_installed"] = True
@@ -1,64 +1,108 @@
 import logging
-import smtplib, json, os
+import mimetypes
+import smtplib, os
+from email.mime.application import MIMEApplication
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.image import MIMEImage
 
+from instrumentation import increment, timed
+from utils import get_config
 
-mailer_log = 'logs/email.log'
-mailer_log = os.path.join(os.path.dirname(__file__), mailer_log)
-conf = 'config/config.json'
-conf = os.path.join(os.path.dirname(__file__), conf)
+# Written to logs/email.log, see log_pipeline.DEDICATED_LOGGERS
+logger = logging.getLogger('mailer')
 
-# Set up logging
-logging.basicConfig(filename=mailer_log, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-if not os.path.exists(conf):
-    raise FileNotFoundError("Config file not found")
+def get_mailer_config():
+    # Read through the cached config on every send so that
+    # credential and server changes are picked up on reload
+    config = get_config()
 
-with open(conf) as config_file:
-    config = json.load(config_file)
-    
-# LOAD MAILING CONFIG
-MAILING_LIST = config.get('MAILING_LIST', [])
-MAILER_EMAIL = config.get('MAILER_EMAIL')
-MAILER_PASSWORD = config.get('MAILER_PASSWORD')
-SMTP_PORT = config.get('SMTP_PORT', 587)
-SMTP_SERVER = config.get('SMTP_SERVER', 'smtp.office365.com')
+    # LOAD MAILING CONFIG
+    mailer_config = {
+        "MAILING_LIST": config.get('MAILING_LIST', []),
+        "MAILER_EMAIL": config.get('MAILER_EMAIL'),
+        "MAILER_PASSWORD": config.get('MAILER_PASSWORD'),
+        "SMTP_PORT": config.get('SMTP_PORT', 587),
+        "SMTP_SERVER": config.get('SMTP_SERVER', 'smtp.office365.com'),
+    }
 
+    if not mailer_config["MAILER_EMAIL"] or not mailer_config["MAILER_PASSWORD"]:
+        logger.error("Mailer email or password not provided in config file")
+        raise ValueError("Mailer email or password not provided in config file")
 
-if not MAILER_EMAIL or not MAILER_PASSWORD:
-    logging.error("Mailer email or password not provided in config file")
-    raise ValueError("Mailer email or password not provided in config file")
+    return mailer_config
 
 
-def send_email(recipients, subject, body, attachments=None):
-    logging.info(f"Sending email to {', '.join(recipients)}")
-    logging.info(f"Subject: {subject}")
-    logging.info(f"Body: {body}")
-    logging.info(f"Images Attached No: {len(attachments)}")
+def build_attachment(path, data):
+    # Graphs go as images, anything else (the JSON of an alert) as a file
+    mime_type, _ = mimetypes.guess_type(path)
+    maintype, subtype = (mime_type or 'application/octet-stream').split('/', 1)
+    name = os.path.basename(path)
+    if maintype == 'image':
+        return MIMEImage(data, _subtype=subtype, name=name)
+
+    attachment = MIMEApplication(data, _subtype=subtype if maintype == 'application' else 'octet-stream', name=name)
+    attachment.add_header('Content-Disposition', 'attachment', filename=name)
+    return attachment
+
+
+@timed('mailer.build')
+def build_message(recipients, subject, body, attachments=None):
+    mailer_config = get_mailer_config()
+    attachments = attachments or []
+
+    logger.info(f"Sending email to {', '.join(recipients)}")
+    logger.info(f"Subject: {subject}")
+    logger.debug(f"Body: {body}")
+    logger.info(f"Attachments No: {len(attachments)}")
     msg = MIMEMultipart()
-    msg['From'] = MAILER_EMAIL
+    msg['From'] = mailer_config["MAILER_EMAIL"]
     msg['To'] = ', '.join(recipients)
     msg['Subject'] = subject
 
     msg.attach(MIMEText(body, 'plain'))
 
-    for image_path in attachments:
-        if not image_path:
-            logging.warning("Invalid image path provided")
+    for attachment_path in attachments:
+        if not attachment_path:
+            logger.warning("Invalid attachment path provided")
             continue
-        if os.path.exists(image_path):
-            logging.info("Adding image to email")
-            with open(image_path, 'rb') as f:
-                image_data = f.read()
-                image = MIMEImage(image_data, name=os.path.basename(image_path))
-                msg.attach(image)
+        if os.path.exists(attachment_path):
+            logger.info(f"Adding {os.path.basename(attachment_path)} to email")
+            with open(attachment_path, 'rb') as f:
+                msg.attach(build_attachment(attachment_path, f.read()))
         else:
-            logging.warning(f"Image file not found: {image_path}")
+            logger.warning(f"Attachment file not found: {attachment_path}")
+
+    return msg
 
-    with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT) as smtp:
-        logging.info("Logging in to SMTP server")
-        smtp.login(MAILER_EMAIL, MAILER_PASSWORD)
-        smtp.send_message(msg)
-        logging.info("Email sent successfully")
+
+def send_messages(messages):
+    '''
+    Send several prepared messages over a single SMTP session
+    '''
+    if not messages:
+        return
+
+    mailer_config = get_mailer_config()
+    with timed('mailer.smtp.connect'):
+        smtp = smtplib.SMTP_SSL(mailer_config["SMTP_SERVER"], mailer_config["SMTP_PORT"])
+    with smtp:
+        logger.info("Logging in to SMTP server")
+        with timed('mailer.smtp.login'):
+            smtp.login(mailer_config["MAILER_EMAIL"], mailer_config["MAILER_PASSWORD"])
+        for msg in messages:
+            # One refused message doesn't hold back the rest of the batch
+            try:
+                with timed('mailer.smtp.send'):
+                    smtp.send_message(msg)
+            except (smtplib.SMTPException, OSError) as e:
+                increment('mailer.failed_messages')
+                logger.error(f"Email failed: {msg['Subject']}: {e}")
+                continue
+            increment('mailer.messages')
+            logger.info(f"Email sent successfully: {msg['Subject']}")
+
+
+def send_email(recipients, subject, body, attachments=None):
+    send_messages([build_message(recipients, subject, body, attachments)])
@@ -0,0 +1,37 @@
+import logging
+import threading
+
+import hardware_monitor
+import nginx
+import ping_monitor
+from agent import start_agent
+from instrumentation import start_stats_writer
+from log_pipeline import setup_logging
+from metrics_server import start_metrics_server
+from utils import install_config_reload_signal
+
+
+setup_logging('logs/ping.log')
+
+
+if __name__ == "__main__":
+    # One process serves every site in config.json: hardware checks and
+    # nginx tailing run on their own threads, pings on the main thread's pool
+    logging.info('Starting Up Health Monitoring.')
+    install_config_reload_signal()
+    # Stage timings go to logs/collector_stats.json, see PROFILE_MODE for profiling
+    start_stats_writer()
+    # OpenMetrics on METRICS_PORT, if set
+    start_metrics_server()
+    # Pushes samples to AGGREGATOR_URL, if set
+    start_agent()
+    # 1s CPU, RAM and load readings, if HIGH_RES_SAMPLING is on
+    hardware_monitor.start_high_res_sampler()
+
+    hardware_thread = threading.Thread(target=hardware_monitor.process_metrics, name='hardware-monitor', daemon=True)
+    hardware_thread.start()
+
+    nginx_thread = threading.Thread(target=nginx.process_metrics, name='nginx-monitor', daemon=True)
+    nginx_thread.start()
+
+    ping_monitor.process_metrics()
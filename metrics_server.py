@@ -0,0 +1,182 @@
+import logging
+import threading
+
+from instrumentation import TIMER_BOUNDS_MS, get_stats_snapshot
+from utils import get_config
+
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# Latest values per site, replaced as a whole on every publish so a
+# scrape reads one consistent snapshot without taking the lock
+_state = {
+    "snapshot": {"version": 0, "sites": {}},
+    "rendered": {"version": None, "text": ""},
+    "server": None,
+}
+_publish_lock = threading.Lock()
+
+# group -> [(value key, metric name, type, help)]
+SITE_METRICS = {
+    'hardware': [
+        ('cpu_usage', 'health_monitor_cpu_usage_percent', 'gauge', 'CPU usage of the host'),
+        ('ram_usage', 'health_monitor_ram_usage_percent', 'gauge', 'RAM usage of the host'),
+        ('load_avg_last_10_mins', 'health_monitor_load_avg_10m_percent', 'gauge', '10 minute load average as a share of the cores'),
+        ('disk_usage', 'health_monitor_disk_usage_percent', 'gauge', 'Disk usage of the host'),
+        ('disk_read_bytes_per_s', 'health_monitor_disk_read_bytes_per_second', 'gauge', 'Bytes read from the disks of the host per second'),
+        ('disk_write_bytes_per_s', 'health_monitor_disk_write_bytes_per_second', 'gauge', 'Bytes written to the disks of the host per second'),
+        ('disk_iops', 'health_monitor_disk_iops', 'gauge', 'Reads and writes of the disks of the host per second'),
+        ('net_recv_bytes_per_s', 'health_monitor_network_receive_bytes_per_second', 'gauge', 'Bytes received by the network interfaces of the host per second'),
+        ('net_sent_bytes_per_s', 'health_monitor_network_transmit_bytes_per_second', 'gauge', 'Bytes sent by the network interfaces of the host per second'),
+        ('net_errors', 'health_monitor_network_errors', 'gauge', 'Network interface errors since the previous sample'),
+        ('net_drops', 'health_monitor_network_drops', 'gauge', 'Network interface drops since the previous sample'),
+        ('timestamp', 'health_monitor_hardware_sample_timestamp_seconds', 'gauge', 'Time of the last hardware sample'),
+    ],
+    'ping': [
+        ('up', 'health_monitor_ping_up', 'gauge', 'Whether the site answered its last ping'),
+        ('timestamp', 'health_monitor_ping_timestamp_seconds', 'gauge', 'Time of the last ping'),
+    ],
+    'nginx': [
+        ('total_requests', 'health_monitor_nginx_window_requests', 'gauge', 'Requests in the nginx alert window'),
+        ('failure_rate', 'health_monitor_nginx_failure_rate_percent', 'gauge', 'Failed share of requests in the nginx alert window'),
+        ('request_time_p99', 'health_monitor_nginx_request_time_p99_milliseconds', 'gauge', 'p99 request time in the nginx alert window'),
+        ('timestamp', 'health_monitor_nginx_timestamp_seconds', 'gauge', 'Time of the last nginx evaluation'),
+    ],
+}
+
+
+def publish(site_name, group, values, alerts=None):
+    '''
+    Record the latest values of a site's hardware, ping or nginx check,
+    and optionally its alert states as {metric: exceeded}
+    '''
+    with _publish_lock:
+        snapshot = _state["snapshot"]
+        sites = dict(snapshot["sites"])
+        site = dict(sites.get(site_name, {}))
+        site[group] = dict(values)
+        if alerts is not None:
+            site['alerts'] = {**site.get('alerts', {}), **{metric: bool(exceeded) for metric, exceeded in alerts.items()}}
+        sites[site_name] = site
+        _state["snapshot"] = {"version": snapshot["version"] + 1, "sites": sites}
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(float(value))
+
+
+def render_sites(snapshot):
+    lines = []
+    sites = snapshot["sites"]
+
+    for group, metrics in SITE_METRICS.items():
+        for key, name, metric_type, help_text in metrics:
+            samples = [
+                f'{name}{{site="{escape_label(site_name)}"}} {format_value(site[group][key])}'
+                for site_name, site in sorted(sites.items())
+                if site.get(group, {}).get(key) is not None
+            ]
+            if samples:
+                lines += [f'# TYPE {name} {metric_type}', f'# HELP {name} {help_text}'] + samples
+
+    alert_samples = [
+        f'health_monitor_alert_active{{site="{escape_label(site_name)}",metric="{escape_label(metric)}"}} {format_value(exceeded)}'
+        for site_name, site in sorted(sites.items())
+        for metric, exceeded in sorted(site.get('alerts', {}).items())
+    ]
+    if alert_samples:
+        lines += ['# TYPE health_monitor_alert_active gauge', '# HELP health_monitor_alert_active Whether the metric is over its threshold'] + alert_samples
+
+    return '\n'.join(lines)
+
+
+def render_stats(stats):
+    lines = []
+
+    if stats["timers"]:
+        name = 'health_monitor_stage_duration_seconds'
+        lines += [f'# TYPE {name} histogram', f'# HELP {name} Time spent in each stage of the collector']
+        for stage, timer in sorted(stats["timers"].items()):
+            label = f'stage="{escape_label(stage)}"'
+            cumulative = 0
+            for bound, count in zip(TIMER_BOUNDS_MS, timer["histogram"]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{label},le="{bound / 1000}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{label},le="+Inf"}} {timer["count"]}')
+            lines.append(f'{name}_count{{{label}}} {timer["count"]}')
+            lines.append(f'{name}_sum{{{label}}} {timer["total_ms"] / 1000}')
+
+    if stats["counters"]:
+        name = 'health_monitor_events'
+        lines += [f'# TYPE {name} counter', f'# HELP {name} Samples, probes, alerts and emails of the collector']
+        for event, count in sorted(stats["counters"].items()):
+            lines.append(f'{name}_total{{event="{escape_label(event)}"}} {count}')
+
+    lines += [
+        '# TYPE health_monitor_start_time_seconds gauge',
+        '# HELP health_monitor_start_time_seconds Start time of the collector',
+        f'health_monitor_start_time_seconds {stats["started_at"]}',
+    ]
+    return '\n'.join(lines)
+
+
+def render_metrics():
+    '''
+    OpenMetrics text of the latest snapshot. The site part is only
+    rendered again once something has been published since.
+    '''
+    snapshot = _state["snapshot"]
+    rendered = _state["rendered"]
+    if rendered["version"] != snapshot["version"]:
+        rendered = _state["rendered"] = {"version": snapshot["version"], "text": render_sites(snapshot)}
+
+    parts = [part for part in [rendered["text"], render_stats(get_stats_snapshot())] if part]
+    return '\n'.join(parts) + '\n# EOF\n'
+
+
+def start_metrics_server():
+    '''
+    Serve /metrics on METRICS_HOST:METRICS_PORT from a daemon
+    thread. Does nothing unless METRICS_PORT is set.
+    '''
+    config = get_config()
+    port = config.get('METRICS_PORT')
+    if not port or _state["server"] is not None:
+        return _state["server"]
+
+    import http.server
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            body = render_metrics().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    host = config.get('METRICS_HOST', '127.0.0.1')
+    try:
+        server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        logging.error(f"Metrics endpoint could not listen on {host}:{port}: {e}")
+        return None
+
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    _state["server"] = server
+    return server
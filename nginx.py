@@ -1,26 +1,90 @@
+import argparse
+import bisect
+import collections
+import datetime
+import functools
+import gzip
+import hashlib
+import heapq
+import json
+import mmap
 import re
 import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-# Set up logging
-logging.basicConfig(filename='logs/nginx_analysis.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+from log_pipeline import setup_logging
 
+# Regular expression to parse log lines
+log_pattern = re.compile(rb'(\S+) - - \[(.*?)\] "\S+ \S+ \S+" (\d{3}) \S+')
+
+# nginx's predefined combined format. Set NGINX_LOG_FORMAT to the
+# log_format of the server to also pick up $request_time etc.
+DEFAULT_LOG_FORMAT = '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" "$http_user_agent"'
+
+# Upper bounds in ms of the latency histogram buckets, plus one overflow bucket
+LATENCY_BOUNDS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+# Routes tracked by the heavy hitters sketch, whatever the number of distinct paths
+DEFAULT_ROUTES_CAPACITY = 100
+
+# Bytes hashed from the head of the log to recognise it after logrotate
+FINGERPRINT_SIZE = 256
+
+NGINX_TRIGGER_DEFAULTS = {
+    "failure_rate": 0.0,
+    "failure_rate_exceeded": False,
+    "failure_rate_trigger_count": 0,
+    "failure_rate_last_trigger_time": None,
+    "request_time_p99": 0.0,
+    "request_time_p99_exceeded": False,
+    "request_time_p99_trigger_count": 0,
+    "request_time_p99_last_trigger_time": None,
+}
+
+# Alerted metrics of the rolling window, with their threshold key and default
+NGINX_ALERT_METRICS = {
+    "failure_rate": ("NGINX_FAILURE_RATE_MAX_THRESH_HOLD", 5),
+    "request_time_p99": ("NGINX_P99_MAX_THRESH_HOLD", 1000),
+}
 
-def parse_nginx_log(log_file):
-    # Regular expression to parse log lines
-    log_pattern = re.compile(r'(\S+) - - \[(.*?)\] "\S+ \S+ \S+" (\d{3}) \S+')
 
+def get_status_code(line):
+    '''
+    Fast path for common and combined format lines: the status is the
+    field after the closing quote of "$request". Returns None if the
+    line doesn't have that shape.
+    '''
+    # Only up to the second quote, common format has no quotes after it
+    parts = line.split(b'"', 2)
+    if len(parts) != 3 or not parts[0].endswith(b'] '):
+        return None
+
+    status = parts[2][1:4]
+    if not status.isdigit() or parts[2][:1] != b' ' or parts[2][4:5] != b' ':
+        return None
+    return int(status)
+
+
+def parse_nginx_log(log_file):
     total_requests = 0
     failed_requests = 0
 
     try:
-        with open(log_file, 'r') as file:
+        with open(log_file, 'rb') as file:
             for line in file:
-                match = log_pattern.match(line)
-                if match:
-                    total_requests += 1
+                status_code = get_status_code(line)
+                if status_code is None:
+                    # Malformed for the fast path, give the regex a go
+                    match = log_pattern.match(line)
+                    if not match:
+                        continue
                     status_code = int(match.group(3))
-                    if status_code >= 400:
-                        failed_requests += 1
+
+                total_requests += 1
+                if status_code >= 400:
+                    failed_requests += 1
     except FileNotFoundError:
         logging.error(f"Log file {log_file} not found")
         return None
@@ -29,11 +93,767 @@ def parse_nginx_log(log_file):
     return total_requests, failed_requests, failure_rate
 
 
+_minute_cache = {}
+
+
+def get_log_timestamp(time_local):
+    '''
+    Epoch seconds of an nginx $time_local value as bytes,
+    e.g. b'10/Oct/2000:13:55:36 -0700'. Parsing is cached per minute.
+    '''
+    minute_key = time_local[:17] + time_local[20:]
+    minute = _minute_cache.get(minute_key)
+    if minute is None:
+        minute = datetime.datetime.strptime(minute_key.decode('ascii', errors='replace'), "%d/%b/%Y:%H:%M %z").timestamp()
+        if len(_minute_cache) > 1024:
+            _minute_cache.clear()
+        _minute_cache[minute_key] = minute
+    return minute + int(time_local[18:20])
+
+
+def get_fingerprint(path, size=FINGERPRINT_SIZE):
+    try:
+        with open(path, 'rb') as file:
+            head = file.read(size)
+    except FileNotFoundError:
+        return None
+    return hashlib.sha1(head).hexdigest() if head else None
+
+
+def get_nginx_folder(site_name):
+    return os.path.join('results', site_name, 'nginx_metrics')
+
+
+def get_checkpoint_file(site_name):
+    return os.path.join(get_nginx_folder(site_name), 'nginx_checkpoint.json')
+
+
+def load_checkpoint(site_name):
+    path = get_checkpoint_file(site_name)
+    if not os.path.exists(path):
+        return {"inode": None, "offset": 0, "fingerprint": None, "buckets": {}}
+
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_checkpoint(site_name, checkpoint):
+    path = get_checkpoint_file(site_name)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(checkpoint, file, indent=4)
+    os.replace(tmp_path, path)
+
+
+def find_rotated_log(log_file, checkpoint):
+    '''
+    After a rename rotation the old inode lives on as access.log.1;
+    after copytruncate the copy has the same head as the old file.
+    '''
+    rotated = log_file + '.1'
+    try:
+        stat = os.stat(rotated)
+    except FileNotFoundError:
+        return None
+
+    if stat.st_ino == checkpoint["inode"]:
+        return rotated
+    if checkpoint["fingerprint"] and get_fingerprint(rotated, checkpoint.get("fingerprint_size", FINGERPRINT_SIZE)) == checkpoint["fingerprint"]:
+        return rotated
+    return None
+
+
+def read_new_lines(path, offset, on_line):
+    '''
+    Feed complete lines from offset to on_line.
+    Returns the offset after the last complete line.
+    '''
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        for line in file:
+            if not line.endswith(b'\n'):
+                # Partially written line, pick it up on the next read
+                break
+            offset += len(line)
+            on_line(line)
+    return offset
+
+
+@functools.lru_cache(maxsize=16)
+def compile_log_format(log_format):
+    '''
+    Build a bytes regex from an nginx log_format string,
+    with a named group for every $variable
+    '''
+    pattern = ''
+    position = 0
+    seen = set()
+    for variable in re.finditer(r'\$(\w+)', log_format):
+        literal = log_format[position:variable.start()]
+        pattern += re.escape(literal)
+        name = variable.group(1)
+        # Only the first occurrence of a variable is captured
+        group = f'?P<{name}>' if name not in seen else '?:'
+        seen.add(name)
+        if name == 'time_local':
+            pattern += f'({group}[^\\]]*)'
+        elif literal.endswith('"'):
+            pattern += f'({group}[^"]*)'
+        else:
+            pattern += f'({group}\\S*)'
+        position = variable.end()
+    pattern += re.escape(log_format[position:])
+    return re.compile(pattern.encode())
+
+
+def to_milliseconds(value):
+    '''
+    $request_time and $upstream_response_time are in seconds. Upstream
+    times list one value per upstream tried, which are summed.
+    '''
+    if not value or value == b'-':
+        return None
+    try:
+        return float(value) * 1000
+    except ValueError:
+        pass
+    try:
+        return sum(float(part) for part in value.replace(b':', b',').split(b',') if part.strip() not in (b'', b'-')) * 1000
+    except ValueError:
+        return None
+
+
+def parse_line(line, log_format=DEFAULT_LOG_FORMAT):
+    '''
+    Returns the fields of a bytes log line, or None if it doesn't match
+    '''
+    match = compile_log_format(log_format).match(line)
+    if not match:
+        return None
+
+    fields = match.groupdict()
+
+    try:
+        status_code = int(fields['status'])
+        timestamp = get_log_timestamp(fields['time_local'])
+    except (KeyError, ValueError):
+        return None
+
+    request = fields.get('request', b'').split(b' ')
+    method = request[0].decode('utf-8', errors='replace') if len(request) > 1 else '-'
+    path = request[1].split(b'?', 1)[0].decode('utf-8', errors='replace') if len(request) > 1 else '-'
+    bytes_sent = fields.get('body_bytes_sent') or fields.get('bytes_sent') or b'0'
+
+    return {
+        "timestamp": timestamp,
+        "status": status_code,
+        "method": method,
+        "path": path,
+        "bytes_sent": int(bytes_sent) if bytes_sent.isdigit() else 0,
+        "request_time": to_milliseconds(fields.get('request_time')),
+        "upstream_response_time": to_milliseconds(fields.get('upstream_response_time')),
+    }
+
+
+def new_histogram():
+    return [0] * (len(LATENCY_BOUNDS_MS) + 1)
+
+
+def observe(histogram, value):
+    histogram[bisect.bisect_left(LATENCY_BOUNDS_MS, value)] += 1
+
+
+def merge_histograms(histogram, other, sign=1):
+    for index, count in enumerate(other):
+        histogram[index] += sign * count
+
+
+def histogram_percentile(histogram, quantile):
+    '''
+    Upper bound in ms of the histogram bucket holding the quantile.
+    Values beyond the last bound are reported as that bound.
+    '''
+    total = sum(histogram)
+    if not total:
+        return None
+
+    rank = quantile * total
+    cumulative = 0
+    for index, count in enumerate(histogram):
+        cumulative += count
+        if cumulative >= rank:
+            return LATENCY_BOUNDS_MS[min(index, len(LATENCY_BOUNDS_MS) - 1)]
+    return LATENCY_BOUNDS_MS[-1]
+
+
+def new_sketch(capacity):
+    # heap has one [count, key] per tracked key, its counts may lag behind
+    return {"capacity": capacity, "counts": {}, "heap": []}
+
+
+def rebuild_sketch_heap(sketch):
+    sketch["heap"] = [[count, key] for key, (count, _) in sketch["counts"].items()]
+    heapq.heapify(sketch["heap"])
+
+
+def sketch_add(sketch, key, count=1):
+    '''
+    Space-Saving heavy hitters: at most `capacity` keys are kept. A new
+    key replaces the smallest one and inherits its count as error.
+    '''
+    counts = sketch["counts"]
+    if key in counts:
+        counts[key][0] += count
+        return
+
+    if len(sketch.get("heap", [])) != len(counts):
+        # Sketches saved before the heap was kept
+        rebuild_sketch_heap(sketch)
+    heap = sketch["heap"]
+
+    if len(counts) < sketch["capacity"]:
+        counts[key] = [count, 0]
+        heapq.heappush(heap, [count, key])
+        return
+
+    # Counts only grow, so stale entries are pushed back down with their
+    # current count until the smallest one is up to date
+    while heap[0][0] != counts[heap[0][1]][0]:
+        heapq.heapreplace(heap, [counts[heap[0][1]][0], heap[0][1]])
+
+    smallest_count, smallest = heapq.heapreplace(heap, [heap[0][0] + count, key])
+    del counts[smallest]
+    counts[key] = [smallest_count + count, smallest_count]
+
+
+def merge_sketches(sketch, other):
+    counts = sketch["counts"]
+    for key, (count, error) in other["counts"].items():
+        if key in counts:
+            counts[key][0] += count
+            counts[key][1] += error
+        else:
+            counts[key] = [count, error]
+
+    if len(counts) > sketch["capacity"]:
+        kept = sorted(counts.items(), key=lambda item: item[1][0], reverse=True)[:sketch["capacity"]]
+        sketch["counts"] = {key: value for key, value in kept}
+    rebuild_sketch_heap(sketch)
+
+
+def sketch_top(sketch, n=10):
+    top = sorted(sketch["counts"].items(), key=lambda item: item[1][0], reverse=True)[:n]
+    return [{"route": key, "count": count, "error": error} for key, (count, error) in top]
+
+
+def new_bucket():
+    return {
+        "total_requests": 0,
+        "failed_requests": 0,
+        "bytes_sent": 0,
+        "status_classes": {},
+        "request_time_histogram": new_histogram(),
+        "upstream_time_histogram": new_histogram(),
+    }
+
+
+def add_to_bucket(bucket, parsed):
+    bucket["total_requests"] += 1
+    if parsed["status"] >= 400:
+        bucket["failed_requests"] += 1
+    bucket["bytes_sent"] += parsed["bytes_sent"]
+
+    status_class = f'{parsed["status"] // 100}xx'
+    bucket["status_classes"][status_class] = bucket["status_classes"].get(status_class, 0) + 1
+
+    if parsed["request_time"] is not None:
+        observe(bucket["request_time_histogram"], parsed["request_time"])
+    if parsed["upstream_response_time"] is not None:
+        observe(bucket["upstream_time_histogram"], parsed["upstream_response_time"])
+
+
+def merge_buckets(bucket, other, sign=1):
+    '''
+    Add other into bucket, or take it back out with sign=-1
+    '''
+    bucket["total_requests"] += sign * other["total_requests"]
+    bucket["failed_requests"] += sign * other["failed_requests"]
+    bucket["bytes_sent"] += sign * other["bytes_sent"]
+    for status_class, count in other["status_classes"].items():
+        bucket["status_classes"][status_class] = bucket["status_classes"].get(status_class, 0) + sign * count
+    merge_histograms(bucket["request_time_histogram"], other["request_time_histogram"], sign)
+    merge_histograms(bucket["upstream_time_histogram"], other["upstream_time_histogram"], sign)
+
+
+def bucket_to_record(timestamp, bucket):
+    total_requests = bucket["total_requests"]
+    return {
+        "timestamp": int(timestamp),
+        **bucket,
+        "failure_rate": (bucket["failed_requests"] / total_requests) * 100 if total_requests else 0,
+        "request_time_p50": histogram_percentile(bucket["request_time_histogram"], 0.5),
+        "request_time_p95": histogram_percentile(bucket["request_time_histogram"], 0.95),
+        "request_time_p99": histogram_percentile(bucket["request_time_histogram"], 0.99),
+    }
+
+
+def add_line(aggregate, line, bucket_seconds, log_format=DEFAULT_LOG_FORMAT):
+    parsed = parse_line(line, log_format)
+    if not parsed:
+        return
+
+    key = str(int(parsed["timestamp"] // bucket_seconds * bucket_seconds))
+    bucket = aggregate["buckets"].get(key)
+    if bucket is None:
+        bucket = aggregate["buckets"][key] = new_bucket()
+    add_to_bucket(bucket, parsed)
+
+    status = str(parsed["status"])
+    aggregate["status_counts"][status] = aggregate["status_counts"].get(status, 0) + 1
+    sketch_add(aggregate["routes"], f'{parsed["method"]} {parsed["path"]}')
+
+
+def load_tail_state(site_name, routes_capacity):
+    checkpoint = load_checkpoint(site_name)
+    # Open buckets from checkpoints written before the richer bucket format
+    checkpoint["buckets"] = {key: {**new_bucket(), **bucket} for key, bucket in checkpoint["buckets"].items()}
+
+    date_string = datetime.date.today().strftime("%Y_%m_%d")
+    routes = checkpoint.get("routes")
+    if not routes or routes.get("date") != date_string:
+        checkpoint["routes"] = {"date": date_string, "sketch": new_sketch(routes_capacity)}
+
+    return checkpoint
+
+
+# Still open buckets of each site after its last read, for alerting
+_open_buckets = {}
+
+
+def tail_nginx_log(site_name, log_file, bucket_seconds=60, log_format=DEFAULT_LOG_FORMAT, routes_capacity=DEFAULT_ROUTES_CAPACITY):
+    '''
+    Parse what has been appended to log_file since the last call.
+    Returns the time buckets that are complete and can be stored;
+    the still open ones are carried in the checkpoint, along with
+    the day's top routes sketch.
+    '''
+    checkpoint = load_tail_state(site_name, routes_capacity)
+    aggregate = {
+        "status_counts": {},
+        "buckets": checkpoint["buckets"],
+        "routes": checkpoint["routes"]["sketch"],
+    }
+
+    def on_line(line):
+        add_line(aggregate, line, bucket_seconds, log_format)
+
+    try:
+        stat = os.stat(log_file)
+    except FileNotFoundError:
+        logging.error(f"Log file {log_file} not found")
+        return []
+
+    if checkpoint["inode"] is None:
+        # First run: only lines appended from now on are parsed
+        checkpoint["offset"] = stat.st_size
+
+    rotated = stat.st_ino != checkpoint["inode"] or stat.st_size < checkpoint["offset"]
+    if not rotated and checkpoint["fingerprint"]:
+        # Truncated and written past the old offset again between reads
+        rotated = get_fingerprint(log_file, checkpoint.get("fingerprint_size", FINGERPRINT_SIZE)) != checkpoint["fingerprint"]
+    if rotated and checkpoint["inode"] is not None:
+        logging.info(f"Log rotation detected for {log_file}")
+        rotated_log = find_rotated_log(log_file, checkpoint)
+        if rotated_log:
+            # Finish off whatever was written before the rotation
+            read_new_lines(rotated_log, checkpoint["offset"], on_line)
+        checkpoint["offset"] = 0
+
+    offset_before = checkpoint["offset"]
+    checkpoint["inode"] = stat.st_ino
+    checkpoint["offset"] = read_new_lines(log_file, checkpoint["offset"], on_line)
+    # Of the head already read, so a file still shorter than FINGERPRINT_SIZE keeps its fingerprint as it grows
+    checkpoint["fingerprint_size"] = min(checkpoint["offset"], FINGERPRINT_SIZE)
+    checkpoint["fingerprint"] = get_fingerprint(log_file, checkpoint["fingerprint_size"]) if checkpoint["fingerprint_size"] else None
+
+    # A bucket is complete once a full bucket has passed since it ended
+    cutoff = time.time() - bucket_seconds
+    buckets = checkpoint["buckets"]
+    complete = []
+    for key in sorted(buckets, key=int):
+        if int(key) + bucket_seconds <= cutoff:
+            complete.append(bucket_to_record(int(key), buckets.pop(key)))
+
+    save_checkpoint(site_name, checkpoint)
+    _open_buckets[site_name] = buckets
+
+    if checkpoint["offset"] != offset_before:
+        # Bounded by the sketch capacity, so cheap to rewrite each read
+        routes_file = get_routes_file(site_name, checkpoint["routes"]["date"])
+        with open(routes_file + '.tmp', 'w') as file:
+            json.dump(checkpoint["routes"]["sketch"], file)
+        os.replace(routes_file + '.tmp', routes_file)
+
+    return complete
+
+
+def get_routes_file(site_name, date_string=None):
+    date_string = date_string or datetime.date.today().strftime("%Y_%m_%d")
+    return os.path.join(get_nginx_folder(site_name), f'nginx_routes_{date_string}.json')
+
+
+def load_top_routes(site_name, n=10, date_string=None):
+    path = get_routes_file(site_name, date_string)
+    if not os.path.exists(path):
+        return []
+
+    with open(path) as file:
+        return sketch_top(json.load(file), n)
+
+
+def new_aggregate(routes_capacity=DEFAULT_ROUTES_CAPACITY):
+    return {
+        "status_counts": {},
+        "buckets": {},
+        "routes": new_sketch(routes_capacity),
+    }
+
+
+def merge_aggregates(aggregates, routes_capacity=DEFAULT_ROUTES_CAPACITY):
+    merged = new_aggregate(routes_capacity)
+    for aggregate in aggregates:
+        for status, count in aggregate["status_counts"].items():
+            merged["status_counts"][status] = merged["status_counts"].get(status, 0) + count
+        for key, bucket in aggregate["buckets"].items():
+            if key in merged["buckets"]:
+                merge_buckets(merged["buckets"][key], bucket)
+            else:
+                merged["buckets"][key] = bucket
+        merge_sketches(merged["routes"], aggregate["routes"])
+    return merged
+
+
+def summarize_aggregate(aggregate):
+    total = new_bucket()
+    for bucket in aggregate["buckets"].values():
+        merge_buckets(total, bucket)
+    return bucket_to_record(0, total)
+
+
+def get_chunk_bounds(log_file, chunks):
+    '''
+    Split log_file into up to `chunks` byte ranges that
+    each start and end on a line boundary
+    '''
+    size = os.path.getsize(log_file)
+    if size == 0:
+        return []
+
+    chunk_size = max(1, size // chunks)
+    bounds = []
+    with open(log_file, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < size:
+            end = mm.find(b'\n', min(start + chunk_size, size) - 1)
+            end = size if end == -1 else end + 1
+            bounds.append((start, end))
+            start = end
+    return bounds
+
+
+def parse_log_chunk(log_file, start, end, bucket_seconds=60, log_format=DEFAULT_LOG_FORMAT):
+    aggregate = new_aggregate()
+    with open(log_file, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        position = start
+        while position < end:
+            line_end = mm.find(b'\n', position, end)
+            line_end = end if line_end == -1 else line_end + 1
+            add_line(aggregate, mm[position:line_end], bucket_seconds, log_format)
+            position = line_end
+    return aggregate
+
+
+def parse_gzip_log(log_file, bucket_seconds=60, log_format=DEFAULT_LOG_FORMAT):
+    '''
+    gzip can't be split, so rotated .gz logs are
+    decompressed as a stream by a single worker each
+    '''
+    aggregate = new_aggregate()
+    with gzip.open(log_file, 'rb') as file:
+        for line in file:
+            add_line(aggregate, line, bucket_seconds, log_format)
+    return aggregate
+
+
+def bulk_parse_nginx_logs(log_files, workers=None, bucket_seconds=60, log_format=DEFAULT_LOG_FORMAT):
+    '''
+    Parse whole (archived) logs in a process pool. Plain files are
+    memory mapped and split into line aligned chunks, .gz files are
+    streamed; partial aggregates are merged at the end.
+    '''
+    workers = workers or os.cpu_count() or 1
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for log_file in log_files:
+            if log_file.endswith('.gz'):
+                futures.append(executor.submit(parse_gzip_log, log_file, bucket_seconds, log_format))
+                continue
+            # A few chunks per worker keeps the pool busy when chunk costs differ
+            for start, end in get_chunk_bounds(log_file, workers * 4):
+                futures.append(executor.submit(parse_log_chunk, log_file, start, end, bucket_seconds, log_format))
+
+        aggregate = merge_aggregates(future.result() for future in futures)
+
+    aggregate["summary"] = summarize_aggregate(aggregate)
+    return aggregate
+
+
+def record_nginx_metrics(site_config):
+    from agent import enqueue
+    from daily_summary import update_summary
+    from instrumentation import timed
+    from metrics_server import publish
+    from utils import current_time_within_business_hours, export_to_json_file
+
+    site_name = site_config.get('SITE_NAME', '')
+    log_file = site_config.get('NGINX_ACCESS_LOG')
+    bucket_seconds = site_config.get('NGINX_BUCKET_SECONDS', 60)
+    log_format = site_config.get('NGINX_LOG_FORMAT', DEFAULT_LOG_FORMAT)
+    routes_capacity = site_config.get('NGINX_TOP_ROUTES', DEFAULT_ROUTES_CAPACITY)
+
+    date_string = datetime.date.today().strftime("%Y_%m_%d")
+    output_file = os.path.join(get_nginx_folder(site_name), f'nginx_metrics_{date_string}.json')
+    window_seconds = site_config.get('NGINX_ALERT_WINDOW', 300)
+    window = get_alert_window(site_name, output_file, window_seconds)
+
+    with timed('nginx.tail'):
+        results = tail_nginx_log(site_name, log_file, bucket_seconds, log_format, routes_capacity)
+    if results:
+        logging.info(f'Logging {len(results)} nginx buckets to {output_file}')
+        with timed('nginx.export'):
+            export_to_json_file(results, output_file)
+        with timed('nginx.summary'):
+            for result in results:
+                update_summary(site_name, 'nginx', result)
+        enqueue(site_name, 'nginx', results)
+
+    # The window moves on every read, not only when a bucket completes,
+    # so a spike is seen within NGINX_CHECK_INTERVAL
+    cutoff = time.time() - window_seconds
+    add_to_alert_window(window, results)
+    expire_alert_window(window, cutoff)
+
+    with timed('nginx.evaluate'):
+        window_metrics = get_window_metrics(window, _open_buckets.get(site_name, {}), cutoff)
+        metric_map = evaluate_nginx_window(window_metrics, site_config)
+        if site_config.get('NGINX_ALERTS', True) and current_time_within_business_hours(site_name=site_name):
+            evaluate_nginx_alerts(site_config, metric_map, output_file, date_string)
+
+    publish(site_name, 'nginx', window_metrics, alerts={metric: metric_map[f'{metric}_exceeded'] for metric in NGINX_ALERT_METRICS})
+
+    return results
+
+
+# Stored buckets inside each site's alert window and their running sum.
+# Buckets are added as they complete and taken back out as they expire,
+# so a window evaluation only has to add the still open buckets on top.
+_alert_windows = {}
+
+
+def get_nginx_thresholds(site_config):
+    return {metric: site_config.get(key, default) for metric, (key, default) in NGINX_ALERT_METRICS.items()}
+
+
+def new_alert_window():
+    return {"records": collections.deque(), "totals": new_bucket()}
+
+
+def get_alert_window(site_name, output_file, window_seconds):
+    window = _alert_windows.get(site_name)
+    if window is not None:
+        return window
+
+    window = _alert_windows[site_name] = new_alert_window()
+
+    # Pick up the window of a restarted collector from today's buckets
+    if os.path.exists(output_file):
+        with open(output_file) as file:
+            try:
+                records = json.load(file)
+            except json.JSONDecodeError:
+                records = []
+        cutoff = time.time() - window_seconds
+        add_to_alert_window(window, [record for record in records if record["timestamp"] >= cutoff])
+
+    return window
+
+
+def add_to_alert_window(window, records):
+    for record in sorted(records, key=lambda record: record["timestamp"]):
+        window["records"].append(record)
+        merge_buckets(window["totals"], {**new_bucket(), **record})
+
+
+def expire_alert_window(window, cutoff):
+    records = window["records"]
+    while records and records[0]["timestamp"] < cutoff:
+        merge_buckets(window["totals"], {**new_bucket(), **records.popleft()}, sign=-1)
+
+
+def get_window_metrics(window, open_buckets, cutoff):
+    '''
+    Failure rate and p99 request time over the stored buckets
+    of the window plus the ones still being filled
+    '''
+    totals = new_bucket()
+    merge_buckets(totals, window["totals"])
+    for key, bucket in open_buckets.items():
+        if int(key) >= cutoff:
+            merge_buckets(totals, bucket)
+
+    total_requests = totals["total_requests"]
+    return {
+        "timestamp": time.time(),
+        "total_requests": total_requests,
+        "failed_requests": totals["failed_requests"],
+        "failure_rate": round((totals["failed_requests"] / total_requests) * 100, 2) if total_requests else 0.0,
+        "request_time_p99": histogram_percentile(totals["request_time_histogram"], 0.99),
+    }
+
+
+def evaluate_nginx_window(window_metrics, site_config):
+    thresholds = get_nginx_thresholds(site_config)
+    # Too few requests in the window for a rate to mean anything
+    enough_requests = window_metrics["total_requests"] >= site_config.get('NGINX_ALERT_MIN_REQUESTS', 20)
+
+    metric_map = {"timestamp": window_metrics["timestamp"]}
+    for metric, threshold in thresholds.items():
+        value = window_metrics.get(metric)
+        metric_map[metric] = value if value is not None else 0.0
+        metric_map[f'{metric}_exceeded'] = bool(enough_requests and value is not None and value > threshold)
+        logging.info(f'nginx {metric} exceeded threshold: {metric_map[f"{metric}_exceeded"]} at {value}.')
+
+    return metric_map
+
+
+def get_site_nginx_alert_file(site_name, date_string):
+    from utils import ensure_alert_file
+
+    alert_file = os.path.join('alert_status', site_name, 'nginx_alert_status', f'alert_status_{date_string}.json')
+    ensure_alert_file(alert_file, NGINX_TRIGGER_DEFAULTS)
+    return alert_file
+
+
+def evaluate_nginx_alerts(site_config, metric_map, output_file, date_string):
+    from utils import send_warning_email_for_nginx_metric, update_alert_file
+
+    site_name = site_config.get('SITE_NAME', '')
+    alert_file = get_site_nginx_alert_file(site_name, date_string)
+
+    with open(alert_file, 'r') as file:
+        previous_alert_data = json.load(file)
+
+    thresholds = get_nginx_thresholds(site_config)
+    for metric in NGINX_ALERT_METRICS:
+        previous_state_exceeded = previous_alert_data.get(f'{metric}_exceeded', False)
+        current_state_exceeded = metric_map.get(f'{metric}_exceeded', False)
+
+        if not previous_state_exceeded and current_state_exceeded:
+            logging.info(f'nginx alarm triggered for {metric} on {site_name}')
+            send_warning_email_for_nginx_metric(
+                site_name=site_name,
+                cc=site_config.get('MAILING_LIST', []),
+                metric=metric,
+                metric_measure=metric_map.get(metric),
+                threshold=thresholds[metric],
+                previous_alert_data=previous_alert_data,
+                source_file=output_file,
+                window_seconds=site_config.get('NGINX_ALERT_WINDOW', 300)
+            )
+        elif previous_state_exceeded and not current_state_exceeded:
+            logging.info(f'nginx alarm no longer triggered for {metric} on {site_name}')
+
+    update_alert_file(alertFile=alert_file, nginx_metrics=metric_map)
+
+
+def process_metrics():
+    '''
+    Tail the access log of every site that sets NGINX_ACCESS_LOG
+    '''
+    from utils import get_config, get_site_configs
+
+    next_due = {}
+
+    while True:
+        now = time.time()
+        site_configs = [site_config for site_config in get_site_configs() if site_config.get('NGINX_ACCESS_LOG')]
+
+        for site_config in site_configs:
+            site_name = site_config.get('SITE_NAME', '')
+            if next_due.get(site_name, 0) > now:
+                continue
+            next_due[site_name] = now + site_config.get('NGINX_CHECK_INTERVAL', 10)
+
+            try:
+                record_nginx_metrics(site_config)
+            except Exception as e:
+                logging.exception(f"nginx check failed for {site_name}: {e}")
+
+        site_names = {site_config.get('SITE_NAME', '') for site_config in site_configs}
+        next_tick = min((due for site_name, due in next_due.items() if site_name in site_names), default=now + get_config().get('NGINX_CHECK_INTERVAL', 10))
+        time.sleep(max(0, next_tick - time.time()))
+
+
 if __name__ == "__main__":
-    log_file_path = '/var/log/nginx/access.log'
-    total, failed, failure_rate = parse_nginx_log(log_file_path)
+    # Not at import, report_generator and daily_summary import this module
+    setup_logging('logs/nginx_analysis.log')
+
+    parser = argparse.ArgumentParser(description="Analyse the nginx access log")
+    parser.add_argument('log_files', nargs='*', default=['/var/log/nginx/access.log'])
+    parser.add_argument('--tail', action='store_true', help="Keep tailing the access logs set in config.json")
+    parser.add_argument('--bulk', action='store_true', help="Parse whole logs (including .gz) in parallel")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes for --bulk")
+    parser.add_argument('--bucket-seconds', type=int, default=60)
+    parser.add_argument('--log-format', default=DEFAULT_LOG_FORMAT, help="nginx log_format of the logs")
+    parser.add_argument('--output', help="Write the --bulk aggregate as JSON to this file")
+    args = parser.parse_args()
+
+    if args.tail:
+        from agent import start_agent
+        from instrumentation import start_stats_writer
+        from utils import install_config_reload_signal
+
+        install_config_reload_signal()
+        start_stats_writer()
+        start_agent()
+        process_metrics()
+
+    if args.bulk:
+        aggregate = bulk_parse_nginx_logs(args.log_files, workers=args.workers, bucket_seconds=args.bucket_seconds, log_format=args.log_format)
+        summary = aggregate["summary"]
+        print(f"Total Requests: {summary['total_requests']}")
+        print(f"Failed Requests: {summary['failed_requests']}")
+        print(f"Failure Rate: {summary['failure_rate']:.2f}%")
+        for status, count in sorted(aggregate["status_counts"].items()):
+            print(f"  {status}: {count}")
+        print(f"Request Time p50/p95/p99 (ms): {summary['request_time_p50']}/{summary['request_time_p95']}/{summary['request_time_p99']}")
+        print("Top Routes:")
+        for route in sketch_top(aggregate["routes"]):
+            print(f"  {route['count']:>10}  {route['route']}")
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(aggregate, file, indent=4)
+        raise SystemExit(0)
+
+    log_file_path = args.log_files[0]
+    analysis = parse_nginx_log(log_file_path)
 
-    if total is not None:
+    if analysis is not None:
+        total, failed, failure_rate = analysis
         logging.info(f"Total Requests: {total}")
         logging.info(f"Failed Requests: {failed}")
         logging.info(f"Failure Rate: {failure_rate:.2f}%")
@@ -2,45 +2,77 @@ import json, os
 import time
 import datetime
 import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
-from utils import current_time_within_business_hours, export_to_json_file, send_warning_email, update_alert_file
+from agent import enqueue, start_agent
+from anomaly import detect_anomalies, get_anomaly_alerts, notify_anomalies
+from daily_summary import update_summary
+from instrumentation import increment, start_stats_writer, timed
+from log_pipeline import setup_logging
+from metrics_server import publish
+from sampling import adapt_interval
+from utils import current_time_within_business_hours, ensure_alert_file, export_to_json_file, get_config, get_site_configs, install_config_reload_signal, on_config_reload, send_warning_email, update_alert_file
 
 
-# Set up logging
-logging.basicConfig(filename='logs/ping.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+def apply_config(config):
+    global PING_URL, PING_INTERVAL, MAILING_LIST, MAX_RETRY_ATTEMPTS, SITE_NAME, MAX_FOLDER_SIZE
+    global BUSINESS_STARTING_HOUR, BUSINESS_FINISHING_HOUR
+    global RAM_USAGE_MAX_THRESH_HOLD, CPU_USAGE_MAX_THRESH_HOLD, HDD_USAGE_MAX_THRESH_HOLD
+    global MAXIMUM_NO_OF_TRIGGERS
 
-if not os.path.exists('config/config.json'):
-    raise FileNotFoundError("Config file not found")
+    # Setting parameters
+    PING_URL = config.get('PING_URL', 'www.example.com')
+    PING_INTERVAL = config.get('PING_INTERVAL', 60)
+    MAILING_LIST = config.get('MAILING_LIST', [])
+    MAX_RETRY_ATTEMPTS = config.get('MAX_RETRY_ATTEMPTS', 4)
+    SITE_NAME = config.get('SITE_NAME')
+    MAX_FOLDER_SIZE = config.get('MAX_FOLDER_SIZE', 1000) # in MB
 
-with open('config/config.json') as config_file:
-    config = json.load(config_file)
+    # business working hours
+    BUSINESS_STARTING_HOUR = config.get("BUSINESS_START", "08:00")
+    BUSINESS_FINISHING_HOUR = config.get("BUSINESS_START", "17:00")
 
-# Setting parameters
-PING_URL = config.get('PING_URL', 'www.example.com')
-PING_INTERVAL = config.get('PING_INTERVAL', 60)
-MAILING_LIST = config.get('MAILING_LIST', [])
-MAX_RETRY_ATTEMPTS = config.get('MAX_RETRY_ATTEMPTS', 4)
-SITE_NAME = config.get('SITE_NAME')
-MAX_FOLDER_SIZE = config.get('MAX_FOLDER_SIZE', 1000) # in MB
+    # Get max thresholds for hardware
+    RAM_USAGE_MAX_THRESH_HOLD = config.get('RAM_USAGE_MAX_THRESH_HOLD', 80)
+    CPU_USAGE_MAX_THRESH_HOLD = config.get('CPU_USAGE_MAX_THRESH_HOLD', 80)
+    HDD_USAGE_MAX_THRESH_HOLD = config.get('HDD_USAGE_MAX_THRESH_HOLD', 80)
 
-# business working hours
-BUSINESS_STARTING_HOUR = config.get("BUSINESS_START", "08:00")
-BUSINESS_FINISHING_HOUR = config.get("BUSINESS_START", "17:00")
+    # Get maximum number of alarm state triggers
+    MAXIMUM_NO_OF_TRIGGERS = config.get('MAXIMUM_NO_OF_ALARM_STATE_TRIGGERS', 3)
 
-# Get max thresholds for hardware
-RAM_USAGE_MAX_THRESH_HOLD = config.get('RAM_USAGE_MAX_THRESH_HOLD', 80)
-CPU_USAGE_MAX_THRESH_HOLD = config.get('CPU_USAGE_MAX_THRESH_HOLD', 80)
-HDD_USAGE_MAX_THRESH_HOLD = config.get('HDD_USAGE_MAX_THRESH_HOLD', 80)
 
-# Get maximum number of alarm state triggers
-MAXIMUM_NO_OF_TRIGGERS = config.get('MAXIMUM_NO_OF_ALARM_STATE_TRIGGERS', 3)
+apply_config(get_config())
+# URL, interval and retry settings follow config.json edits without a restart
+on_config_reload(apply_config)
 
 
-def ping_retry(url):
+PING_TRIGGER_DEFAULTS = {
+    "alarm_triggered": False,
+    "trigger_count": 0,
+    "last_time_triggered": None
+}
+
+# One pooled session is shared by every site's probes
+_session = None
+
+
+def get_session():
+    global _session
+    if _session is None:
+        pool_size = get_config().get('PING_WORKERS', 8)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        _session = requests.Session()
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+
+def ping_retry(url, max_retry_attempts=None):
+    max_retry_attempts = max_retry_attempts if max_retry_attempts is not None else MAX_RETRY_ATTEMPTS
     retries = 0
     s = requests.Session()
     logging.info(f'Retrying connection to {url}')
@@ -48,7 +80,7 @@ def ping_retry(url):
     logging.info('Setting up retry strategy')
     # Set up retry strategy
     retry_strategy = Retry(
-        total=MAX_RETRY_ATTEMPTS,
+        total=max_retry_attempts,
         backoff_factor=0.1,
         status_forcelist=[500, 502, 503, 504]
     )
@@ -56,7 +88,7 @@ def ping_retry(url):
     s.mount('https://', HTTPAdapter(max_retries=retry_strategy))
     logging.info('Retry strategy set')
 
-    while retries < MAX_RETRY_ATTEMPTS:
+    while retries < max_retry_attempts:
         logging.info('Retrying to connect.....')
         logging.info(f'Retry count: {retries + 1}')
         try:
@@ -68,120 +100,202 @@ def ping_retry(url):
                 time.sleep(5)
         except requests.RequestException:
             retries += 1
-            if retries <= MAX_RETRY_ATTEMPTS:
+            if retries <= max_retry_attempts:
                 time.sleep(5)
     # When max number of retries is reached, return False
     # Send warning email
     return False
 
 
-def ping_url(url, output_file):
+def probe_url(url, max_retry_attempts=None):
+    '''
+    Network side of a ping, safe to run on a worker thread.
+    Returns whether the url was reached and the results to record.
+    '''
     results = []
     connected = False
 
     logging.info(f'Pinging: {url}')
+    increment('ping.probes')
     try:
-        response = requests.get(url)
+        with timed('ping.request'):
+            response = get_session().get(url)
         if response.status_code == 200:
             logging.info(f'Successfully reached {url}')
             connected = True
-            results.append({"timestamp": time.time(), "status": "success"})
+            results.append({"timestamp": time.time(), "status": "success", "response_time_ms": round(response.elapsed.total_seconds() * 1000, 1)})
         else:
             logging.info(f'Failed to reach {url}')
             logging.info('Retrying to connect')
             logging.info(f'Status Code: {response.status_code}')
             # retry ping
             results.append({"timestamp": time.time(), "status": "failure", "status_code": response.status_code})
-            connected = ping_retry(url)
+            with timed('ping.retry'):
+                connected = ping_retry(url, max_retry_attempts)
     except requests.RequestException as e:
         logging.info(f'Error - {e}')
         results.append({"timestamp": time.time(), "status": "failure", "error": str(e)})
         # retry ping
-        connected = ping_retry(url)
+        with timed('ping.retry'):
+            connected = ping_retry(url, max_retry_attempts)
+
+    return connected, results
 
+
+def store_ping_results(site_name, results, output_file):
     logging.info(f'Logging to {output_file}')
     logging.info(f'Logging File {output_file} found. TRUE:{os.path.exists(output_file)}')
 
-    export_to_json_file(results, output_file)
+    with timed('ping.export'):
+        export_to_json_file(results, output_file)
+    with timed('ping.summary'):
+        for result in results:
+            update_summary(site_name, 'ping', result)
+    enqueue(site_name, 'ping', results)
+
 
+def ping_url(url, output_file, site_name=None):
+    connected, results = probe_url(url)
+    store_ping_results(site_name or SITE_NAME, results, output_file)
     return connected
 
 
-def process_metrics(url, interval, ping_results_folder, site_alert_folder):
-    while True:
-        date_string = datetime.date.today().strftime("%Y_%m_%d")
-        output_file = ping_results_folder + f'/ping_metrics_{date_string}.json'
-        alert_file = site_alert_folder + f'/alert_status_{date_string}.json'
+def get_site_ping_files(site_name, date_string):
+    ping_results_folder = os.path.join('results', site_name, 'ping_metrics')
+    site_alert_folder = os.path.join('alert_status', site_name, "ping_alert_status")
+
+    if not os.path.exists(ping_results_folder):
+        os.makedirs(ping_results_folder)
+
+    output_file = os.path.join(ping_results_folder, f'ping_metrics_{date_string}.json')
+    alert_file = os.path.join(site_alert_folder, f'alert_status_{date_string}.json')
+    ensure_alert_file(alert_file, PING_TRIGGER_DEFAULTS)
+
+    return output_file, alert_file
+
+
+def evaluate_ping(site_config, url_accessed, alert_file):
+    site_name = site_config.get('SITE_NAME')
+
+    with timed('ping.alert_file.read'):
+        with open(alert_file, 'r') as file:
+            previous_alert_data = json.load(file)
+
+    previous_alert_state_triggered = previous_alert_data.get('alarm_triggered', False)
+
+    if not url_accessed and not previous_alert_state_triggered:
+        logging.info(f'Ping alarm triggered for {site_name}')
+        increment('ping.alerts')
+        send_warning_email(
+                site_name=site_name,
+                cc=site_config.get('MAILING_LIST', []),
+                ping_alarm_triggered=True,
+                ping_retries=site_config.get('MAX_RETRY_ATTEMPTS', 4),
+                last_trigger_time=previous_alert_data.get('last_time_triggered')
+            )
+        update_alert_file(alert_file, alert_triggered=True)
+    elif url_accessed and previous_alert_state_triggered:
+        logging.info(f"Setting alert for {site_name} from {previous_alert_state_triggered} to {not url_accessed}")
+        update_alert_file(alert_file, alert_triggered=False)
+    else:
+        if not url_accessed:
+            logging.info(f'Ping alarm still triggered for {site_name}')
+        else:
+            logging.info(f'No issues detected for {site_name}.')
 
+
+def process_site_results(site_config, url_accessed, results):
+    '''
+    Store and evaluate a site's ping.
+    Returns the seconds until the site's next ping.
+    '''
+    site_name = site_config.get('SITE_NAME')
+    date_string = datetime.date.today().strftime("%Y_%m_%d")
+    output_file, alert_file = get_site_ping_files(site_name, date_string)
+
+    interval = adapt_interval(site_config, 'ping', {"success": 100 if url_accessed else 0}, failing=not url_accessed)
+    # The seconds each result stands for, so averages can be weighted by time
+    results = [{**result, "interval": interval} for result in results]
+    store_ping_results(site_name, results, output_file)
+    with timed('ping.evaluate'):
+        evaluate_ping(site_config, url_accessed, alert_file)
+    # Slow answers of a reachable site, failures alert above
+    with timed('ping.anomaly'):
+        anomalies = detect_anomalies(site_config, 'ping', {"response_time_ms": results[-1].get("response_time_ms") if results else None}, results[-1]["timestamp"] if results else time.time())
+    notify_anomalies(site_config, 'ping', anomalies, output_file)
+
+    publish(site_name, 'ping', {
+        "up": url_accessed,
+        "timestamp": results[-1]["timestamp"] if results else time.time(),
+    }, alerts={"ping": not url_accessed, **get_anomaly_alerts(anomalies)})
+
+    return interval
+
+
+def process_metrics():
+    '''
+    Ping every configured site from one loop. Probes run on a shared
+    thread pool and session; their results are written and evaluated
+    here on the loop thread, which is the only writer to results/
+    and alert_status/.
+    '''
+    next_due = {}
+    started = {}
+    pending = {}
+    executor = ThreadPoolExecutor(max_workers=get_config().get('PING_WORKERS', 8))
+
+    while True:
+        now = time.time()
         curr_time = time.strftime("%H:%M")
         curr_date = datetime.datetime.now().date().strftime("%a")
-        
-        # Check if current date and time with working hours
-        if current_time_within_business_hours():
-            logging.info(f'Current TIME:{curr_time} DAY:{curr_date} within business hours')
-            url_accessed = ping_url(url, output_file)
-            
-            with open(alert_file, 'r') as file:
-                previous_alert_data = json.load(file)
-                
-            previous_alert_state_triggered = previous_alert_data.get('alarm_triggered', False)
-            
-            if not url_accessed and not previous_alert_state_triggered:
-                logging.info('Ping alarm triggered')
-                send_warning_email(
-                        site_name=SITE_NAME,
-                        cc=MAILING_LIST,
-                        ping_alarm_triggered=True,
-                        ping_retries=MAX_RETRY_ATTEMPTS,
-                        last_trigger_time=previous_alert_data.get('last_time_triggered')
-                    )
-                update_alert_file(alert_file, alert_triggered=True)
-            elif url_accessed and previous_alert_state_triggered:
-                logging.info(f"Setting alert from {previous_alert_state_triggered} to {not url_accessed}")
-                update_alert_file(alert_file, alert_triggered=False)
-            else:
-                if not url_accessed:
-                    logging.info('Ping alarm still triggered')
-                else:
-                    logging.info('No issues detected.')
-                
-        else:
-            logging.info(f'Current TIME:{curr_time} DAY:{curr_date} is outside business hours. Skipping ping monitoring.')
 
-        time.sleep(interval)
+        site_configs = [site_config for site_config in get_site_configs() if site_config.get('MONITOR_PING', True)]
+        in_flight = {site_config.get('SITE_NAME') for site_config in pending.values()}
 
+        for site_config in site_configs:
+            site_name = site_config.get('SITE_NAME')
+            if site_name in in_flight or next_due.get(site_name, 0) > now:
+                continue
+            next_due[site_name] = now + site_config.get('PING_INTERVAL', 60)
+            started[site_name] = now
 
-if __name__ == "__main__":
-    url_to_ping = PING_URL
-    ping_interval = PING_INTERVAL
+            # Check if current date and time with working hours
+            if not current_time_within_business_hours(site_name=site_name):
+                logging.info(f'Current TIME:{curr_time} DAY:{curr_date} is outside business hours for {site_name}. Skipping ping monitoring.')
+                continue
 
-    # create sites results folder if it doesn't exist
-    ping_results_folder = os.path.join('results', SITE_NAME, 'ping_metrics')
-    site_alert_folder = os.path.join('alert_status', SITE_NAME, "ping_alert_status")
-    date_string = datetime.date.today().strftime("%Y_%m_%d")
-    if not os.path.exists(ping_results_folder):
-        os.makedirs(ping_results_folder)
-        # Create file
-        with open(os.path.join(ping_results_folder, f'ping_metrics_{date_string}.json'), 'w') as file:
-            json.dump([], file)
-            
-    trigger_defaults = {
-        "alarm_triggered": False,
-        "trigger_count": 0,
-        "last_time_triggered": None
-    }
-    
-    if not os.path.exists(site_alert_folder):
-        os.makedirs(site_alert_folder)
-
-    # Create file
-    alert_file = os.path.join(site_alert_folder, f'alert_status_{date_string}.json')
-    logging.info(f'Alert File: {alert_file}')
+            logging.info(f'Current TIME:{curr_time} DAY:{curr_date} within business hours for {site_name}')
+            future = executor.submit(
+                probe_url,
+                site_config.get('PING_URL', 'www.example.com'),
+                site_config.get('MAX_RETRY_ATTEMPTS', 4)
+            )
+            pending[future] = site_config
+
+        site_names = {site_config.get('SITE_NAME') for site_config in site_configs}
+        next_tick = min((due for site_name, due in next_due.items() if site_name in site_names), default=now + PING_INTERVAL)
+        timeout = max(0, next_tick - time.time())
+
+        if not pending:
+            time.sleep(timeout)
+            continue
 
-    if not os.path.exists(alert_file):
-        logging.info('Alert file not found. Creating...')
-        with open(alert_file, 'w') as file:
-            json.dump(trigger_defaults, file, indent=4)
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            site_config = pending.pop(future)
+            try:
+                url_accessed, results = future.result()
+                interval = process_site_results(site_config, url_accessed, results)
+                site_name = site_config.get('SITE_NAME')
+                next_due[site_name] = started[site_name] + interval
+            except Exception as e:
+                logging.exception(f"Ping check failed for {site_config.get('SITE_NAME')}: {e}")
 
+
+if __name__ == "__main__":
+    setup_logging('logs/ping.log')
     logging.info('Starting Up')
-    process_metrics(url_to_ping, ping_interval, ping_results_folder, site_alert_folder)
+    install_config_reload_signal()
+    start_stats_writer()
+    start_agent()
+    process_metrics()
@@ -0,0 +1,156 @@
+import heapq
+import threading
+import time
+
+import psutil
+
+
+# Handles kept between snapshots, so CPU and I/O are deltas since the
+# previous read rather than a fresh wait per process
+_processes = {"handles": {}, "io": {}, "read_at": None, "alert": None, "periodic_at": None}
+_processes_lock = threading.Lock()
+
+CMDLINE_LENGTH = 200
+
+
+def refresh_handles():
+    handles = _processes["handles"]
+    pids = set(psutil.pids())
+    for pid in [pid for pid in handles if pid not in pids]:
+        del handles[pid]
+        _processes["io"].pop(pid, None)
+
+    new_pids = pids - handles.keys()
+    for pid in new_pids:
+        try:
+            handles[pid] = psutil.Process(pid)
+        except psutil.Error:
+            continue
+    return handles, new_pids
+
+
+def read_processes(handles, new_pids, elapsed):
+    '''
+    One pass over the handles, each read under oneshot(). Processes
+    seen for the first time get their CPU averaged over their lifetime.
+    '''
+    now = time.time()
+    entries = []
+    for pid, handle in list(handles.items()):
+        try:
+            with handle.oneshot():
+                if pid in new_pids:
+                    times = handle.cpu_times()
+                    handle.cpu_percent(None)
+                    cpu = (times.user + times.system) / max(now - handle.create_time(), 1) * 100
+                else:
+                    cpu = handle.cpu_percent(None)
+                rss = handle.memory_info().rss
+                name = handle.name()
+                try:
+                    counters = handle.io_counters()
+                    io_total = counters.read_bytes + counters.write_bytes
+                except (psutil.AccessDenied, AttributeError):
+                    # Other users' processes without root, and not on macOS
+                    io_total = None
+        except psutil.NoSuchProcess:
+            del handles[pid]
+            _processes["io"].pop(pid, None)
+            continue
+        except psutil.Error:
+            continue
+
+        previous_io = _processes["io"].get(pid)
+        io_rate = None
+        if io_total is not None:
+            _processes["io"][pid] = io_total
+            if previous_io is not None and elapsed:
+                io_rate = round(max(io_total - previous_io, 0) / elapsed, 1)
+
+        entries.append({
+            "pid": pid,
+            "name": name,
+            "cpu_percent": round(cpu, 1),
+            "rss_mb": round(rss / 2**20, 1),
+            "io_bytes_per_s": io_rate,
+        })
+    return entries
+
+
+def describe(entry, handles):
+    # Only for the few processes reported, the rest never pay for it
+    handle = handles.get(entry["pid"])
+    if handle is None or "cmdline" in entry:
+        return entry
+    try:
+        entry["username"] = handle.username()
+        entry["cmdline"] = " ".join(handle.cmdline())[:CMDLINE_LENGTH]
+    except psutil.Error:
+        entry["username"] = entry["cmdline"] = None
+    return entry
+
+
+def take_snapshot(top_n=10, sample_seconds=1):
+    '''
+    Top top_n processes by CPU, RSS and I/O. With sample_seconds,
+    CPU and I/O are measured over that many seconds from now, otherwise
+    since the previous snapshot.
+    '''
+    with _processes_lock:
+        handles, new_pids = refresh_handles()
+        if sample_seconds:
+            read_processes(handles, new_pids, 0)
+            _processes["read_at"] = time.monotonic()
+            new_pids = set()
+            time.sleep(sample_seconds)
+
+        read_at = time.monotonic()
+        elapsed = read_at - _processes["read_at"] if _processes["read_at"] is not None else 0
+        entries = read_processes(handles, new_pids, elapsed)
+        _processes["read_at"] = read_at
+
+        snapshot = {
+            "timestamp": time.time(),
+            "seconds": round(elapsed, 1),
+            "process_count": len(entries),
+            "top_cpu": [describe(entry, handles) for entry in heapq.nlargest(top_n, entries, key=lambda entry: entry["cpu_percent"])],
+            "top_rss": [describe(entry, handles) for entry in heapq.nlargest(top_n, entries, key=lambda entry: entry["rss_mb"])],
+            "top_io": [
+                describe(entry, handles)
+                for entry in heapq.nlargest(top_n, [entry for entry in entries if entry["io_bytes_per_s"] is not None], key=lambda entry: entry["io_bytes_per_s"])
+            ],
+        }
+        return snapshot
+
+
+def get_snapshot(top_n=10, sample_seconds=1, max_age=30):
+    '''
+    The latest alert snapshot if younger than max_age seconds, so several
+    sites breaching on the same tick share one. Periodic snapshots are
+    never reused, their CPU and I/O cover the whole interval.
+    '''
+    alert = _processes["alert"]
+    if alert is not None and time.time() - alert["timestamp"] <= max_age:
+        return alert
+    _processes["alert"] = take_snapshot(top_n, sample_seconds)
+    return _processes["alert"]
+
+
+def get_periodic_snapshot(interval, top_n=10):
+    '''
+    A snapshot once every interval seconds, None in between. CPU and
+    I/O are averaged since the previous one, without waiting.
+    '''
+    now = time.time()
+    if _processes["periodic_at"] is not None and now - _processes["periodic_at"] < interval:
+        return None
+    _processes["periodic_at"] = now
+    return take_snapshot(top_n, sample_seconds=0)
+
+
+if __name__ == "__main__":
+    snapshot = take_snapshot(top_n=5)
+    for key in ["top_cpu", "top_rss", "top_io"]:
+        print(key)
+        for entry in snapshot[key]:
+            print(f"  {entry}")
@@ -0,0 +1,410 @@
+import argparse
+import collections
+import datetime
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from daily_summary import get_record_values
+from log_pipeline import setup_logging
+from sampling import get_interval_bounds
+from utils import get_abs_path, get_base_dir, get_config, get_site_config
+
+
+setup_logging('logs/query_api.log')
+
+METRICS = ['hardware', 'ping', 'nginx']
+
+# Rollup tiers in seconds. Past days are rolled up once and kept in
+# results/<site>/rollups/, so long ranges read a few points per day.
+TIERS = {
+    'raw': None,
+    '5m': 300,
+    '1h': 3600,
+    '1d': 86400,
+}
+
+# Bumped when the rollup points change shape, so stored rollups are rebuilt
+ROLLUP_FORMAT = 2
+
+DASHBOARD_FILE = get_abs_path(os.path.join('static', 'dashboard.html'))
+
+# Day rollups and rendered responses, least recently used dropped first
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def cache_get(key):
+    with _cache_lock:
+        value = _cache.get(key)
+        if value is not None:
+            _cache.move_to_end(key)
+        return value
+
+
+def cache_put(key, value):
+    with _cache_lock:
+        _cache[key] = value
+        _cache.move_to_end(key)
+        while len(_cache) > get_config().get('QUERY_CACHE_SIZE', 1024):
+            _cache.popitem(last=False)
+
+
+def get_point_values(metric, record):
+    if metric == 'ping':
+        return {'success': 100.0 if record.get('status') == 'success' else 0.0}
+
+    if metric == 'nginx':
+        values = get_record_values(metric, record)
+        if record.get('request_time_p99') is not None:
+            values['request_time_p99'] = record['request_time_p99']
+        return values
+
+    return get_record_values(metric, record)
+
+
+def get_sample_interval(site_name, metric, shortest=False):
+    '''
+    Seconds between a site's samples. With shortest, the min interval
+    adaptive sampling may drop to.
+    '''
+    site_config = get_site_config(site_name)
+    if metric == 'nginx':
+        return site_config.get('NGINX_BUCKET_SECONDS', 60)
+    base, low, _ = get_interval_bounds(site_config, metric)
+    return low if shortest and site_config.get('ADAPTIVE_SAMPLING', False) else base
+
+
+def discover_sites():
+    results_folder = os.path.join(get_base_dir(), 'results')
+    if not os.path.exists(results_folder):
+        return []
+
+    return sorted(
+        entry.name for entry in os.scandir(results_folder)
+        if entry.is_dir() and any(
+            os.path.isdir(os.path.join(entry.path, f'{metric}_metrics')) for metric in METRICS
+        )
+    )
+
+
+def get_day_files(site_name, metric, start, end):
+    '''
+    Daily results files of a site overlapping [start, end],
+    as (date_string, path, stat) tuples
+    '''
+    folder = os.path.join(get_base_dir(), 'results', site_name, f'{metric}_metrics')
+    day = datetime.date.fromtimestamp(start)
+    last_day = datetime.date.fromtimestamp(end)
+    day_files = []
+
+    while day <= last_day:
+        date_string = day.strftime("%Y_%m_%d")
+        path = os.path.join(folder, f'{metric}_metrics_{date_string}.json')
+        try:
+            day_files.append((date_string, path, os.stat(path)))
+        except FileNotFoundError:
+            pass
+        day += datetime.timedelta(days=1)
+
+    return day_files
+
+
+def roll_up(metric, records, tier_seconds, default_interval=60):
+    '''
+    Bucket records by tier_seconds (per record for raw).
+    Returns [[timestamp, count, {field: [weighted sum, min, max, weight]}], ...]
+    Each value is weighted by the interval its sample covered, records
+    stored without one by default_interval.
+    '''
+    buckets = {}
+    for record in records:
+        timestamp = record.get('timestamp')
+        if timestamp is None:
+            continue
+        key = int(timestamp // tier_seconds * tier_seconds) if tier_seconds else timestamp
+
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = [key, 0, {}]
+        bucket[1] += 1
+        weight = record.get('interval') or default_interval
+        for field, value in get_point_values(metric, record).items():
+            stats = bucket[2].get(field)
+            if stats is None:
+                bucket[2][field] = [value * weight, value, value, weight]
+            else:
+                stats[0] += value * weight
+                stats[1] = min(stats[1], value)
+                stats[2] = max(stats[2], value)
+                stats[3] += weight
+
+    return [buckets[key] for key in sorted(buckets)]
+
+
+def get_rollup_file(site_name, metric, resolution, date_string):
+    return os.path.join(get_base_dir(), 'results', site_name, 'rollups', f'{metric}_{resolution}_{date_string}.json')
+
+
+def load_day_rollup(site_name, metric, resolution, date_string, path, stat):
+    '''
+    Rollup of one day's results at a tier, from memory, then from the
+    rollup file, then from the results file. Keyed on the results file's
+    mtime and size so today's rollup follows new samples.
+    '''
+    version = [ROLLUP_FORMAT, stat.st_mtime_ns, stat.st_size]
+    key = ('rollup', path, resolution)
+    cached = cache_get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    is_today = date_string == datetime.date.today().strftime("%Y_%m_%d")
+    rollup_file = get_rollup_file(site_name, metric, resolution, date_string)
+
+    points = None
+    if resolution != 'raw' and not is_today and os.path.exists(rollup_file):
+        with open(rollup_file) as file:
+            try:
+                stored = json.load(file)
+                if stored.get("source_version") == version:
+                    points = stored["points"]
+            except json.JSONDecodeError:
+                logging.warning(f"Rollup file could not be parsed: {rollup_file}")
+
+    if points is None:
+        with open(path) as file:
+            try:
+                records = json.load(file)
+            except json.JSONDecodeError:
+                logging.warning(f"Results file could not be parsed: {path}")
+                records = []
+        points = roll_up(metric, records, TIERS[resolution], get_sample_interval(site_name, metric))
+
+        # Past days don't change any more, keep their rollups
+        if resolution != 'raw' and not is_today:
+            os.makedirs(os.path.dirname(rollup_file), exist_ok=True)
+            with open(rollup_file + '.tmp', 'w') as file:
+                json.dump({"source_version": version, "points": points}, file)
+            os.replace(rollup_file + '.tmp', rollup_file)
+
+    cache_put(key, (version, points))
+    return points
+
+
+def choose_resolution(site_name, metric, start, end):
+    '''
+    Finest tier that keeps the range within QUERY_MAX_POINTS
+    '''
+    max_points = get_config().get('QUERY_MAX_POINTS', 1500)
+    span = max(end - start, 1)
+
+    if span / get_sample_interval(site_name, metric, shortest=True) <= max_points:
+        return 'raw'
+    for resolution, tier_seconds in TIERS.items():
+        if tier_seconds and span / tier_seconds <= max_points:
+            return resolution
+    return '1d'
+
+
+def parse_query(params):
+    '''
+    Validate the query string of /api/query.
+    Raises ValueError with a message for the client.
+    '''
+    site_name = params.get('site', [None])[0]
+    metric = params.get('metric', ['hardware'])[0]
+    if not site_name or site_name not in discover_sites():
+        raise ValueError(f"Unknown site: {site_name}")
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric: {metric}, expected one of {', '.join(METRICS)}")
+
+    now = time.time()
+    end = float(params.get('end', [now])[0])
+    start = float(params.get('start', [end - 86400])[0])
+    if start >= end:
+        raise ValueError("start must be before end")
+
+    resolution = params.get('resolution', ['auto'])[0]
+    if resolution == 'auto':
+        resolution = choose_resolution(site_name, metric, start, end)
+    if resolution not in TIERS:
+        raise ValueError(f"Unknown resolution: {resolution}, expected auto or one of {', '.join(TIERS)}")
+
+    # Align the range to the tier so that repeated "last 24h" queries
+    # hit the same cache entry until a new bucket starts
+    step = TIERS[resolution] or 60
+    start = int(start // step * step)
+    end = int(-(-end // step) * step)
+
+    return site_name, metric, resolution, start, end
+
+
+def merge_points(point, other):
+    # A new point, the cached rollups stay as they are
+    merged = [point[0], point[1] + other[1], dict(point[2])]
+    for field, stats in other[2].items():
+        current = merged[2].get(field)
+        if current is None:
+            merged[2][field] = stats
+        else:
+            merged[2][field] = [current[0] + stats[0], min(current[1], stats[1]), max(current[2], stats[2]), current[3] + stats[3]]
+    return merged
+
+
+def run_query(site_name, metric, resolution, start, end, day_files):
+    points = []
+    for date_string, path, stat in day_files:
+        for point in load_day_rollup(site_name, metric, resolution, date_string, path, stat):
+            if not start <= point[0] <= end:
+                continue
+            # Buckets are cut on UTC multiples and day files on local midnight,
+            # so away from UTC a bucket can start in one file and end in the next
+            if points and points[-1][0] == point[0]:
+                points[-1] = merge_points(points[-1], point)
+            else:
+                points.append(point)
+
+    fields = sorted({field for point in points for field in point[2]})
+    result = {
+        "site": site_name,
+        "metric": metric,
+        "resolution": resolution,
+        "start": start,
+        "end": end,
+        "fields": fields,
+        "timestamps": [point[0] for point in points],
+        "count": [point[1] for point in points],
+        "avg": {},
+        "min": {},
+        "max": {},
+    }
+
+    for field in fields:
+        stats = [point[2].get(field) for point in points]
+        result["avg"][field] = [round(stat[0] / stat[3], 3) if stat else None for stat in stats]
+        result["min"][field] = [stat[1] if stat else None for stat in stats]
+        result["max"][field] = [stat[2] if stat else None for stat in stats]
+
+    return result
+
+
+def handle_query(params, headers):
+    '''
+    Returns (status, headers, body) of /api/query. The ETag comes from
+    the query and its files' mtimes, so a revalidation that matches is
+    answered without reading any results.
+    '''
+    site_name, metric, resolution, start, end = parse_query(params)
+    day_files = get_day_files(site_name, metric, start, end)
+
+    versions = [(date_string, stat.st_mtime_ns, stat.st_size) for date_string, _, stat in day_files]
+    etag = '"' + hashlib.sha1(json.dumps([site_name, metric, resolution, start, end, versions]).encode()).hexdigest() + '"'
+    last_modified = max((stat.st_mtime for _, _, stat in day_files), default=time.time())
+
+    response_headers = {
+        "ETag": etag,
+        "Last-Modified": email.utils.formatdate(last_modified, usegmt=True),
+        # Ranges over past days can't change, the rest is revalidated
+        "Cache-Control": "max-age=86400" if end < time.time() - 86400 else "no-cache",
+    }
+
+    if etag in [tag.strip() for tag in headers.get('If-None-Match', '').split(',')]:
+        return 304, response_headers, b''
+
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since and 'If-None-Match' not in headers:
+        try:
+            if int(last_modified) <= email.utils.parsedate_to_datetime(if_modified_since).timestamp():
+                return 304, response_headers, b''
+        except (TypeError, ValueError):
+            pass
+
+    key = ('response', etag)
+    body = cache_get(key)
+    if body is None:
+        body = json.dumps(run_query(site_name, metric, resolution, start, end, day_files)).encode()
+        cache_put(key, body)
+
+    return 200, {**response_headers, "Content-Type": "application/json"}, body
+
+
+def get_plotly_js():
+    '''
+    plotly.js as bundled with the plotly package, so the
+    dashboard works without access to a CDN
+    '''
+    body = cache_get(('static', 'plotly.min.js'))
+    if body is None:
+        from plotly.offline import get_plotlyjs
+
+        body = get_plotlyjs().encode()
+        cache_put(('static', 'plotly.min.js'), body)
+    return body
+
+
+def make_handler():
+    import http.server
+
+    class QueryHandler(http.server.BaseHTTPRequestHandler):
+        def send(self, status, headers, body):
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            try:
+                if url.path == '/api/query':
+                    self.send(*handle_query(parse_qs(url.query), self.headers))
+                elif url.path == '/api/sites':
+                    self.send(200, {"Content-Type": "application/json", "Cache-Control": "no-cache"}, json.dumps(discover_sites()).encode())
+                elif url.path in ('/', '/dashboard'):
+                    with open(DASHBOARD_FILE, 'rb') as file:
+                        self.send(200, {"Content-Type": "text/html; charset=utf-8"}, file.read())
+                elif url.path == '/plotly.min.js':
+                    self.send(200, {"Content-Type": "application/javascript", "Cache-Control": "max-age=86400"}, get_plotly_js())
+                else:
+                    self.send(404, {"Content-Type": "application/json"}, json.dumps({"error": "Not found"}).encode())
+            except ValueError as e:
+                self.send(400, {"Content-Type": "application/json"}, json.dumps({"error": str(e)}).encode())
+            except Exception as e:
+                logging.exception(f"Query failed for {self.path}: {e}")
+                self.send(500, {"Content-Type": "application/json"}, json.dumps({"error": "Internal error"}).encode())
+
+        do_HEAD = do_GET
+
+        def log_message(self, format, *args):
+            logging.info(f"{self.address_string()} {format % args}")
+
+    return QueryHandler
+
+
+def serve(host=None, port=None):
+    import http.server
+
+    config = get_config()
+    host = host or config.get('QUERY_API_HOST', '127.0.0.1')
+    port = port or config.get('QUERY_API_PORT', 8050)
+
+    server = http.server.ThreadingHTTPServer((host, port), make_handler())
+    server.daemon_threads = True
+    logging.info(f"Serving the query API and dashboard on http://{host}:{port}/")
+    print(f"Dashboard on http://{host}:{port}/")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve range queries over results/ and the dashboard")
+    parser.add_argument('--host', default=None)
+    parser.add_argument('--port', type=int, default=None)
+    args = parser.parse_args()
+    serve(args.host, args.port)
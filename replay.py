@@ -0,0 +1,271 @@
+'''
+Replay of historical results through the alerting logic.
+
+Day files of results/ (and of any --source folders holding archived
+results in the same layout, plain or .json.gz) are read one day at a
+time, in date order, and run through the same evaluation as the
+collectors with the current config plus any --set overrides. Alerts are
+captured instead of sent, nothing is rendered.
+
+    python replay.py [--sites a b] [--metrics hardware ping nginx] [--start 2026-09-01] [--end 2026-09-30]
+                     [--set RAM_USAGE_MAX_THRESH_HOLD=70] [--source archive/results] [--output alerts.json] [--backfill]
+
+Regenerated daily summaries go to replay/<site>/summaries/, or with
+--backfill to results/<site>/summaries/ for past days, where reports
+pick them up.
+'''
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import os
+import time
+
+import hardware_monitor
+import nginx
+from daily_summary import fold_record, get_summary_file, new_summary, write_summary
+from log_pipeline import setup_logging
+from utils import _compile_business_hours, get_base_dir, get_site_config, get_site_configs, within_business_hours
+
+
+setup_logging('logs/replay.log')
+
+METRICS = ['hardware', 'ping', 'nginx']
+HARDWARE_ALERT_METRICS = ["ram_usage", "disk_usage", "load_avg_last_10_mins"]
+HARDWARE_THRESHOLD_KEYS = {
+    "ram_usage": ("RAM_USAGE_MAX_THRESH_HOLD", 80),
+    "disk_usage": ("HDD_USAGE_MAX_THRESH_HOLD", 80),
+}
+
+
+def parse_override(text):
+    key, _, value = text.partition('=')
+    if not key or not _:
+        raise argparse.ArgumentTypeError(f"Expected KEY=VALUE, got {text}")
+    try:
+        return key, json.loads(value)
+    except json.JSONDecodeError:
+        return key, value
+
+
+def find_day_files(roots, site_name, metric, start_date=None, end_date=None):
+    '''
+    Day files of a site and metric across roots, as [(date_string, path)]
+    in date order. A day found in several roots is read from the first.
+    '''
+    day_files = {}
+    prefix = f'{metric}_metrics_'
+
+    for root in roots:
+        folder = os.path.join(root, site_name, f'{metric}_metrics')
+        if not os.path.exists(folder):
+            continue
+        for entry in os.scandir(folder):
+            name = entry.name
+            if not name.startswith(prefix) or not (name.endswith('.json') or name.endswith('.json.gz')):
+                continue
+            date_string = name[len(prefix):].split('.', 1)[0]
+            try:
+                day = datetime.datetime.strptime(date_string, "%Y_%m_%d").date()
+            except ValueError:
+                continue
+            if (start_date and day < start_date) or (end_date and day > end_date):
+                continue
+            day_files.setdefault(date_string, entry.path)
+
+    return sorted(day_files.items())
+
+
+def read_day_file(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as file:
+        try:
+            records = json.load(file)
+        except (json.JSONDecodeError, EOFError, OSError) as e:
+            logging.warning(f"Skipping {path}, it could not be parsed: {e}")
+            return []
+    return sorted((record for record in records if record.get('timestamp') is not None), key=lambda record: record['timestamp'])
+
+
+def is_alerting_time(timestamp, business_hours):
+    # The collectors only check within business hours
+    return within_business_hours(datetime.datetime.fromtimestamp(timestamp), business_hours)
+
+
+def replay_hardware(site_config, path, records, alerts):
+    site_name = site_config.get('SITE_NAME', '')
+    business_hours = _compile_business_hours(site_config)
+    # Alert files are per day, so every day starts without alerts
+    previous_state = dict(hardware_monitor.HARDWARE_TRIGGER_DEFAULTS)
+
+    def capture(**kwargs):
+        metric = kwargs['metric']
+        key, default = HARDWARE_THRESHOLD_KEYS.get(metric, (None, None))
+        alerts.append({
+            "site": site_name,
+            "metric": metric,
+            "timestamp": kwargs['scoped_time_stamp'],
+            "value": kwargs['metric_measure'],
+            "threshold": site_config.get(key, default) if key else None,
+            "source_file": path,
+        })
+
+    for record in records:
+        if not is_alerting_time(record['timestamp'], business_hours):
+            continue
+        metric_map = hardware_monitor.evaluate_hardware_sample(record, site_config)
+        for metric in HARDWARE_ALERT_METRICS:
+            hardware_monitor.evaulate_metric(previous_state, metric_map, metric, path, site_config, notify=capture)
+        previous_state = metric_map
+
+
+def replay_ping(site_config, path, records, alerts):
+    # As evaluate_ping: a failed ping alerts unless the previous one failed too
+    site_name = site_config.get('SITE_NAME', '')
+    business_hours = _compile_business_hours(site_config)
+    alarm_triggered = False
+
+    for record in records:
+        if not is_alerting_time(record['timestamp'], business_hours):
+            continue
+        url_accessed = record.get('status') == 'success'
+        if not url_accessed and not alarm_triggered:
+            alerts.append({
+                "site": site_name,
+                "metric": "ping",
+                "timestamp": record['timestamp'],
+                "value": record.get('status_code') or record.get('error'),
+                "threshold": None,
+                "source_file": path,
+            })
+        alarm_triggered = not url_accessed
+
+
+def replay_nginx(site_config, path, records, alerts, window):
+    # As record_nginx_metrics and evaluate_nginx_alerts, evaluated as each bucket completes
+    site_name = site_config.get('SITE_NAME', '')
+    if not site_config.get('NGINX_ALERTS', True):
+        return
+
+    business_hours = _compile_business_hours(site_config)
+    bucket_seconds = site_config.get('NGINX_BUCKET_SECONDS', 60)
+    window_seconds = site_config.get('NGINX_ALERT_WINDOW', 300)
+    thresholds = nginx.get_nginx_thresholds(site_config)
+    previous_state = dict(nginx.NGINX_TRIGGER_DEFAULTS)
+
+    for record in records:
+        evaluated_at = record['timestamp'] + bucket_seconds
+        cutoff = evaluated_at - window_seconds
+        nginx.add_to_alert_window(window, [record])
+        nginx.expire_alert_window(window, cutoff)
+        if not is_alerting_time(evaluated_at, business_hours):
+            continue
+
+        window_metrics = nginx.get_window_metrics(window, {}, cutoff)
+        window_metrics["timestamp"] = evaluated_at
+        metric_map = nginx.evaluate_nginx_window(window_metrics, site_config)
+        for metric in nginx.NGINX_ALERT_METRICS:
+            if metric_map[f'{metric}_exceeded'] and not previous_state.get(f'{metric}_exceeded'):
+                alerts.append({
+                    "site": site_name,
+                    "metric": metric,
+                    "timestamp": evaluated_at,
+                    "value": metric_map[metric],
+                    "threshold": thresholds[metric],
+                    "source_file": path,
+                })
+        previous_state = metric_map
+
+
+def replay_site(site_config, metrics, roots, start_date, end_date, on_summary):
+    '''
+    Stream a site's days through the alerting logic. Returns the
+    captured alerts and the records read and alerts raised per metric.
+    '''
+    site_name = site_config.get('SITE_NAME', '')
+    alerts = []
+    counts = {}
+
+    for metric in metrics:
+        counts[metric] = {"records": 0, "alerts": 0}
+        alerts_before = len(alerts)
+        window = nginx.new_alert_window()
+        for date_string, path in find_day_files(roots, site_name, metric, start_date, end_date):
+            records = read_day_file(path)
+            counts[metric]["records"] += len(records)
+
+            if metric == 'hardware':
+                replay_hardware(site_config, path, records, alerts)
+            elif metric == 'ping':
+                replay_ping(site_config, path, records, alerts)
+            else:
+                replay_nginx(site_config, path, records, alerts, window)
+
+            summary = new_summary(metric, date_string)
+            for record in records:
+                fold_record(summary, metric, record)
+            on_summary(site_name, metric, date_string, summary)
+
+        counts[metric]["alerts"] = len(alerts) - alerts_before
+
+    return alerts, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sites', nargs='*', help="Sites to replay, defaults to every configured site")
+    parser.add_argument('--metrics', nargs='*', default=METRICS, choices=METRICS)
+    parser.add_argument('--start', type=datetime.date.fromisoformat, help="First day, YYYY-MM-DD")
+    parser.add_argument('--end', type=datetime.date.fromisoformat, help="Last day, YYYY-MM-DD")
+    parser.add_argument('--set', dest='overrides', type=parse_override, action='append', default=[], help="Config override, e.g. RAM_USAGE_MAX_THRESH_HOLD=70")
+    parser.add_argument('--source', action='append', default=[], help="Extra folder of archived results, laid out like results/")
+    parser.add_argument('--summaries-dir', default='replay', help="Where regenerated summaries are written")
+    parser.add_argument('--backfill', action='store_true', help="Write summaries of past days to results/ instead")
+    parser.add_argument('--output', help="Write the would-be alerts as JSON to this file")
+    args = parser.parse_args()
+
+    roots = [os.path.join(get_base_dir(), 'results')] + args.source
+    overrides = dict(args.overrides)
+    site_names = args.sites or [site_config.get('SITE_NAME', '') for site_config in get_site_configs()]
+    today = datetime.date.today().strftime("%Y_%m_%d")
+
+    def on_summary(site_name, metric, date_string, summary):
+        if args.backfill:
+            # Today's summary belongs to the running collector
+            if date_string != today:
+                write_summary(get_summary_file(site_name, metric, date_string), summary)
+        else:
+            write_summary(os.path.join(args.summaries_dir, site_name, 'summaries', f'{metric}_summary_{date_string}.json'), summary)
+
+    started = time.perf_counter()
+    all_alerts = []
+    total_records = 0
+
+    # Per sample logging of the evaluation would dominate the run time
+    logging.disable(logging.INFO)
+    try:
+        for site_name in site_names:
+            site_config = {**get_site_config(site_name), **overrides}
+            alerts, counts = replay_site(site_config, args.metrics, roots, args.start, args.end, on_summary)
+            all_alerts += alerts
+            for metric, count in counts.items():
+                total_records += count["records"]
+                print(f"{site_name:<20} {metric:<9} {count['records']:>10,} records {count['alerts']:>6,} alerts")
+    finally:
+        logging.disable(logging.NOTSET)
+
+    elapsed = time.perf_counter() - started
+    print(f"Replayed {total_records:,} records in {elapsed:.2f}s ({total_records / max(elapsed, 1e-9):,.0f} records/s), {len(all_alerts):,} alerts")
+    logging.info(f"Replayed {total_records} records of {len(site_names)} sites with overrides {overrides}: {len(all_alerts)} alerts")
+
+    for alert in all_alerts:
+        alert["time"] = datetime.datetime.fromtimestamp(alert["timestamp"]).isoformat(timespec='seconds')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({"overrides": overrides, "records": total_records, "alerts": all_alerts}, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,32 @@
 import datetime
 import logging
-from graph_generator import generate_graphs_for_daily_report
-from mailer import send_email
-from utils import current_time_within_business_hours, get_abs_path, get_latest_json_file, get_config
-import os
+from daily_summary import get_hardware_breakdown, get_nginx_breakdown, get_ping_breakdown, load_summary
+from forecast import FORECAST_METRICS, load_forecasts
+from graph_generator import generate_graphs_for_daily_report, generate_nginx_graphs_for_daily_report, get_datetime_string_from_timestamp, warm_renderer
+from log_pipeline import setup_logging
+from mailer import build_message, send_email, send_messages
+from utils import current_time_within_business_hours, get_abs_path, get_base_dir, get_latest_json_file, get_config, get_site_config
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
 import json
-import sys
-
-
-log_file = 'logs/daily_report.log'
-log_file = get_abs_path(log_file)
-config_file = 'config/config.json'
-config_file = get_abs_path(config_file)
-
-logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+import os
 
 
-with open(config_file) as config_file:
-    conf = json.load(config_file)
+conf = get_config()
 
 
-def generate_report(site_name, last_n_items=None):
-    ping_skipped = conf.get('EXCLUDE_PING_FROM_REPORTING')
-    hardware_skipped = conf.get('EXCLUDE_HARDWARE_CHECK_FROM_REPORTING')
+def build_report(site_name, last_n_items=None):
+    '''
+    Render the graphs and compose the report email for a site.
+    Returns a dict of send_email arguments, or None if skipped.
+    '''
+    site_conf = get_site_config(site_name)
+    ping_skipped = site_conf.get('EXCLUDE_PING_FROM_REPORTING')
+    hardware_skipped = site_conf.get('EXCLUDE_HARDWARE_CHECK_FROM_REPORTING')
+    nginx_skipped = site_conf.get('EXCLUDE_NGINX_FROM_REPORTING')
     stats_breakdown = ""
 
-    if not current_time_within_business_hours(check_working_days_only=True) and last_n_items is None:
+    if not current_time_within_business_hours(check_working_days_only=True, site_name=site_name) and last_n_items is None:
         logging.info(
             "Skipping Daily Report: " +
             f"{str(datetime.datetime.now().strftime('%a'))} outside working week."
@@ -45,17 +46,57 @@ def generate_report(site_name, last_n_items=None):
     if hardware_source_file:
         hardware_source_file = get_abs_path(hardware_source_file)
 
+    # Most sites don't tail nginx, get_latest_json_file would create the folder for them
+    nginx_folder = os.path.join(get_base_dir(), 'results', site_name, 'nginx_metrics')
+    nginx_source_file = get_latest_json_file(site_name, 'nginx') if not nginx_skipped and os.path.exists(nginx_folder) else None
+
     logging.info(f"Generating Daily Report for {site_name}")
     logging.info(f"Ping Source File: {ping_source_file}")
     logging.info(f"Hardware Source File: {hardware_source_file}")
 
+    # The daily breakdown comes from the collectors' running summaries.
+    # Recent activity reports average the last n items they graph instead:
+    # summaries only hold whole day totals, and the day file is read for the
+    # graph either way, so the averages over those items cost one more pass.
+    ping_summary = None
+    hardware_summary = None
+    if last_n_items is None:
+        ping_summary = load_summary(site_name, 'ping') if not ping_skipped else None
+        hardware_summary = load_summary(site_name, 'hardware') if not hardware_skipped else None
+    # Only average the day files when a summary is missing
+    with_breakdown = bool(ping_source_file and not ping_summary) or bool(hardware_source_file and not hardware_summary)
+
     logging.info("Generating Graphs for Daily Report")
     hardware_attachment, ping_attachment, stats = generate_graphs_for_daily_report(
         site_name=site_name,
         hardware_source_file=hardware_source_file,
         ping_source_file=ping_source_file,
-        last_n_items=last_n_items
+        last_n_items=last_n_items,
+        with_breakdown=with_breakdown
     )
+    if ping_summary:
+        stats['ping'] = get_ping_breakdown(ping_summary)
+    if hardware_summary:
+        stats['hardware'] = get_hardware_breakdown(hardware_summary)
+
+    nginx_attachments = []
+    top_routes = []
+    if nginx_source_file:
+        from nginx import get_nginx_thresholds, load_top_routes
+
+        logging.info(f"nginx Source File: {nginx_source_file}")
+        top_routes = load_top_routes(site_name)
+        nginx_attachments = generate_nginx_graphs_for_daily_report(
+            site_name=site_name,
+            nginx_source_file=nginx_source_file,
+            top_routes=top_routes,
+            last_n_items=last_n_items,
+            thresholds=get_nginx_thresholds(site_conf)
+        )
+        # The day's breakdown would disagree with the last n items graphed
+        nginx_summary = load_summary(site_name, 'nginx') if last_n_items is None else None
+        if nginx_summary:
+            stats['nginx'] = get_nginx_breakdown(nginx_summary)
     logging.info("Graphs Generated Successfully")
 
     logging.info("Preparing Email Body")
@@ -65,6 +106,7 @@ def generate_report(site_name, last_n_items=None):
     ram_use_avg = hardware_avg.get('ram_usage_avg') if hardware_avg else 0.0
     load_last_10_mins_avg = hardware_avg.get('load_last_10_mins_avg') if hardware_avg else 0.0
     cpu_usage_avg = hardware_avg.get('cpu_usage_avg') if hardware_avg else 0.0
+    peaks = hardware_avg.get('peaks', {}) if hardware_avg else {}
     
     if not ping_skipped:
         stats_breakdown += f"Average Ping Success: {avg_ping} %.\n"
@@ -75,6 +117,48 @@ def generate_report(site_name, last_n_items=None):
             f"Load Avg (10 Min): {load_last_10_mins_avg}.\n"
             f"Average CPU Usage: {cpu_usage_avg} %.\n"
         )
+        for metric, label in [('cpu_usage', 'CPU Usage'), ('ram_usage_percentage', 'RAM Usage'), ('disk_usage', 'Disk Usage')]:
+            peak = peaks.get(metric)
+            if peak and peak.get('timestamp'):
+                stats_breakdown += f"Peak {label}: {round(peak['value'], 2)} % at {get_datetime_string_from_timestamp(peak['timestamp'])}.\n"
+
+        if site_conf.get('FORECASTING', False):
+            forecasts = load_forecasts(site_name, site_conf.get('FORECAST_MIN_HOURS', 24))
+            for metric, label in FORECAST_METRICS.items():
+                projection = forecasts.get(metric)
+                if not projection:
+                    continue
+                if projection['hours_to_full'] is None:
+                    stats_breakdown += f"{label} Forecast: not growing ({projection['growth_per_day']} % a day).\n"
+                else:
+                    stats_breakdown += (
+                        f"{label} Forecast: full in {round(projection['hours_to_full'] / 24, 1)} days "
+                        f"at {projection['growth_per_day']} % a day.\n"
+                    )
+
+    nginx_stats = stats.get('nginx')
+    if nginx_stats:
+        status_classes = ', '.join(f"{status_class}: {count}" for status_class, count in sorted(nginx_stats['status_classes'].items()))
+        stats_breakdown += (
+            f"nginx Requests: {nginx_stats['total_requests']} ({status_classes}).\n"
+            f"nginx Failure Rate: {nginx_stats['failure_rate']} %.\n"
+        )
+        if nginx_stats.get('request_time_p99') is not None:
+            stats_breakdown += (
+                f"nginx Request Time p50/p95/p99: {nginx_stats['request_time_p50']} / "
+                f"{nginx_stats['request_time_p95']} / {nginx_stats['request_time_p99']} ms.\n"
+            )
+        peak = nginx_stats['peaks'].get('failure_rate')
+        if peak and peak.get('timestamp'):
+            stats_breakdown += f"Peak nginx Failure Rate: {round(peak['value'], 2)} % at {get_datetime_string_from_timestamp(peak['timestamp'])}.\n"
+        nginx_alerts = load_nginx_alert_counts(site_name)
+        if nginx_alerts:
+            stats_breakdown += (
+                f"nginx Failure Rate Alerts: {nginx_alerts.get('failure_rate_trigger_count', 0)}.\n"
+                f"nginx p99 Latency Alerts: {nginx_alerts.get('request_time_p99_trigger_count', 0)}.\n"
+            )
+        for route in top_routes[:5]:
+            stats_breakdown += f"Top Route: {route['route']} ({route['count']} requests).\n"
 
     subject = f"Daily Report for {site_name}" if not last_n_items else f"Recent Activity Report for {site_name} (Last {last_n_items} Items)."
     
@@ -84,20 +168,105 @@ def generate_report(site_name, last_n_items=None):
         f"{stats_breakdown}\n"
     )
 
-    attachments = [ping_attachment, hardware_attachment]
+    attachments = [ping_attachment, hardware_attachment] + nginx_attachments
 
-    logging.info("Sending Email")
-    logging.info(f"Subject: {subject}")
-    logging.info(f"Body: {body}")
-    
-    mailing_list = conf.get('MAILING_LIST')
+    mailing_list = site_conf.get('MAILING_LIST')
     
     logging.info(f"Confirmed Mailing List {str(mailing_list)}")
 
-    send_email(mailing_list, subject=subject, body=body, attachments=attachments)
+    return {
+        "recipients": mailing_list,
+        "subject": subject,
+        "body": body,
+        "attachments": attachments,
+    }
+
+
+def load_nginx_alert_counts(site_name):
+    date_string = datetime.date.today().strftime("%Y_%m_%d")
+    alert_file = os.path.join(get_base_dir(), 'alert_status', site_name, 'nginx_alert_status', f'alert_status_{date_string}.json')
+    if not os.path.exists(alert_file):
+        return None
+
+    with open(alert_file) as file:
+        return json.load(file)
+
+
+def generate_report(site_name, last_n_items=None):
+    report = build_report(site_name, last_n_items)
+    if not report:
+        return
+
+    logging.info("Sending Email")
+    send_email(**report)
+
+
+def discover_sites():
+    results_folder = os.path.join(get_base_dir(), 'results')
+    if not os.path.exists(results_folder):
+        return []
+
+    return sorted(
+        entry.name for entry in os.scandir(results_folder)
+        if entry.is_dir() and any(
+            os.path.isdir(os.path.join(entry.path, sub_folder)) for sub_folder in ['ping_metrics', 'hardware_metrics']
+        )
+    )
+
+
+def _build_site_report(site_name, last_n_items):
+    try:
+        return site_name, build_report(site_name, last_n_items)
+    except Exception as e:
+        logging.exception(f"Report for {site_name} failed: {e}")
+        return site_name, None
+
+
+def generate_reports(site_names=None, last_n_items=None, workers=None):
+    '''
+    Build reports for many sites in a process pool. Each worker keeps
+    one warm kaleido renderer for all the sites it handles, and the
+    emails go out over a single SMTP session from this process.
+    '''
+    site_names = site_names if site_names is not None else discover_sites()
+    if not site_names:
+        logging.info("No sites found to report on")
+        return
+
+    workers = workers or conf.get('REPORT_WORKERS') or os.cpu_count() or 1
+    workers = min(workers, len(site_names))
+    logging.info(f"Generating reports for {len(site_names)} sites with {workers} workers")
+
+    messages = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=warm_renderer) as executor:
+        futures = [executor.submit(_build_site_report, site_name, last_n_items) for site_name in site_names]
+        for future in as_completed(futures):
+            site_name, report = future.result()
+            if report:
+                messages.append(build_message(**report))
+            else:
+                logging.info(f"No report sent for {site_name}")
+
+    logging.info(f"Sending {len(messages)} report emails")
+    send_messages(messages)
 
 
 if __name__ == "__main__":
-    site_name = sys.argv[1] if len(sys.argv) > 1 else conf.get('SITE_NAME')
-    last_n_items = int(sys.argv[2]) if len(sys.argv) > 2 else None
-    generate_report(site_name, last_n_items)
\ No newline at end of file
+    log_file = 'logs/daily_report.log'
+    log_file = get_abs_path(log_file)
+
+    setup_logging(log_file)
+
+    parser = argparse.ArgumentParser(description="Generate and email site reports")
+    parser.add_argument('site_name', nargs='?', default=conf.get('SITE_NAME'))
+    parser.add_argument('last_n_items', nargs='?', type=int, default=None)
+    parser.add_argument('--all', action='store_true', help="Report on every site found under results/")
+    parser.add_argument('--last-n-items', type=int, default=None, dest='last_n_items_option')
+    parser.add_argument('--workers', type=int, default=None, help="Number of report worker processes")
+    args = parser.parse_args()
+    last_n_items = args.last_n_items_option if args.last_n_items_option is not None else args.last_n_items
+
+    if args.all or not args.site_name:
+        generate_reports(last_n_items=last_n_items, workers=args.workers)
+    else:
+        generate_report(args.site_name, last_n_items)
\ No newline at end of file
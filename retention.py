@@ -0,0 +1,156 @@
+import heapq
+import logging
+import os
+import time
+
+from utils import get_config
+
+
+EXPORTS_ROOT = os.path.join('exports', 'images')
+
+MB = 1024 * 1024
+
+# Running byte totals per folder from the last scan plus any exports
+# recorded since. While the ledger is fresh and within budget, pruning
+# is a dictionary lookup instead of a directory walk.
+_ledger = {
+    "scanned_at": None,
+    "folders": {},
+    "total": 0,
+}
+
+
+def get_retention_budgets():
+    config = get_config()
+    max_exports_size = config.get('MAX_EXPORTS_SIZE')
+    return {
+        # in MB, applied to every folder under exports/images
+        "folder": config.get('MAX_FOLDER_SIZE', 1000) * MB,
+        # in MB, applied to exports/images as a whole
+        "total": max_exports_size * MB if max_exports_size else None,
+        "rescan_interval": config.get('RETENTION_RESCAN_INTERVAL', 3600),
+    }
+
+
+def record_export(path):
+    '''
+    Add a newly written file to the ledger so the next
+    prune can skip the scan while still under budget
+    '''
+    if _ledger["scanned_at"] is None:
+        return
+
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return
+
+    folder = os.path.dirname(path)
+    _ledger["folders"][folder] = _ledger["folders"].get(folder, 0) + size
+    _ledger["total"] += size
+
+
+def _ledger_within_budget(budgets):
+    if _ledger["scanned_at"] is None:
+        return False
+
+    if time.time() - _ledger["scanned_at"] > budgets["rescan_interval"]:
+        return False
+
+    if budgets["total"] is not None and _ledger["total"] > budgets["total"]:
+        return False
+
+    return all(size <= budgets["folder"] for size in _ledger["folders"].values())
+
+
+def scan_exports(root=EXPORTS_ROOT):
+    '''
+    Walk root once with os.scandir.
+    Returns {folder: [(mtime, size, path), ...]}
+    '''
+    folders = {}
+    pending = [root]
+
+    while pending:
+        folder = pending.pop()
+        try:
+            entries = os.scandir(folder)
+        except FileNotFoundError:
+            continue
+
+        with entries:
+            files = []
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        if files:
+            folders[folder] = files
+
+    return folders
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    logging.info(f"Deleted file: {path}")
+
+
+def prune_exports(root=EXPORTS_ROOT, force=False):
+    '''
+    Delete the oldest exports until every folder is within
+    MAX_FOLDER_SIZE and the whole tree within MAX_EXPORTS_SIZE.
+    Returns the number of files deleted.
+    '''
+    budgets = get_retention_budgets()
+
+    if not force and _ledger_within_budget(budgets):
+        logging.info("Exports within retention budget, skipping scan")
+        return 0
+
+    folders = scan_exports(root)
+    folder_sizes = {folder: sum(size for _, size, _ in files) for folder, files in folders.items()}
+    pruned_files_count = 0
+
+    # Per folder budget: pop oldest files off a min-heap on mtime
+    for folder, files in folders.items():
+        if folder_sizes[folder] <= budgets["folder"]:
+            continue
+
+        logging.info(f"{folder} size {folder_sizes[folder] / MB:.2f} MB exceeds maximum limit")
+        heapq.heapify(files)
+        while files and folder_sizes[folder] > budgets["folder"]:
+            _, size, path = heapq.heappop(files)
+            _remove(path)
+            folder_sizes[folder] -= size
+            pruned_files_count += 1
+
+    total_size = sum(folder_sizes.values())
+
+    # Global budget: oldest first across all remaining files
+    if budgets["total"] is not None and total_size > budgets["total"]:
+        logging.info(f"Exports size {total_size / MB:.2f} MB exceeds maximum limit")
+        remaining = [item for files in folders.values() for item in files]
+        heapq.heapify(remaining)
+        while remaining and total_size > budgets["total"]:
+            _, size, path = heapq.heappop(remaining)
+            _remove(path)
+            folder_sizes[os.path.dirname(path)] -= size
+            total_size -= size
+            pruned_files_count += 1
+
+    _ledger["scanned_at"] = time.time()
+    _ledger["folders"] = folder_sizes
+    _ledger["total"] = total_size
+
+    if pruned_files_count > 0:
+        logging.info(f"Pruned {pruned_files_count} files")
+    else:
+        logging.info("No files were pruned, exports are within the limit")
+
+    return pruned_files_count
@@ -0,0 +1,71 @@
+import array
+import threading
+
+
+def new_ring(fields, capacity):
+    '''
+    Fixed size buffer of readings, one array of doubles per field.
+    The first field is the timestamp. Once full the oldest reading
+    is overwritten, so memory stays at capacity x fields x 8 bytes.
+    '''
+    return {
+        "fields": list(fields),
+        "capacity": capacity,
+        "columns": {field: array.array('d', bytes(8 * capacity)) for field in fields},
+        # Index the next reading is written to
+        "head": 0,
+        "count": 0,
+        "lock": threading.Lock(),
+    }
+
+
+def ring_append(ring, values):
+    with ring["lock"]:
+        head = ring["head"]
+        for field, column in ring["columns"].items():
+            column[head] = values.get(field) or 0.0
+        ring["head"] = (head + 1) % ring["capacity"]
+        ring["count"] = min(ring["count"] + 1, ring["capacity"])
+
+
+def _indices(ring):
+    # Oldest to newest
+    capacity, count = ring["capacity"], ring["count"]
+    start = (ring["head"] - count) % capacity
+    return [(start + offset) % capacity for offset in range(count)]
+
+
+def ring_window(ring, start=None, end=None):
+    '''
+    Readings with start < timestamp <= end as dicts, oldest first
+    '''
+    timestamp_field = ring["fields"][0]
+    with ring["lock"]:
+        columns = ring["columns"]
+        timestamps = columns[timestamp_field]
+        return [
+            {field: columns[field][index] for field in ring["fields"]}
+            for index in _indices(ring)
+            if (start is None or timestamps[index] > start) and (end is None or timestamps[index] <= end)
+        ]
+
+
+def ring_aggregate(ring, start, end=None):
+    '''
+    min/max/mean/last of every field over the readings with
+    start < timestamp <= end, None when there are none
+    '''
+    readings = ring_window(ring, start, end)
+    if not readings:
+        return None
+
+    aggregates = {"count": len(readings)}
+    for field in ring["fields"][1:]:
+        values = [reading[field] for reading in readings]
+        aggregates[field] = {
+            "min": min(values),
+            "max": max(values),
+            "mean": sum(values) / len(values),
+            "last": values[-1],
+        }
+    return aggregates
@@ -0,0 +1,65 @@
+import logging
+import threading
+
+
+# Base interval key of each check
+INTERVAL_KEYS = {
+    'hardware': 'HARDWARE_CHECK_INTERVAL',
+    'ping': 'PING_INTERVAL',
+}
+
+# Current interval and last values per (check, site)
+_intervals = {}
+_previous_values = {}
+_lock = threading.Lock()
+
+
+def get_interval_bounds(site_config, kind):
+    '''
+    Base, min and max interval of a site's check in seconds.
+    Min and max default to a sixth and five times the base.
+    '''
+    prefix = kind.upper()
+    base = site_config.get(INTERVAL_KEYS[kind], 60)
+    low = site_config.get(f'{prefix}_MIN_INTERVAL', max(base / 6, 5))
+    high = site_config.get(f'{prefix}_MAX_INTERVAL', base * 5)
+    return base, min(low, base), max(high, base)
+
+
+def adapt_interval(site_config, kind, values, thresholds=None, failing=False):
+    '''
+    Seconds until the next check of a site. With ADAPTIVE_SAMPLING on, a
+    failing check or a value over its threshold drops to the min interval,
+    values within ADAPTIVE_NEAR_THRESHOLD % of their threshold shorten it,
+    and values that moved less than ADAPTIVE_STEADY_CHANGE since the last
+    check lengthen it up to the max. Otherwise the base interval is used.
+    '''
+    base, low, high = get_interval_bounds(site_config, kind)
+    if not site_config.get('ADAPTIVE_SAMPLING', False):
+        return base
+
+    thresholds = thresholds or {}
+    near = site_config.get('ADAPTIVE_NEAR_THRESHOLD', 90) / 100
+    steady_change = site_config.get('ADAPTIVE_STEADY_CHANGE', 2)
+    factor = site_config.get('ADAPTIVE_BACKOFF_FACTOR', 2)
+    key = (kind, site_config.get('SITE_NAME', ''))
+
+    with _lock:
+        current = _intervals.get(key, base)
+        previous = _previous_values.get(key)
+        _previous_values[key] = dict(values)
+
+        if failing or any(values.get(metric, 0) > threshold for metric, threshold in thresholds.items()):
+            interval = low
+        elif any(values.get(metric, 0) >= threshold * near for metric, threshold in thresholds.items()):
+            interval = max(min(current, base) / factor, low)
+        elif previous is not None and all(abs(value - previous.get(metric, value)) <= steady_change for metric, value in values.items()):
+            interval = min(max(current, base) * factor, high)
+        else:
+            interval = base
+
+        if interval != current:
+            logging.info(f"{kind} interval of {key[1]} changed from {current}s to {interval}s")
+        _intervals[key] = interval
+
+    return interval
@@ -0,0 +1,455 @@
+'''
+Fleet simulator for sizing a collector.
+
+Runs the real hardware and ping process_metrics loops and their alert
+paths against synthetic sources, in accelerated virtual time:
+
+* psutil readings come from a deterministic synthetic host whose RAM,
+  CPU and load spike now and then
+* every site is pinged at a local stub HTTP server with configurable
+  latency and outages
+* alert emails are captured instead of sent
+* results/, alert_status/, logs and config go to a scratch folder
+
+It reports checks completed against those due, how late each site's
+ticks ran, alerts raised and the collector's memory.
+
+    python simulator.py [--sites 200] [--speed 60] [--duration 3600] [--output sim.json]
+'''
+import argparse
+import datetime
+import http.server
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+
+import psutil
+
+import anomaly
+import daily_summary
+import forecast
+import hardware_monitor
+import ping_monitor
+import utils
+from instrumentation import get_stats_snapshot
+from log_pipeline import setup_logging
+
+
+class VirtualClock:
+    '''
+    Time that runs speed times faster than real time. Sleeps are
+    shortened to match, work done in between takes its real time.
+    '''
+    def __init__(self, speed, start=None):
+        self.speed = speed
+        self.start = start if start is not None else time.time()
+        self.real_start = time.monotonic()
+        self.stopped = threading.Event()
+
+    def time(self):
+        return self.start + (time.monotonic() - self.real_start) * self.speed
+
+    def sleep(self, seconds):
+        # Ends the collector loops once the simulation is over
+        if self.stopped.wait(max(seconds, 0) / self.speed):
+            raise SystemExit
+
+    def wait_futures(self, futures, timeout=None, return_when=None):
+        from concurrent.futures import wait
+
+        if self.stopped.is_set():
+            raise SystemExit
+        return wait(futures, timeout=None if timeout is None else timeout / self.speed, return_when=return_when)
+
+
+def make_time_module(clock):
+    module = types.ModuleType('time')
+    module.__dict__.update(time.__dict__)
+    module.time = clock.time
+    module.sleep = clock.sleep
+    module.strftime = lambda format, t=None: time.strftime(format, time.localtime(clock.time()) if t is None else t)
+    return module
+
+
+def make_datetime_module(clock):
+    class VirtualDate(datetime.date):
+        @classmethod
+        def today(cls):
+            return datetime.date.fromtimestamp(clock.time())
+
+    class VirtualDateTime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.datetime.fromtimestamp(clock.time(), tz)
+
+        @classmethod
+        def today(cls):
+            return datetime.datetime.fromtimestamp(clock.time())
+
+    module = types.ModuleType('datetime')
+    module.__dict__.update(datetime.__dict__)
+    module.date = VirtualDate
+    module.datetime = VirtualDateTime
+    return module
+
+
+def in_episode(seed, key, timestamp, period, rate):
+    '''
+    Whether key is inside an episode (outage, spike) at timestamp.
+    Each period is in one with probability rate, the same on every run.
+    '''
+    return rate > 0 and random.Random(f'{seed}:{key}:{int(timestamp // period)}').random() < rate
+
+
+class SyntheticHost:
+    '''
+    psutil shaped readings with a daily cycle, noise and spikes
+    '''
+    def __init__(self, clock, seed, spike_rate, spike_seconds):
+        self.clock = clock
+        self.seed = seed
+        self.spike_rate = spike_rate
+        self.spike_seconds = spike_seconds
+        self.cores = psutil.cpu_count() or 1
+
+    def reading(self):
+        now = self.clock.time()
+        rng = random.Random(f'{self.seed}:host:{int(now)}')
+        cycle = math.sin(2 * math.pi * (now % 86400) / 86400)
+        spiking = in_episode(self.seed, 'host', now, self.spike_seconds, self.spike_rate)
+        return now, rng, cycle, spiking
+
+    def get_cpu_usage(self, interval=1):
+        _, rng, cycle, spiking = self.reading()
+        return {"cpu_usage": 97.0 if spiking else round(30 + 15 * cycle + rng.uniform(-5, 5), 1)}
+
+    def get_ram_usage(self):
+        _, rng, cycle, spiking = self.reading()
+        total = 16 * 2**30
+        percent = 95.0 if spiking else round(55 + 10 * cycle + rng.uniform(-3, 3), 1)
+        return types.SimpleNamespace(percent=percent, used=total * percent / 100, free=total * (100 - percent) / 100)
+
+    def get_load_average(self):
+        _, rng, cycle, spiking = self.reading()
+        load = self.cores * (1.2 if spiking else 0.2 + 0.1 * cycle + rng.uniform(0, 0.05))
+        return {"Last 5 Mins": load, "Last 10 Mins": load, "Last 15 Mins": load}
+
+    def get_disk_usage(self):
+        now = self.clock.time()
+        # Fills by a gigabyte a day
+        used = 300 + (now - self.clock.start) / 86400
+        return {"used": round(used, 2), "free": round(500 - used, 2)}
+
+
+def start_stub_server(clock, seed, failure_rate, outage_seconds, latency_ms, jitter_ms):
+    '''
+    Answers /<site> with 200, or 503 while the site is in an outage,
+    after latency_ms +- jitter_ms of virtual time
+    '''
+    class StubHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            site_name = self.path.strip('/')
+            now = clock.time()
+            delay = max(latency_ms + random.uniform(-jitter_ms, jitter_ms), 0) / 1000
+            time.sleep(delay / clock.speed)
+
+            status = 503 if in_episode(seed, site_name, now, outage_seconds, failure_rate) else 200
+            self.send_response(status)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+
+        def log_message(self, format, *args):
+            pass
+
+    class StubServer(http.server.ThreadingHTTPServer):
+        daemon_threads = True
+        request_queue_size = 1024
+
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, name='stub-server', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def build_config(args, stub_url):
+    config = {key: value for key, value in utils.get_config().items() if key not in ('SITES', 'METRICS_PORT', 'AGGREGATOR_URL')}
+    config.update({
+        "SITE_NAME": "sim",
+        "PING_INTERVAL": args.ping_interval,
+        "HARDWARE_CHECK_INTERVAL": args.hardware_interval,
+        "PING_WORKERS": args.ping_workers,
+        "MAX_RETRY_ATTEMPTS": args.max_retries,
+        "ADAPTIVE_SAMPLING": args.adaptive,
+        "HIGH_RES_SAMPLING": args.high_res,
+        "ANOMALY_DETECTION": args.anomaly,
+        "FORECASTING": args.forecast,
+        # Around the clock, so every tick is due
+        "BUSINESS_DAY_START": "00:00",
+        "BUSINESS_DAY_END": "23:59",
+        "BUSINESS_WEEK_START": "MONDAY",
+        "BUSINESS_WEEK_END": "SUNDAY",
+        "SITES": [
+            {"SITE_NAME": f'sim-{index:04d}', "PING_URL": f'{stub_url}/sim-{index:04d}'}
+            for index in range(args.sites)
+        ],
+    })
+    return config
+
+
+class Recorder:
+    '''
+    Start times of every check against when it was due,
+    and the alerts raised, in virtual time
+    '''
+    def __init__(self, clock):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.starts = {'hardware': {}, 'ping': {}}
+        self.due = {'hardware': {}, 'ping': {}}
+        self.lateness = {'hardware': [], 'ping': []}
+        self.completed = {'hardware': 0, 'ping': 0}
+        self.notifications = []
+
+    def check_started(self, kind, site_name):
+        now = self.clock.time()
+        with self.lock:
+            due = self.due[kind].get(site_name)
+            if due is not None:
+                self.lateness[kind].append(max(now - due, 0))
+            self.starts[kind][site_name] = now
+
+    def check_completed(self, kind, site_name, interval):
+        # The collector schedules the next check interval seconds after this one
+        with self.lock:
+            self.completed[kind] += 1
+            self.due[kind][site_name] = self.starts[kind][site_name] + interval
+
+    def notify(self, kind, **kwargs):
+        with self.lock:
+            self.notifications.append({"kind": kind, "timestamp": self.clock.time(), "site_name": kwargs.get('site_name'), "metric": kwargs.get('metric', 'ping')})
+
+
+def install(clock, host, recorder, work_dir, args):
+    '''
+    Point the collector modules at the virtual clock,
+    synthetic sources, recorder and scratch folder
+    '''
+    virtual_time = make_time_module(clock)
+    virtual_datetime = make_datetime_module(clock)
+    for module in (hardware_monitor, ping_monitor, daily_summary, utils):
+        module.time = virtual_time
+        module.datetime = virtual_datetime
+    ping_monitor.wait = clock.wait_futures
+
+    # config/config.json and the summaries resolve into the scratch folder
+    utils.get_abs_path = lambda path: os.path.join(work_dir, path)
+    daily_summary.get_base_dir = lambda: work_dir
+    anomaly.get_base_dir = lambda: work_dir
+    forecast.get_base_dir = lambda: work_dir
+
+    # The collectors set up logs/ping.log on import, simulated sites stay out of it
+    os.makedirs(os.path.join(work_dir, 'logs'), exist_ok=True)
+    setup_logging(os.path.join(work_dir, 'logs', 'simulator.log'))
+
+    hardware_monitor.get_cpu_usage = host.get_cpu_usage
+    hardware_monitor.get_ram_usage = host.get_ram_usage
+    hardware_monitor.get_load_average = host.get_load_average
+    hardware_monitor.get_disk_usage = host.get_disk_usage
+
+    hardware_monitor.send_warning_email_for_metric = lambda **kwargs: recorder.notify('hardware', **kwargs)
+    ping_monitor.send_warning_email = lambda **kwargs: recorder.notify('ping', **kwargs)
+    anomaly.send_anomaly_email = lambda kind, **kwargs: recorder.notify('anomaly', **kwargs)
+    forecast.send_forecast_email = lambda **kwargs: recorder.notify('forecast', **kwargs)
+
+    process_site_sample = hardware_monitor.process_site_sample
+    probe_url = ping_monitor.probe_url
+    process_site_results = ping_monitor.process_site_results
+
+    def timed_site_sample(site_config, sample, date_string):
+        recorder.check_started('hardware', site_config.get('SITE_NAME'))
+        interval = process_site_sample(site_config, sample, date_string)
+        recorder.check_completed('hardware', site_config.get('SITE_NAME'), interval)
+        return interval
+
+    def timed_probe_url(url, max_retry_attempts=None):
+        recorder.check_started('ping', url.rsplit('/', 1)[-1])
+        return probe_url(url, max_retry_attempts)
+
+    def timed_site_results(site_config, url_accessed, results):
+        interval = process_site_results(site_config, url_accessed, results)
+        recorder.check_completed('ping', site_config.get('SITE_NAME'), interval)
+        return interval
+
+    hardware_monitor.process_site_sample = timed_site_sample
+    ping_monitor.probe_url = timed_probe_url
+    ping_monitor.process_site_results = timed_site_results
+
+
+def sample_memory(stopped, samples, interval=0.5):
+    process = psutil.Process()
+    while not stopped.is_set():
+        samples.append(process.memory_info().rss)
+        stopped.wait(interval)
+
+
+def summarize_lateness(values, interval):
+    if not values:
+        return {"ticks": 0}
+    values = sorted(values)
+    return {
+        "ticks": len(values),
+        "p50_s": round(values[len(values) // 2], 3),
+        "p95_s": round(values[int(len(values) * 0.95)], 3),
+        "max_s": round(values[-1], 3),
+        "mean_s": round(statistics.fmean(values), 3),
+        # A tick later than a tenth of the interval has slipped
+        "slipped_share": round(sum(value > interval / 10 for value in values) / len(values), 4),
+    }
+
+
+def run(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='health-sim-')
+    os.makedirs(os.path.join(work_dir, 'config'), exist_ok=True)
+
+    clock = VirtualClock(args.speed)
+    recorder = Recorder(clock)
+    host = SyntheticHost(clock, args.seed, args.spike_rate, args.spike_seconds)
+    server, stub_url = start_stub_server(clock, args.seed, args.failure_rate, args.outage_seconds, args.latency_ms, args.jitter_ms)
+
+    config = build_config(args, stub_url)
+    with open(os.path.join(work_dir, 'config', 'config.json'), 'w') as file:
+        json.dump(config, file, indent=4)
+
+    install(clock, host, recorder, work_dir, args)
+    logging.info(f"Starting fleet simulation of {args.sites} sites")
+    hardware_monitor.apply_config(utils.get_config())
+    ping_monitor.apply_config(utils.get_config())
+    hardware_monitor.start_high_res_sampler()
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    memory_samples = []
+    memory_stopped = threading.Event()
+    threading.Thread(target=sample_memory, args=(memory_stopped, memory_samples), daemon=True).start()
+
+    # results/ and alert_status/ are relative to the working directory
+    previous_dir = os.getcwd()
+    os.chdir(work_dir)
+    threads = [
+        threading.Thread(target=hardware_monitor.process_metrics, name='sim-hardware', daemon=True),
+        threading.Thread(target=ping_monitor.process_metrics, name='sim-ping', daemon=True),
+    ]
+    started = time.monotonic()
+    print(f"Simulating {args.sites} sites for {args.duration}s of virtual time at {args.speed}x in {work_dir}")
+    try:
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration / args.speed)
+    finally:
+        clock.stopped.set()
+        for thread in threads:
+            thread.join(timeout=30)
+        wall_seconds = time.monotonic() - started
+        memory_stopped.set()
+        server.shutdown()
+        os.chdir(previous_dir)
+
+    virtual_seconds = wall_seconds * args.speed
+    intervals = {'hardware': args.hardware_interval, 'ping': args.ping_interval}
+    completed = sum(recorder.completed.values())
+    report = {
+        "settings": vars(args),
+        "wall_seconds": round(wall_seconds, 2),
+        "virtual_seconds": round(virtual_seconds, 1),
+        "checks": {
+            kind: {
+                "completed": recorder.completed[kind],
+                # At the base interval, adaptive sampling runs fewer or more
+                "due": int(args.sites * virtual_seconds // intervals[kind]),
+                "lateness": summarize_lateness(recorder.lateness[kind], intervals[kind]),
+            }
+            for kind in intervals
+        },
+        "throughput": {
+            "checks_per_wall_second": round(completed / wall_seconds, 1),
+            "checks_per_virtual_second": round(completed / virtual_seconds, 2),
+        },
+        "notifications": {
+            kind: sum(notification["kind"] == kind for notification in recorder.notifications)
+            for kind in list(intervals) + ['anomaly', 'forecast']
+        },
+        "memory": {
+            "rss_start_mb": round(memory_samples[0] / 2**20, 1) if memory_samples else None,
+            "rss_peak_mb": round(max(memory_samples) / 2**20, 1) if memory_samples else None,
+            "rss_end_mb": round(memory_samples[-1] / 2**20, 1) if memory_samples else None,
+        },
+        "stages": {
+            name: {"count": timer["count"], "mean_ms": round(timer["mean_ms"], 3), "p95_ms": timer["p95_ms"], "max_ms": round(timer["max_ms"], 3)}
+            for name, timer in sorted(get_stats_snapshot()["timers"].items())
+        },
+    }
+    if args.tracemalloc:
+        report["memory"]["tracemalloc_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+        tracemalloc.stop()
+
+    if not args.work_dir and not args.keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def print_report(report):
+    print(f"{report['virtual_seconds']:.0f}s virtual in {report['wall_seconds']:.1f}s wall")
+    for kind, checks in report["checks"].items():
+        lateness = checks["lateness"]
+        print(
+            f"{kind:<9} {checks['completed']:>8,} of {checks['due']:>8,} due checks"
+            f"  late p95 {lateness.get('p95_s', 0):7.2f}s  max {lateness.get('max_s', 0):7.2f}s"
+            f"  slipped {lateness.get('slipped_share', 0) * 100:5.1f}%"
+            f"  alerts {report['notifications'][kind]}"
+        )
+    print(f"anomalies {report['notifications']['anomaly']}, forecasts {report['notifications']['forecast']}")
+    print(f"throughput {report['throughput']['checks_per_wall_second']:,.1f} checks/s wall")
+    print(f"memory rss start {report['memory']['rss_start_mb']} MB, peak {report['memory']['rss_peak_mb']} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sites', type=int, default=200)
+    parser.add_argument('--speed', type=float, default=60, help="Virtual seconds per real second")
+    parser.add_argument('--duration', type=float, default=3600, help="Virtual seconds to simulate")
+    parser.add_argument('--ping-interval', type=int, default=60)
+    parser.add_argument('--hardware-interval', type=int, default=60)
+    parser.add_argument('--ping-workers', type=int, default=8)
+    parser.add_argument('--max-retries', type=int, default=2, help="MAX_RETRY_ATTEMPTS of a failed ping")
+    parser.add_argument('--failure-rate', type=float, default=0.02, help="Share of outage periods per site")
+    parser.add_argument('--outage-seconds', type=int, default=600)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--spike-rate', type=float, default=0.05, help="Share of spike periods of the host")
+    parser.add_argument('--spike-seconds', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--adaptive', action='store_true', help="Turn ADAPTIVE_SAMPLING on for the simulated sites")
+    parser.add_argument('--high-res', action='store_true', help="Turn HIGH_RES_SAMPLING on, reading the host every virtual second")
+    parser.add_argument('--anomaly', action='store_true', help="Turn ANOMALY_DETECTION on for the simulated sites")
+    parser.add_argument('--forecast', action='store_true', help="Turn FORECASTING on for the simulated sites")
+    parser.add_argument('--tracemalloc', action='store_true', help="Also report the peak traced Python memory")
+    parser.add_argument('--work-dir', help="Keep results/ and alert_status/ here instead of a temporary folder")
+    parser.add_argument('--keep', action='store_true', help="Keep the temporary folder")
+    parser.add_argument('--output', help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=4)
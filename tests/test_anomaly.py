@@ -0,0 +1,20 @@
+import os
+
+import anomaly
+
+
+def get_site_config(site_name):
+    return {"SITE_NAME": site_name, "ANOMALY_DETECTION": True, "ANOMALY_PERSIST_INTERVAL": 0}
+
+
+def test_all_none_first_sample(tmp_path, monkeypatch):
+    monkeypatch.setattr(anomaly, 'get_state_file', lambda site_name: str(tmp_path / site_name / 'anomaly_state.json'))
+    site_config = get_site_config('down-from-start')
+
+    # A site whose pings fail from startup has no response time to learn from
+    assert anomaly.detect_anomalies(site_config, 'ping', {"response_time_ms": None}, 1_700_000_000) == []
+    assert not os.path.exists(anomaly.get_state_file('down-from-start'))
+
+    results = anomaly.detect_anomalies(site_config, 'ping', {"response_time_ms": 42.0}, 1_700_000_060)
+    assert [result["metric"] for result in results] == ['response_time_ms']
+    assert os.path.exists(anomaly.get_state_file('down-from-start'))
@@ -3,73 +3,173 @@ import multiprocessing
 import os
 import logging
 import datetime
+import signal
+import threading
 import time
 
-from graph_generator import generate_graphic, generate_graphs_for_daily_report, generate_hardware_graphic, get_datetime_string_from_timestamp
-from mailer import send_email
-
-
-logging.basicConfig(filename='logs/ping.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# graph_generator (plotly/kaleido) and mailer are imported inside the
+# functions that use them so collectors only load them when an alert fires.
+
+# Entry points call log_pipeline.setup_logging under __main__, after their
+# imports. Records from before then (the config load) are dropped rather
+# than logging.info() falling back to basicConfig and echoing to stderr.
+logging.getLogger().addHandler(logging.NullHandler())
+
+
+# Parsed config is cached and only re-read when config.json's mtime changes
+# or a reload is requested (SIGHUP). Values derived from it, such as the
+# business hours window, are compiled once per load.
+_config_state = {
+    "mtime": None,
+    "config": None,
+    "derived": None,
+    "reload_requested": False,
+}
+_config_listeners = []
+_config_lock = threading.RLock()
+
+DAYS_OF_WEEK = {
+    "MONDAY": 0,
+    "TUESDAY": 1,
+    "WEDNESDAY": 2,
+    "THURSDAY": 3,
+    "FRIDAY": 4,
+    "SATURDAY": 5,
+    "SUNDAY": 6
+}
 
 
 def get_config():
     path = get_abs_path('config/config.json')
-    if not os.path.exists(path):
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
         raise FileNotFoundError("Config file not found")
 
-    with open(path) as config_file:
-        config = json.load(config_file)
-    
-    return config
+    if _config_state["config"] is not None and not _config_state["reload_requested"] and mtime == _config_state["mtime"]:
+        return _config_state["config"]
+
+    with _config_lock:
+        if _config_state["config"] is None:
+            _load_config(path, mtime)
+        elif _config_state["reload_requested"] or mtime != _config_state["mtime"]:
+            _config_state["reload_requested"] = False
+            if _load_config(path, mtime):
+                for listener in list(_config_listeners):
+                    listener(_config_state["config"])
+
+    return _config_state["config"]
+
+
+def _load_config(path, mtime):
+    try:
+        with open(path) as config_file:
+            config = json.load(config_file)
+        derived = _compile_config(config)
+    except (json.JSONDecodeError, KeyError, ValueError) as e:
+        # Keep serving the last good config if the new one is invalid or mid-write
+        if _config_state["config"] is None:
+            raise
+        logging.error(f"Config file could not be loaded, keeping previous config: {e}")
+        _config_state["mtime"] = mtime
+        return False
 
+    _config_state["config"] = config
+    _config_state["derived"] = derived
+    _config_state["mtime"] = mtime
+    logging.info("Config loaded")
+    return True
 
-def prune_graphs(site_name):
-    config = get_config()
-    max_folder_size = config.get('MAX_FOLDER_SIZE', 1000)
-    logging.info(f"Pruning graphs for site: {site_name}")
-    # get site folder
-    site_folder = os.path.join('exports/images', site_name, 'ping_metrics')
 
-    # if folder does not exist return
-    if not os.path.exists(site_folder):
-        logging.warning(f"Site folder does not exist: {site_folder}")
-        return
+def _compile_business_hours(config):
+    week_start = DAYS_OF_WEEK[config.get('BUSINESS_WEEK_START', "MONDAY").upper()]
+    week_end = DAYS_OF_WEEK[config.get('BUSINESS_WEEK_END', "FRIDAY").upper()]
 
-    def get_folder_size(folder):
-        return sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f))) / (1024 * 1024)
+    return {
+        "business_day_start": datetime.datetime.strptime(config.get('BUSINESS_DAY_START', '08:00'), "%H:%M").time(),
+        "business_day_end": datetime.datetime.strptime(config.get('BUSINESS_DAY_END', '17:00'), "%H:%M").time(),
+        "business_week_days": frozenset(range(week_start, week_end + 1)),
+    }
 
-    folder_size = get_folder_size(site_folder)
-    logging.info(f"Initial folder size: {folder_size:.2f} MB")
 
-    pruned_files_count = 0
-    while folder_size > max_folder_size:
-        logging.info("Folder size exceeds maximum limit")
-        # sort files by modification time
-        files = sorted((f for f in os.listdir(site_folder) if os.path.isfile(os.path.join(site_folder, f))),
-                       key=lambda x: os.path.getmtime(os.path.join(site_folder, x)))
+def _expand_sites(config):
+    '''
+    Each entry in SITES inherits every top level setting it doesn't
+    override. Without SITES the top level config is the only site.
+    '''
+    shared = {key: value for key, value in config.items() if key != 'SITES'}
+    site_configs = [{**shared, **site} for site in config.get('SITES') or [{}]]
 
-        if not files:
-            break
+    for site_config in site_configs:
+        if not site_config.get('SITE_NAME') and config.get('SITES'):
+            raise ValueError("Every entry in SITES needs a SITE_NAME")
 
-        # delete the oldest file
-        oldest_file = files[0]
-        os.remove(os.path.join(site_folder, oldest_file))
-        logging.info(f"Deleted file: {oldest_file}")
-        pruned_files_count += 1
-        folder_size = get_folder_size(site_folder)
+    return site_configs
 
-    if pruned_files_count > 0:
-        logging.info(f"Pruned {pruned_files_count} files")
-    else:
-        logging.info("No files were pruned, folder size is within the limit")
 
-    # clear all metrics files
-    metrics_folder = os.path.join('exports/images', site_name, 'hardware_metrics')
-    for metric in ['cpu_usage', 'disk_usage', 'ram_usage', 'system_metrics']:
-        sub_folder = os.path.join(metrics_folder, metric)
-        if os.path.exists(sub_folder):
-            for file in os.listdir(sub_folder):
-                os.remove(os.path.join(sub_folder, file))
+def _compile_config(config):
+    sites = {}
+    for site_config in _expand_sites(config):
+        sites[site_config.get('SITE_NAME', '')] = {
+            "config": site_config,
+            **_compile_business_hours(site_config),
+        }
+
+    return {
+        **_compile_business_hours(config),
+        "sites": sites,
+    }
+
+
+def get_derived_config(site_name=None):
+    get_config()
+    derived = _config_state["derived"]
+    if site_name is not None and site_name in derived["sites"]:
+        return derived["sites"][site_name]
+    return derived
+
+
+def get_site_configs():
+    '''
+    Merged config of every monitored site
+    '''
+    return [site["config"] for site in get_derived_config()["sites"].values()]
+
+
+def get_site_config(site_name):
+    site = get_derived_config()["sites"].get(site_name)
+    if site is None:
+        return {**get_config(), 'SITE_NAME': site_name}
+    return site["config"]
+
+
+def on_config_reload(listener):
+    '''
+    Register a callable to receive the new config dict
+    whenever config.json is reloaded
+    '''
+    _config_listeners.append(listener)
+
+
+def request_config_reload(*_):
+    _config_state["reload_requested"] = True
+
+
+def install_config_reload_signal():
+    '''
+    Reload config on SIGHUP. The reload is applied on the
+    next get_config call rather than inside the handler.
+    '''
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, request_config_reload)
+
+
+def prune_graphs(site_name):
+    from retention import prune_exports
+
+    logging.info(f"Pruning graphs for site: {site_name}")
+    # Budgets apply across all of exports/images, not just this site
+    prune_exports()
 
 
 def get_latest_graphic(site_name, metric, metric_param=None):
@@ -127,6 +227,9 @@ def send_warning_email(site_name,
                        metrics_map=None,
                        last_trigger_time=None
                        ):
+    from graph_generator import generate_graphic, get_datetime_string_from_timestamp
+    from mailer import send_email
+
     issues = []
     subject = ""
     attachments = []
@@ -206,44 +309,34 @@ def get_latest_json_file(site_name, metric):
 def get_abs_path(path):
     return os.path.join(os.path.dirname(__file__), path)
 
-def current_time_within_business_hours(check_working_days_only=False):
-    conf = get_config()
-    business_starting_hour = conf.get('BUSINESS_DAY_START', '08:00')
-    business_finishing_hour = conf.get('BUSINESS_DAY_END', '17:00')
-    business_weekstart_day = conf.get('BUSINESS_WEEK_START', "MONDAY")
-    business_weekend_day = conf.get('BUSINESS_WEEK_END', "FRIDAY")
-
-    # Return false if day outside business week
-    days_of_week = {
-        "MONDAY": 0,
-        "TUESDAY": 1,
-        "WEDNESDAY": 2,
-        "THURSDAY": 3,
-        "FRIDAY": 4,
-        "SATURDAY": 5,
-        "SUNDAY": 6
-    }
+def current_time_within_business_hours(check_working_days_only=False, site_name=None):
+    return within_business_hours(datetime.datetime.today(), get_derived_config(site_name), check_working_days_only)
 
-    current_day = datetime.datetime.today().weekday()
-    current_time = datetime.datetime.today().time()
 
-    week_start = days_of_week[business_weekstart_day.upper()]
-    week_end = days_of_week[business_weekend_day.upper()]
-
-    # Check if the current day is within the business week
-    if not (week_start <= current_day <= week_end):
+def within_business_hours(moment, business_hours, check_working_days_only=False):
+    # Return false if day outside business week
+    if moment.weekday() not in business_hours["business_week_days"]:
         return False
 
     if check_working_days_only:
         return True
 
-    business_starting_hour = datetime.datetime.strptime(business_starting_hour, "%H:%M").time()
-    business_finishing_hour = datetime.datetime.strptime(business_finishing_hour, "%H:%M").time()
+    return business_hours["business_day_start"] <= moment.time() <= business_hours["business_day_end"]
+
+
+def ensure_alert_file(alert_file, defaults):
+    if os.path.exists(alert_file):
+        return
+
+    if not os.path.exists(os.path.dirname(alert_file)):
+        os.makedirs(os.path.dirname(alert_file))
 
-    return business_starting_hour <= current_time <= business_finishing_hour
+    logging.info(f'Alert file {alert_file} not found. Creating...')
+    with open(alert_file, 'w') as file:
+        json.dump(defaults, file, indent=4)
 
 
-def update_alert_file(alertFile, alert_triggered=None, hardware_metrics=None):
+def update_alert_file(alertFile, alert_triggered=None, hardware_metrics=None, nginx_metrics=None):
     logging.info(f"Updating alert file: {alertFile}")
     if not os.path.exists(os.path.dirname(alertFile)):
         os.makedirs(os.path.dirname(alertFile))
@@ -252,19 +345,24 @@ def update_alert_file(alertFile, alert_triggered=None, hardware_metrics=None):
         data = json.load(file)
         time_stamp = time.time()
         
-        if hardware_metrics:
-            logging.info("Updating hardware metrics on alert file.")
+        if hardware_metrics or nginx_metrics:
+            logging.info(f"Updating {'hardware' if hardware_metrics else 'nginx'} metrics on alert file.")
+            metrics_map = hardware_metrics or nginx_metrics
+            metrics = ['load_avg_last_10_mins', 'ram_usage', 'disk_usage'] if hardware_metrics else ['failure_rate', 'request_time_p99']
+            # nginx is checked every few seconds, so its breaches are counted once each
+            count_every_check = bool(hardware_metrics)
             # Update trigger counts and states in a loop to reduce redundancy
-            for metric in ['load_avg_last_10_mins', 'ram_usage', 'disk_usage']:
+            for metric in metrics:
                 # Logging trigger counts
-                data[f"{metric}_trigger_count"] += 1 if hardware_metrics.get(f'{metric}_exceeded') else 0
+                if metrics_map.get(f'{metric}_exceeded') and (count_every_check or not data.get(f"{metric}_exceeded")):
+                    data[f"{metric}_trigger_count"] += 1
                 # Logging time
-                if hardware_metrics.get(f'{metric}_exceeded'):
+                if metrics_map.get(f'{metric}_exceeded'):
                     data[f"{metric}_last_trigger_time"] = time_stamp
                 # Setting New States
-                data[f"{metric}_exceeded"] = hardware_metrics.get(f'{metric}_exceeded')
+                data[f"{metric}_exceeded"] = metrics_map.get(f'{metric}_exceeded')
                 # Setting Metrics
-                data[f"{metric}"] = hardware_metrics.get(metric)
+                data[f"{metric}"] = metrics_map.get(metric)
         else:
             logging.info("Updating ping metrics on alert file.")
             data['alarm_triggered'] = alert_triggered
@@ -285,8 +383,13 @@ def send_warning_email_for_metric(site_name,
                        metric_measure,
                        previous_alert_data,
                        source_file,
-                       scoped_time_stamp
+                       scoped_time_stamp,
+                       raw_source_file=None,
+                       process_source_file=None
                        ):
+    from graph_generator import generate_graphs_for_daily_report, generate_hardware_graphic, get_datetime_string_from_timestamp
+    from mailer import send_email
+
     attachments = []
     label = " ".join([word.capitalize() for word in metric.split('_')])
     subject = f"Hardware Threshhold Breach: {label} on {site_name}"
@@ -301,14 +404,14 @@ def send_warning_email_for_metric(site_name,
     
     metric_graphic = generate_hardware_graphic(metric, site_name, metric_measure)
     
-    intervals = int(get_interval_in_minutes('hardware') * 60)
-    logging.info(f"Generating graphic trends for the last hour: {intervals} intervals")
-    logging.info(f"Source for trends for the last hour: {source_file} intervals")
+    # By time rather than a count of samples, adaptive sampling changes the interval
+    logging.info("Generating graphic trends for the last hour")
+    logging.info(f"Source for trends for the last hour: {source_file}")
     
     last_hr_trends = generate_graphs_for_daily_report(
         site_name=site_name,
         hardware_source_file=source_file,
-        last_n_items=intervals,
+        since_timestamp=(scoped_time_stamp or time.time()) - 3600,
         scope_by_metric=metric
     )
     
@@ -319,11 +422,13 @@ def send_warning_email_for_metric(site_name,
         attachments.append(trend_graph)
         export_folder = os.path.dirname(trend_graph)
         
-    # Generate graphic for n: 10 records before and after recorded spike
+    # Generate graphic for n: 10 records before and after recorded spike,
+    # or for every raw reading kept before it with high resolution sampling
     time_scoped_graphic = generate_graphs_for_daily_report(
         site_name=site_name,
-        hardware_source_file=source_file,
+        hardware_source_file=raw_source_file or source_file,
         scoped_time_stamp=scoped_time_stamp,
+        scoped_items=None if raw_source_file else 10,
         scope_by_metric=metric
     )
     
@@ -336,12 +441,24 @@ def send_warning_email_for_metric(site_name,
     logging.info(f'Attaching graphic at {metric_graphic}')
     attachments.append(metric_graphic)
 
+    # Stays in results/ after the email is sent
+    if raw_source_file:
+        logging.info(f'Attaching high resolution readings at {raw_source_file}')
+        attachments.append(raw_source_file)
+
+    top_processes = ''
+    if process_source_file:
+        logging.info(f'Attaching top processes at {process_source_file}')
+        attachments.append(process_source_file)
+        top_processes = format_top_processes(process_source_file, 'top_rss' if metric == 'ram_usage' else 'top_cpu')
+
     msg = (
         f"Greetings,\n\n"
         f"Kindly note that the site {site_name}'s {label} has breached it's threshold. Please check the attached graphic for your perusal.\n\n"
         f"The following parameters have been breached:\n\n"
         f"{label} currently has a value of {metric_measure} %.\n"
         f"Previous trigger time: {last_trigger_time}\n"
+        f"{top_processes}"
         f"Regards"
     )
 
@@ -355,12 +472,166 @@ def send_warning_email_for_metric(site_name,
     
 
 
-def get_interval_in_minutes(metric):
+def format_top_processes(process_source_file, key, count=5):
+    with open(process_source_file) as file:
+        entries = json.load(file).get(key, [])[:count]
+    if not entries:
+        return ''
+    lines = "\n".join(f"{entry['name']} (pid {entry['pid']}): {entry['cpu_percent']} % CPU, {entry['rss_mb']} MB RSS" for entry in entries)
+    return f"\nTop processes at the breach:\n{lines}\n\n"
+
+
+def send_anomaly_email(site_name,
+                       cc,
+                       kind,
+                       metric,
+                       metric_measure,
+                       baselines,
+                       scores,
+                       source_file,
+                       scoped_time_stamp
+                       ):
+    from graph_generator import generate_graphs_for_daily_report
+    from mailer import send_email
+
+    attachments = []
+    export_folder = ''
+    label = " ".join([word.capitalize() for word in metric.split('_')])
+    subject = f"Anomaly: {label} on {site_name}"
+
+    logging.info(f"Sending anomaly email for {label} on {site_name}")
+
+    # Last hour of the series, hardware only as pings aren't graphed by value
+    if kind == 'hardware' and source_file and os.path.exists(source_file):
+        last_hr_trends = generate_graphs_for_daily_report(
+            site_name=site_name,
+            hardware_source_file=source_file,
+            since_timestamp=(scoped_time_stamp or time.time()) - 3600,
+            scope_by_metric=metric
+        )
+        if last_hr_trends and last_hr_trends[0]:
+            attachments.append(last_hr_trends[0])
+            export_folder = os.path.dirname(last_hr_trends[0])
+
+    expected = "\n".join(f"{detector}: {baselines[detector]} (z-score {scores[detector]})" for detector in sorted(scores))
+    msg = (
+        f"Greetings,\n\n"
+        f"Kindly note that the site {site_name}'s {label} is well above its usual level, although it may be within its threshold.\n\n"
+        f"{label} currently has a value of {metric_measure}.\n"
+        f"Expected levels:\n{expected}\n"
+        f"Regards"
+    )
+
+    logging.info("Sending email")
+    send_email(cc, subject, msg, attachments)
+
+    if export_folder:
+        clear_folder(export_folder)
+
+
+def send_forecast_email(site_name,
+                       cc,
+                       metric,
+                       metric_measure,
+                       growth_per_day,
+                       hours_to_full,
+                       horizon_hours,
+                       source_file
+                       ):
+    from graph_generator import generate_graphs_for_daily_report
+    from mailer import send_email
+
+    attachments = []
+    export_folder = ''
+    label = " ".join([word.capitalize() for word in metric.split('_')])
+    subject = f"Capacity Forecast: {label} on {site_name}"
+
+    logging.info(f"Sending forecast email for {label} on {site_name}")
+
+    # The day's trend the projection follows
+    if source_file and os.path.exists(source_file):
+        trends = generate_graphs_for_daily_report(
+            site_name=site_name,
+            hardware_source_file=source_file,
+            scope_by_metric=metric
+        )
+        if trends and trends[0]:
+            attachments.append(trends[0])
+            export_folder = os.path.dirname(trends[0])
+
+    msg = (
+        f"Greetings,\n\n"
+        f"Kindly note that the site {site_name}'s {label} is projected to reach 100 % within {horizon_hours} hours.\n\n"
+        f"{label} currently has a value of {metric_measure} %, growing {growth_per_day} % a day.\n"
+        f"Projected full in: {hours_to_full} hours ({round(hours_to_full / 24, 1)} days).\n"
+        f"Regards"
+    )
+
+    logging.info("Sending email")
+    send_email(cc, subject, msg, attachments)
+
+    if export_folder:
+        clear_folder(export_folder)
+
+
+def send_warning_email_for_nginx_metric(site_name,
+                       cc,
+                       metric,
+                       metric_measure,
+                       threshold,
+                       previous_alert_data,
+                       source_file,
+                       window_seconds
+                       ):
+    from graph_generator import generate_nginx_error_trends_graph, get_datetime_string_from_timestamp
+    from mailer import send_email
+
+    attachments = []
+    label = "Failure Rate" if metric == 'failure_rate' else "Request Time p99"
+    unit = "%" if metric == 'failure_rate' else "ms"
+    subject = f"nginx Threshhold Breach: {label} on {site_name}"
+    last_trigger_time = previous_alert_data.get(f'{metric}_last_trigger_time')
+    last_trigger_time = get_datetime_string_from_timestamp(last_trigger_time) if last_trigger_time else "N/A."
+
+    logging.info(f"Sending warning email for nginx {label} breach on {site_name}")
+
+    # Buckets stored over the last hour, if any have completed yet
+    if source_file and os.path.exists(source_file):
+        with open(source_file) as file:
+            data = json.load(file)
+        cutoff = time.time() - 3600
+        trend_graph = generate_nginx_error_trends_graph(
+            site_name,
+            [record for record in data if record['timestamp'] >= cutoff],
+            thresholds={metric: threshold},
+            sub_folder='nginx_alerts'
+        )
+        if trend_graph:
+            logging.info(f"Adding last hr trend graph to attachements {trend_graph}")
+            attachments.append(trend_graph)
+
+    msg = (
+        f"Greetings,\n\n"
+        f"Kindly note that the site {site_name}'s nginx {label} has breached it's threshold. Please check the attached graphic for your perusal.\n\n"
+        f"The following parameters have been breached:\n\n"
+        f"{label} over the last {int(window_seconds / 60)} minutes currently has a value of {metric_measure} {unit} (threshold {threshold} {unit}).\n"
+        f"Previous trigger time: {last_trigger_time}\n"
+        f"Regards"
+    )
+
+    logging.info("Sending email")
+    send_email(cc, subject, msg, attachments)
+
+    for attachment in attachments:
+        os.remove(attachment)
+
+
+def get_interval_in_minutes(metric, site_name=None):
     metric_interval_map = {
         "hardware": "HARDWARE_CHECK_INTERVAL",
         "ping": "PING_INTERVAL"
     }
-    conf = get_config()
+    conf = get_site_config(site_name) if site_name else get_config()
     # Return interval in minutes
     return conf.get(metric_interval_map.get(metric.lower()), 60) / 60
 
@@ -376,8 +647,11 @@ def get_data_scoped_by_time_stamp(timestamp, data, n=10):
         else:
             break
         
-    start_index = max(0, index - 10)
-    end_index = min(len(data_sorted), index + 11)
+    if n is None:
+        return data_sorted[:index + 1]
+
+    start_index = max(0, index - n)
+    end_index = min(len(data_sorted), index + n + 1)
     return data_sorted[start_index: end_index]
 
 def clear_folder(folder):